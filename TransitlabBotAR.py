@@ -1,18 +1,32 @@
+import asyncio
 import logging
 import os
+import shutil
 from datetime import datetime
 import psycopg2
 from psycopg2 import extras
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
-import gpxpy
-from shapely.geometry import Point, LineString
-from simplification.cutil import simplify_coords_vw
+from shapely.geometry import LineString
 import pandas as pd
 from sqlalchemy import create_engine
 import itertools
 import boto3
+from send_scheduler import FloodControlRateLimiter, PRIORITY_CONFIRMATION, PRIORITY_INFO
+from track_parser import TRACK_EXTENSIONS, read_track_file, track_file_suffix
+from bulk_upload import parse_metadata_sheet, expand_uploads, parse_files_parallel
+from gps_cleaning import clean_track
+from trip_storage import POINT_TYPE_CODES, linestring_m_wkt, multipoint_m_wkt, read_session_tracks, recorded_at, simplify_route
+from shared_state import open_state_store, bind_user_state
+from session_spool import SessionSpool
+from passenger_events import analyze_passenger_events, remove_hotspots, save_hotspots
+from stop_index import StopIndex
+from place_index import PlaceIndex
+from vector_tiles import mark_tiles_dirty, tiles_for_line, tiles_for_point, tiles_for_wkt
+from coverage_grid import SERVICE_AREA, cell_center, least_covered_cells, parse_bbox, remove_coverage, save_coverage
+from speed_profiles import LOCAL_TIMEZONE, remove_speed_profile, save_speed_profile
+from query_api import notify_changes
 
 # Load environment variables
 load_dotenv()
@@ -24,13 +38,16 @@ db_user = os.getenv('DB_USER')
 db_password = os.getenv('DB_PASSWORD')
 db_name = os.getenv('DB_NAME')
 
-conn = psycopg2.connect(
-    host=db_host,
-    port=db_port,
-    user=db_user,
-    password=db_password,
-    dbname=db_name
-)
+def connect_db():
+    return psycopg2.connect(
+        host=db_host,
+        port=db_port,
+        user=db_user,
+        password=db_password,
+        dbname=db_name
+    )
+
+conn = connect_db()
 
 engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
 # Configure S3
@@ -49,11 +66,30 @@ logging.basicConfig(
 # Global variables
 user_data = {}
 video_path = os.path.join(os.path.dirname(__file__), 'intro_480p.mp4')
+gps_smoothing_window = int(os.getenv('GPS_SMOOTHING_WINDOW', 0))
+# Time zone of the hour of day in speed_profiles
+local_timezone = os.getenv('LOCAL_TIMEZONE', LOCAL_TIMEZONE)
+# 'points' stores one route_points row per GPS point, 'trips' stores one bus_trips row per session
+trip_storage_mode = os.getenv('TRIP_STORAGE_MODE', 'points')
+# Shared conversation state for multi-worker deployments, user_data stays process-local when unset
+state_store = open_state_store(os.getenv('STATE_STORE_URL'))
+# Finished sessions are journaled here first and drained into the database
+session_spool = SessionSpool(os.getenv('SPOOL_DIR', os.path.join(os.getcwd(), 'spool')), os.getenv('SPOOL_NAME', 'sessions'))
+spool_batch_size = int(os.getenv('SPOOL_BATCH_SIZE', 50))
+spool_drain_interval = float(os.getenv('SPOOL_DRAIN_INTERVAL', 10))
+# Shared locations closer than this to a recorded stop are offered as the same stop
+stop_merge_radius = float(os.getenv('STOP_MERGE_RADIUS_M', 30))
+# min_lon,min_lat,max_lon,max_lat of the area /coverage suggests, so it includes areas nobody recorded yet
+service_area = parse_bbox(os.getenv('SERVICE_AREA_BBOX')) if os.getenv('SERVICE_AREA_BBOX') else SERVICE_AREA
+stop_index = StopIndex()
+# Canonical places and their known spellings, used to suggest a place for the typed source and destination
+place_index = PlaceIndex()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
         [InlineKeyboardButton("🚌 تسجيل مسار الباص", callback_data='record_bus_route')],
         [InlineKeyboardButton("🚏 تسجيل محطة انطلاق الخط", callback_data='record_bus_stop')],
+        [InlineKeyboardButton("📦 رفع ملفات متعددة (للمنسقين)", callback_data='bulk_upload')],
         [InlineKeyboardButton("🎥 مشاهدة فيديو تعريفي", callback_data='show_video')],
         [InlineKeyboardButton("❓ مساعدة", callback_data='help')]
     ]
@@ -70,17 +106,46 @@ async def show_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     if os.path.exists(video_path):
         with open(video_path, 'rb') as video_file:
-            await context.bot.send_video(chat_id=query.message.chat_id, video=video_file, caption=" للعودة إلى القائمة الرئيسية اضغط /start")
+            await context.bot.send_video(chat_id=query.message.chat_id, video=video_file, caption=" للعودة إلى القائمة الرئيسية اضغط /start", rate_limit_args=PRIORITY_INFO)
     else:
-        await context.bot.send_message(chat_id=query.message.chat_id, text="الفيديو غير موجود. يرجى المحاولة لاحقاً.")
+        await context.bot.send_message(chat_id=query.message.chat_id, text="الفيديو غير موجود. يرجى المحاولة لاحقاً.", rate_limit_args=PRIORITY_INFO)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     help_text = (
         "❓ مساعدة:\n"
         "1. <b>🚌 تسجيل مسار الباص:</b> تسجيل مسار الباص بواسطة برنامج تسجيل المسار باستخدام GPS حيث يتم تسجيل المسار للباص عند الصعود وانهاء التسجيل عند النزول ثم ارسال ملف التتبع الى البوت لحفظ المعلومات.\n"
-        "2. <b>🚏 تسجيل محطة انطلاق الخط:</b> يستخدم هذا الخيار لتسجيل موقع انطلاق الباص من الكراج او من اماكن تجمع الباصات."
+        "2. <b>🚏 تسجيل محطة انطلاق الخط:</b> يستخدم هذا الخيار لتسجيل موقع انطلاق الباص من الكراج او من اماكن تجمع الباصات.\n"
+        "3. <b>🗺️ /coverage:</b> عرض المناطق الأقل تسجيلاً للرحلات، لتحديد أين يتم التسجيل لاحقاً."
     )
-    await update.message.reply_text(help_text, parse_mode='HTML')
+    # rate_limit_args is only accepted by the bot methods, not by the message shortcuts
+    await context.bot.send_message(chat_id=update.message.chat_id, text=help_text, parse_mode='HTML', rate_limit_args=PRIORITY_INFO)
+
+async def coverage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM coverage_cells WHERE level = 1")
+            covered = cur.fetchone()[0]
+            cells = least_covered_cells(cur, level=1, limit=10, bbox=service_area)
+        conn.commit()
+    except Exception as e:
+        rollback_quietly()
+        logging.error(f"Error reading coverage: {e}")
+        await context.bot.send_message(chat_id=update.message.chat_id, text="حدث خطأ أثناء قراءة التغطية. يرجى المحاولة مرة أخرى لاحقاً.", rate_limit_args=PRIORITY_INFO)
+        return
+
+    if covered:
+        lines = [f"🗺️ التغطية: {covered} منطقة بحجم 900 م تقريباً فيها رحلات مسجلة. المناطق الأقل تغطية:"]
+    else:
+        lines = ["🗺️ لم يتم تسجيل أي رحلة بعد. مناطق للبدء بها:"]
+    for index, cell in enumerate(cells, start=1):
+        lat, lon = cell_center(1, cell['cell_x'], cell['cell_y'])
+        if not cell['session_count']:
+            lines.append(f"{index}. لم تُسجل أي رحلة بعد\nhttps://maps.google.com/?q={lat:.5f},{lon:.5f}")
+            continue
+        vehicles = '، '.join(f"{name} {cell[column]}" for name, column in (('كيا', 'kia_sessions'), ('كوستر', 'coaster_sessions'), ('باص', 'bus_sessions')) if cell[column])
+        last_seen = cell['last_seen'].strftime('%Y-%m-%d') if cell['last_seen'] else "لا يوجد"
+        lines.append(f"{index}. {cell['session_count']} رحلة ({vehicles})، آخر تسجيل {last_seen}\nhttps://maps.google.com/?q={lat:.5f},{lon:.5f}")
+    await context.bot.send_message(chat_id=update.message.chat_id, text='\n'.join(lines), disable_web_page_preview=True, rate_limit_args=PRIORITY_INFO)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -129,11 +194,47 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("شنو نوع النقل العام اللي راح تستخدمه؟", reply_markup=reply_markup)
 
+    elif query.data == 'bulk_upload':
+        session_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        user_data[user_id] = {'step': 'bulk_metadata', 'session_id': session_id, 'username': query.from_user.username}
+        await query.edit_message_text("📦 رفع ملفات متعددة: ارسل المعلومات المشتركة لكل الملفات برسالة وحدة، كل معلومة بسطر:\n\n<code>المركبة: كيا\nالانطلاق: علاوي\nالوجهة: بياع\nالأجرة: 750\nالحالة: جيدة</code>\n\nسطر الحالة اختياري.", parse_mode='HTML')
+
+    elif query.data == 'bulk_finish':
+        if user_id not in user_data or user_data[user_id].get('step') != 'bulk_upload':
+            logging.error(f"Missing bulk upload data for user {user_id}")
+            return
+        await finish_bulk_upload(user_id, query, context)
+
+    elif query.data == 'new_stop' or query.data.startswith('same_stop_'):
+        if user_id not in user_data or user_data[user_id].get('step') != 'confirm_bus_stop':
+            logging.error(f"Missing bus stop data for user {user_id}")
+            return
+        lat, lon = user_data[user_id]['stop_location']
+        same_as_stop_id = int(query.data.split('same_stop_')[1]) if query.data.startswith('same_stop_') else None
+        save_bus_stop(user_id, lat, lon, same_as_stop_id)
+        user_data.pop(user_id, None)
+        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup([]))
+        await context.bot.send_message(chat_id=query.message.chat_id, text="تم حفظ محطة انطلاق الخط. شكراً! اضغط /start للعودة للقائمة الرئيسية.", reply_markup=ReplyKeyboardRemove(), rate_limit_args=PRIORITY_CONFIRMATION)
+
+    elif query.data.startswith('place_source_') or query.data.startswith('place_destination_'):
+        field, choice = query.data[len('place_'):].rsplit('_', 1)
+        if user_id not in user_data or user_data[user_id].get('step') != f'{field}_place':
+            logging.error(f"Missing place data for user {user_id}")
+            return
+        user_data[user_id][f'{field}_place_id'] = resolve_place(user_data[user_id][field], None if choice == 'new' else int(choice))
+        if field == 'source':
+            user_data[user_id]['step'] = 'destination'
+            await query.edit_message_text("🗺️ أدخل الوجهة (ليوين رايح الباص؟):")
+        else:
+            await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup([]))
+            await ask_fare(user_id, context)
+
     elif query.data == 'help':
         await help_command(query, context)
 
     elif query.data == 'cancel':
-        user_data[user_id]['last_step'] = user_data[user_id]['step']  # Store the current step
+        if user_id in user_data:
+            user_data[user_id]['last_step'] = user_data[user_id].get('step')  # Store the current step
         keyboard = [
             [InlineKeyboardButton("✅ نعم", callback_data='confirm_cancel')],
             [InlineKeyboardButton("❌ لا", callback_data='deny_cancel')]
@@ -143,8 +244,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif query.data == 'confirm_cancel':
         await mark_session_as_canceled(user_id)
+        cleanup_bulk_upload(user_id)
         user_data.pop(user_id, None)
-        await query.edit_message_text("تم الإلغاء! يرجى الضغط على /start للعودة إلى القائمة الرئيسية.", reply_markup=InlineKeyboardMarkup([]))
+        await context.bot.edit_message_text("تم الإلغاء! يرجى الضغط على /start للعودة إلى القائمة الرئيسية.", chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup([]), rate_limit_args=PRIORITY_CONFIRMATION)
 
     elif query.data == 'deny_cancel':
         # Resume from the last step
@@ -161,9 +263,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await query.edit_message_text("شنو نوع النقل العام اللي راح تستخدمه؟", reply_markup=reply_markup)
-            elif step == 'source':
+            elif step in ('source', 'source_place'):
                 await query.edit_message_text("🗺️ أدخل مكان الانطلاق (من وين طالع الباص؟ مثلا علاوي, باب معظم, بياع .. الخ):")
-            elif step == 'destination':
+            elif step in ('destination', 'destination_place'):
                 await query.edit_message_text("🗺️ أدخل الوجهة (ليوين رايح الباص؟):")
             elif step == 'enter_fare':
                 await query.edit_message_text("💬 أدخل الأجرة يدويًا (ارقام فقط بدون العملة):")
@@ -175,6 +277,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await query.edit_message_text("شنو نوع النقل العام اللي راح تستخدمه؟", reply_markup=reply_markup)
+            elif step == 'bulk_upload':
+                await query.edit_message_text("📂 هسة ارسل ملفات GPX او ملفات ZIP، تگدر ترسل اكثر من ملف مرة وحدة. اضغط ✅ إنهاء بعد ما ترسل كل الملفات.", reply_markup=bulk_upload_markup())
             elif step == 'destination_bus_stop':
                 await query.edit_message_text("🗺️ أدخل الوجهة (ليوين رايح الباص؟):")
             # Restore the original step
@@ -197,7 +301,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if user_id in user_data and 'fare' in user_data[user_id] and 'session_id' in user_data[user_id]:
             user_data[user_id]['vehicle_condition'] = vehicle_condition
             await save_all_data(user_id)
-            await query.edit_message_text("تم تسجيل الأجرة وحالة المركبة. شكراً! اضغط /start للعودة إلى القائمة الرئيسية.", reply_markup=InlineKeyboardMarkup([]))
+            await context.bot.edit_message_text("تم تسجيل الأجرة وحالة المركبة. شكراً! اضغط /start للعودة إلى القائمة الرئيسية.", chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=InlineKeyboardMarkup([]), rate_limit_args=PRIORITY_CONFIRMATION)
         else:
             logging.error(f"Missing session data for user {user_id}")
 
@@ -224,17 +328,84 @@ async def ask_vehicle_condition(user_id: int, context: ContextTypes.DEFAULT_TYPE
     await context.bot.send_message(chat_id=user_id, text="🚐 كيف كانت حالة المركبة (شنو تقييمك للسيارة بشكل عام)؟", reply_markup=reply_markup)
 
 async def mark_session_as_canceled(user_id: int) -> None:
-    logging.info(f"Marking session as canceled for user {user_id}")
-    session_id = user_data[user_id]['session_id']
-    with conn.cursor() as cur:
+    session_id = user_data.get(user_id, {}).get('session_id')
+    if session_id is None:
+        logging.info(f"No session to cancel for user {user_id}")
+        return
+    logging.info(f"Marking session {session_id} as canceled for user {user_id}")
+    try:
+        # Journaled behind the session's own record, so a session still waiting in the spool is dropped
+        # before it is written and one already written is canceled in the same order
+        session_spool.append({'type': 'cancel', 'user_id': user_id, 'session_id': session_id})
+    except Exception as e:
+        logging.error(f"Error journaling the cancellation of session {session_id}: {e}")
+        return
+    drain_session_spool()
+
+def cancel_session(cur, user_id, session_id) -> None:
+    # Every table holding rows of the session in one transaction, each update is served by its
+    # (user_id, session_id) index and bus_routes reads cancel from the sessions row
+    for table in ('bus_trips', 'fares'):
         cur.execute(
-            """
-            UPDATE bus_routes
+            f"""
+            UPDATE {table}
             SET cancel = TRUE
-            WHERE user_id = %s AND session_id = %s
+            WHERE user_id = %s AND session_id = %s AND cancel = FALSE
             """, (user_id, session_id)
         )
-        conn.commit()
+
+    # The counts ingest_session added to the aggregates are taken off again, computed from the stored rows.
+    # Only rows that were not canceled yet are returned, so a repeated cancel subtracts nothing.
+    cur.execute(
+        """
+        UPDATE sessions
+        SET cancel = TRUE
+        WHERE user_id = %s AND session_id = %s AND cancel = FALSE
+        RETURNING id, vehicle_type
+        """, (user_id, session_id)
+    )
+    for session_ref, vehicle_type in cur.fetchall():
+        tracks = read_session_tracks(cur, session_ref, user_id, session_id)
+        remove_coverage(cur, vehicle_type, tracks)
+        remove_speed_profile(cur, tracks, local_timezone)
+    cur.execute(
+        """
+        UPDATE passenger_events
+        SET cancel = TRUE
+        WHERE user_id = %s AND session_id = %s AND cancel = FALSE
+        RETURNING cell_x, cell_y, dwell_seconds, snapped_lat, snapped_lon
+        """, (user_id, session_id)
+    )
+    remove_hotspots(cur, [
+        {'cell_x': cell_x, 'cell_y': cell_y, 'dwell_seconds': dwell_seconds, 'snapped_lat': snapped_lat, 'snapped_lon': snapped_lon}
+        for cell_x, cell_y, dwell_seconds, snapped_lat, snapped_lon in cur.fetchall()
+    ])
+
+    tiles = set()
+    cur.execute(
+        """
+        UPDATE simplified_bus_routes
+        SET cancel = TRUE
+        WHERE user_id = %s AND session_id = %s AND cancel = FALSE
+        RETURNING ST_AsText(geom_line)
+        """, (user_id, session_id)
+    )
+    for (line_wkt,) in cur.fetchall():
+        tiles |= tiles_for_wkt(line_wkt)
+    cur.execute(
+        """
+        UPDATE bus_stops
+        SET cancel = TRUE
+        WHERE user_id = %s AND session_id = %s AND cancel = FALSE
+        RETURNING id, lat, lon, same_as_stop_id
+        """, (user_id, session_id)
+    )
+    for stop_id, lat, lon, same_as_stop_id in cur.fetchall():
+        stop_index.remove(stop_id)
+        if same_as_stop_id is None and lat is not None and lon is not None:
+            tiles |= tiles_for_point(lon, lat)
+    mark_tiles_dirty(cur, tiles)
+    notify_changes(cur)
 
 async def save_fare(user_id: int) -> None:
     try:
@@ -269,19 +440,39 @@ async def handle_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if user_id not in user_data:
         user_data[user_id] = {'session_id': datetime.now().strftime("%Y%m%d%H%M%S"), 'username': update.message.from_user.username}
 
-    if user_id in user_data and user_data[user_id]['step'] == 'source':
+    if user_id in user_data and user_data[user_id]['step'] in ('source', 'source_place'):
         user_data[user_id]['source'] = text
-        user_data[user_id]['step'] = 'destination'
-        await update.message.reply_text("🗺️ أدخل الوجهة (ليوين رايح الباص؟):")
+        if not await offer_places(update, user_id, 'source', text):
+            user_data[user_id]['source_place_id'] = resolve_place(text)
+            user_data[user_id]['step'] = 'destination'
+            await update.message.reply_text("🗺️ أدخل الوجهة (ليوين رايح الباص؟):")
 
-    elif user_id in user_data and user_data[user_id]['step'] == 'destination':
+    elif user_id in user_data and user_data[user_id]['step'] in ('destination', 'destination_place'):
         user_data[user_id]['destination'] = text
-        await ask_fare(user_id, context)
+        if not await offer_places(update, user_id, 'destination', text):
+            user_data[user_id]['destination_place_id'] = resolve_place(text)
+            await ask_fare(user_id, context)
 
     elif user_data[user_id]['step'] == 'enter_fare':
         user_data[user_id]['fare'] = text
         await ask_vehicle_condition(user_id, context)
 
+    elif user_data[user_id].get('step') == 'bulk_metadata':
+        metadata, missing = parse_metadata_sheet(text)
+        if not missing:
+            metadata['source_place_id'] = place_index.lookup(metadata['source'])
+            metadata['destination_place_id'] = place_index.lookup(metadata['destination'])
+        if missing:
+            field_names = {'vehicle_type': 'المركبة (كيا، كوستر او باص)', 'source': 'الانطلاق', 'destination': 'الوجهة', 'fare': 'الأجرة'}
+            fields = ', '.join(field_names[field] for field in missing)
+            await update.message.reply_text(f"بعض المعلومات ناقصة او غير صحيحة: {fields}. يرجى ارسال المعلومات مرة أخرى.")
+            return
+        bulk_dir = os.path.join(os.getcwd(), f"bulk_{user_data[user_id]['username']}_{user_data[user_id]['session_id']}")
+        os.makedirs(bulk_dir, exist_ok=True)
+        user_data[user_id]['bulk'] = {'metadata': metadata, 'dir': bulk_dir, 'files': []}
+        user_data[user_id]['step'] = 'bulk_upload'
+        await update.message.reply_text("📂 هسة ارسل ملفات GPX او ملفات ZIP، تگدر ترسل اكثر من ملف مرة وحدة. اضغط ✅ إنهاء بعد ما ترسل كل الملفات.", reply_markup=bulk_upload_markup())
+
     elif user_id in user_data and user_data[user_id]['step'] == 'destination_bus_stop':
         user_data[user_id]['destination'] = text
         user_data[user_id]['step'] = 'location_bus_stop'
@@ -300,53 +491,164 @@ async def handle_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text("❌ هل أنت متأكد من الإلغاء؟", reply_markup=reply_markup)
 
+async def offer_places(update: Update, user_id: int, field: str, text: str) -> bool:
+    suggestions = place_index.suggest(text)
+    if not suggestions:
+        return False
+    user_data[user_id]['step'] = f'{field}_place'
+    keyboard = [
+        [InlineKeyboardButton(f"📍 {name}", callback_data=f"place_{field}_{place_id}")]
+        for place_id, name, score in suggestions
+    ]
+    keyboard.append([InlineKeyboardButton(f'✏️ إبقاء "{text}"', callback_data=f'place_{field}_new')])
+    await update.message.reply_text("هل تقصد أحد هذه الأماكن؟", reply_markup=InlineKeyboardMarkup(keyboard))
+    return True
+
+def resolve_place(text: str, place_id: int = None):
+    # Every spelling is kept as an alias of its place, so the next volunteer typing it gets the same suggestion
+    created = False
+    try:
+        with conn.cursor() as cur:
+            if place_id is None:
+                # A spelling saved before keeps its place, a new place is only created for an unknown name
+                cur.execute("SELECT place_id FROM place_aliases WHERE alias = %s", (text,))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute("INSERT INTO places (canonical_name) VALUES (%s) RETURNING id", (text,))
+                    row = cur.fetchone()
+                    created = True
+                place_id = row[0]
+            cur.execute(
+                "INSERT INTO place_aliases (alias, place_id) VALUES (%s, %s) ON CONFLICT (alias) DO NOTHING RETURNING place_id",
+                (text, place_id)
+            )
+            if cur.fetchone() is None and created:
+                # Another worker saved the same name in between, its place is used and the new one rolled back
+                conn.rollback()
+                created = False
+                cur.execute("SELECT place_id FROM place_aliases WHERE alias = %s", (text,))
+                place_id = cur.fetchone()[0]
+        conn.commit()
+    except Exception as e:
+        rollback_quietly()
+        logging.error(f"Error saving place {text}: {e}")
+        # A place created in the failed transaction does not exist
+        return None if created else place_id
+
+    if place_id in place_index.places:
+        place_index.add_alias(place_id, text)
+    else:
+        place_index.add_place(place_id, text)
+    return place_id
+
 async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
     if user_id not in user_data:
         await update.message.reply_text("يرجى الاختيار من القائمة.")
         return
 
-    current_time = datetime.now()
     lat, lon = update.message.location.latitude, update.message.location.longitude
 
     if user_data[user_id].get('step') == 'location_bus_stop':
-        session_id = user_data[user_id]['session_id']
-        vehicle_type = user_data[user_id]['vehicle_type']
-        username = user_data[user_id]['username']
+        nearby = stop_index.nearby(lat, lon, stop_merge_radius)
+        if nearby:
+            # Offer the existing stops instead of recording the same place again with slightly different coordinates
+            user_data[user_id]['stop_location'] = (lat, lon)
+            user_data[user_id]['step'] = 'confirm_bus_stop'
+            keyboard = [
+                [InlineKeyboardButton(f"📍 نفس الموقف {stop['id']} ({stop['destination']}، {distance:.0f} م)", callback_data=f"same_stop_{stop['id']}")]
+                for distance, stop in nearby
+            ]
+            keyboard.append([InlineKeyboardButton("➕ موقف جديد", callback_data='new_stop')])
+            await update.message.reply_text("يوجد موقف مسجل قريب من هذا الموقع. هل هو نفس الموقف؟", reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+
+        save_bus_stop(user_id, lat, lon)
+        user_data.pop(user_id, None)
+        await context.bot.send_message(chat_id=update.message.chat_id, text="تم حفظ محطة انطلاق الخط. شكراً! اضغط /start للعودة للقائمة الرئيسية.", reply_markup=ReplyKeyboardRemove(), rate_limit_args=PRIORITY_CONFIRMATION)
+
+def save_bus_stop(user_id: int, lat: float, lon: float, same_as_stop_id: int = None) -> None:
+    current_time = datetime.now()
+    session_id = user_data[user_id]['session_id']
+    vehicle_type = user_data[user_id]['vehicle_type']
+    username = user_data[user_id]['username']
+    destination = user_data[user_id]['destination']
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO bus_stops (user_id, telegram_username, session_id, vehicle_type, date, time, destination, lat, lon, cancel, same_as_stop_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """, (user_id, username, session_id, vehicle_type, current_time.date(), current_time.time(), destination, lat, lon, False, same_as_stop_id)
+        )
+        stop_id = cur.fetchone()[0]
+        if same_as_stop_id is None:
+            mark_tiles_dirty(cur, tiles_for_point(lon, lat))
+        notify_changes(cur)
+        conn.commit()
+
+    # Confirmations of an existing stop stay out of the index so it only holds one entry per place
+    if same_as_stop_id is None:
+        stop_index.add(stop_id, lat, lon, destination)
+
+def refresh_place_index() -> None:
+    # Only places and spellings added since the last refresh, e.g. by other worker processes
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, canonical_name FROM places WHERE id > %s ORDER BY id", (place_index.last_place_id,))
+            place_index.load_places(cur.fetchall())
+            cur.execute("SELECT id, alias, place_id FROM place_aliases WHERE id > %s ORDER BY id", (place_index.last_alias_id,))
+            place_index.load_aliases(cur.fetchall())
+        conn.commit()
+    except Exception as e:
+        rollback_quietly()
+        logging.error(f"Error refreshing the place index: {e}")
 
+def refresh_stop_index() -> None:
+    # Stops added or canceled since the last refresh, e.g. by other worker processes. Only the ids of the
+    # active stops are read, the rows are fetched for the new ones.
+    try:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO bus_stops (user_id, telegram_username, session_id, vehicle_type, date, time, destination, lat, lon, cancel)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (user_id, username, session_id, vehicle_type, current_time.date(), current_time.time(), user_data[user_id]['destination'], lat, lon, False)
+                SELECT id
+                FROM bus_stops
+                WHERE cancel = FALSE AND same_as_stop_id IS NULL AND lat IS NOT NULL AND lon IS NOT NULL
+                """
             )
-            conn.commit()
-
-        user_data.pop(user_id, None)
-        await update.message.reply_text("تم حفظ محطة انطلاق الخط. شكراً! اضغط /start للعودة للقائمة الرئيسية.", reply_markup=ReplyKeyboardRemove())
+            missing = stop_index.sync(stop_id for (stop_id,) in cur.fetchall())
+            if missing:
+                cur.execute(
+                    """
+                    SELECT id, lat, lon, destination
+                    FROM bus_stops
+                    WHERE id = ANY(%s)
+                    ORDER BY id
+                    """, (sorted(missing),)
+                )
+                stop_index.load(cur.fetchall())
+        conn.commit()
+    except Exception as e:
+        rollback_quietly()
+        logging.error(f"Error refreshing the bus stop index: {e}")
 
 def chunked_iterable(iterable, size):
     it = iter(iterable)
     while chunk := list(itertools.islice(it, size)):
         yield chunk
 
-def simplify_route(route_points, tolerance=0.000000001):
-    line = LineString(route_points)
-    simplified = simplify_coords_vw(line.coords, tolerance)
-    return list(simplified)
-
 def get_route_points(session_id, point_type):
     query = """
         SELECT lon, lat, time, telegram_username, date, source, destination, cancel
         FROM bus_routes
         WHERE session_id = %s AND point_type = %s
-        ORDER BY time
+        ORDER BY point_id
     """
     df = pd.read_sql(query, engine, params=(session_id, point_type))
     return df
 
-def save_to_simplified_table(user_id, username, vehicle_type, session_id, source, destination, simplified_points):
+def save_to_simplified_table(user_id, username, vehicle_type, session_id, source, destination, simplified_points, cur=None):
     logging.info("Inside save_to_simplified_table")
     line_geom = LineString(simplified_points).wkt
 
@@ -368,14 +670,24 @@ def save_to_simplified_table(user_id, username, vehicle_type, session_id, source
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromText(%s), 4326))
     """
 
-    with conn.cursor() as cur:
+    # Callers that pass a cursor commit the insert as part of their own transaction
+    # The vector tiles the new line crosses are queued for vector_tiles.py to render again
+    if cur is not None:
         cur.execute(insert_query, single_row)
-        conn.commit()
+        mark_tiles_dirty(cur, tiles_for_line(simplified_points))
+    else:
+        with conn.cursor() as cur:
+            cur.execute(insert_query, single_row)
+            mark_tiles_dirty(cur, tiles_for_line(simplified_points))
+            conn.commit()
 
     logging.info("Exiting save_to_simplified_table")
 
 async def gpx_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
+    if user_id in user_data and user_data[user_id].get('step') == 'bulk_upload':
+        await bulk_document_handler(update, context)
+        return
     if user_id not in user_data or user_data[user_id].get('step') != 'upload_gpx':
         await update.message.reply_text("يرجى الاختيار من القائمة.")
         return
@@ -385,7 +697,7 @@ async def gpx_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     session_id = user_data[user_id]['session_id']
     username = user_data[user_id]['username']
     current_date = datetime.now().strftime("%Y%m%d")
-    file_name = f'{username}_{session_id}_{current_date}.gpx'
+    file_name = f'{username}_{session_id}_{current_date}{track_file_suffix(update.message.document.file_name)}'
     file_path = os.path.join(os.getcwd(), file_name)
     await file.download_to_drive(file_path)
 
@@ -398,46 +710,92 @@ async def gpx_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         logging.error(f"Error uploading to s3: {e}")
 
     try:
-        # Initialize gpx_data dictionary
-        user_data[user_id]['gpx_data'] = {
-            'tracks': [],
-            'waypoints': []
-        }
-
-        # Parse the GPX file
-        with open(file_path, 'r') as gpx_file:
-            gpx = gpxpy.parse(gpx_file)
-
-        logging.info("GPX file parsed successfully")
-
-        point_id = 1
-
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    user_data[user_id]['gpx_data']['tracks'].append({
-                        'lat': point.latitude,
-                        'lon': point.longitude,
-                        'time': point.time,
-                        'type': 'bus_routing'
-                    })
-                    point_id += 1
-
-        point_id = 1
-        for waypoint in gpx.waypoints:
-            user_data[user_id]['gpx_data']['waypoints'].append({
-                'lat': waypoint.latitude,
-                'lon': waypoint.longitude,
-                'time': waypoint.time,
-                'type': 'passenger_on_off'
-            })
-            point_id += 1
+        # Parse the track file, the format is detected from its content
+        user_data[user_id]['gpx_data'] = read_track_file(file_path)
+
+        logging.info("Track file parsed successfully")
 
         await ask_vehicle_type(user_id, context)
     except Exception as e:
         logging.error(f"Error processing GPX file: {e}")
         await update.message.reply_text("حدث خطأ أثناء معالجة ملف GPX. يرجى المحاولة مرة أخرى.")
 
+def bulk_upload_markup() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton("✅ إنهاء", callback_data='bulk_finish')],
+        [InlineKeyboardButton("❌ إلغاء", callback_data='cancel')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def cleanup_bulk_upload(user_id: int) -> None:
+    bulk = user_data.get(user_id, {}).get('bulk')
+    if bulk:
+        shutil.rmtree(bulk['dir'], ignore_errors=True)
+
+async def bulk_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    document = update.message.document
+    bulk = user_data[user_id]['bulk']
+
+    file = await context.bot.get_file(document.file_id)
+    file_name = os.path.basename(document.file_name or 'upload.gpx')
+    file_path = os.path.join(bulk['dir'], f"{len(bulk['files']) + 1}_{file_name}")
+    await file.download_to_drive(file_path)
+    bulk['files'].append((file_name, file_path))
+    logging.info(f"Bulk upload file {file_name} received from user {user_id}")
+
+    try:
+        # Upload the file to S3
+        s3_key = f"gpx-files/{user_data[user_id]['username']}_{user_data[user_id]['session_id']}_{os.path.basename(file_path)}"
+        s3_client.upload_file(file_path, s3_bucket_name, s3_key)
+        logging.info(f"Bulk upload file uploaded to S3 at {s3_key}")
+    except Exception as e:
+        logging.error(f"Error uploading to s3: {e}")
+
+async def finish_bulk_upload(user_id: int, query, context: ContextTypes.DEFAULT_TYPE) -> None:
+    bulk = user_data[user_id]['bulk']
+    if not bulk['files']:
+        await query.edit_message_text("لم يتم استلام أي ملف بعد. يرجى ارسال ملفات GPX او ZIP اولاً.", reply_markup=bulk_upload_markup())
+        return
+
+    await query.edit_message_text(f"⏳ جاري معالجة {len(bulk['files'])} ملف...")
+    files = expand_uploads(bulk['files'], bulk['dir'])
+    results = await asyncio.to_thread(parse_files_parallel, files)
+
+    lines = []
+    saved = 0
+    for index, (name, path, gpx_data, error) in enumerate(results, start=1):
+        if gpx_data is not None:
+            session = dict(
+                bulk['metadata'],
+                session_id=f"{user_data[user_id]['session_id']}_{index}",
+                username=user_data[user_id]['username'],
+                gpx_data=gpx_data
+            )
+            # Journaled only, all sessions are drained together below
+            if await save_all_data(user_id, session, drain=False):
+                saved += 1
+                lines.append(f"✅ {name}: {len(gpx_data['tracks'])} نقطة، {len(gpx_data['waypoints'])} نقطة ركوب/نزول")
+                continue
+            error = "تعذر الحفظ"
+        lines.append(f"❌ {name}: {error}")
+    # The database writes go through the bot's one connection, spool_batch_size sessions per transaction
+    drain_session_spool()
+    logging.info(f"Bulk upload for user {user_id} finished: {saved} of {len(results)} files saved")
+
+    cleanup_bulk_upload(user_id)
+    user_data.pop(user_id, None)
+
+    # Keep the summary within Telegram's message size limit
+    shown = len(lines)
+    while shown > 0 and len('\n'.join(lines[:shown])) > 3500:
+        shown -= 1
+    summary = [f"📦 انتهى رفع الملفات: تم حفظ {saved} من {len(results)} ملف."] + lines[:shown]
+    if shown < len(lines):
+        summary.append(f"... و {len(lines) - shown} ملف آخر")
+    summary.append("اضغط /start للعودة إلى القائمة الرئيسية.")
+    await context.bot.send_message(chat_id=user_id, text='\n'.join(summary), rate_limit_args=PRIORITY_CONFIRMATION)
+
 async def ask_fare(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
         [
@@ -470,103 +828,254 @@ async def ask_vehicle_type(user_id: int, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = InlineKeyboardMarkup(keyboard)
     await context.bot.send_message(chat_id=user_id, text="شنو نوع النقل العام اللي راح تستخدمه؟", reply_markup=reply_markup)
 
-async def save_all_data(user_id: int) -> None:
+async def save_all_data(user_id: int, session: dict = None, drain: bool = True) -> bool:
+    # Bulk uploads pass their own session, the conversation flow uses the user's current one
+    if session is None:
+        session = user_data[user_id]
+    if 'source' not in session or 'destination' not in session or 'vehicle_type' not in session:
+        logging.info("Not all necessary data is available yet. Waiting for user input.")
+        return False
+
+    # The raw file stays archived, only the cleaned track points are stored
+    tracks, cleaning_report = clean_track(session['gpx_data']['tracks'], smoothing_window=gps_smoothing_window)
+    logging.info(f"Cleaned track for session {session['session_id']}: {cleaning_report}")
+
+    record = {
+        'user_id': user_id,
+        'username': session['username'],
+        'session_id': session['session_id'],
+        'source': session.get('source', 'unknown'),
+        'destination': session.get('destination', 'unknown'),
+        'source_place_id': session.get('source_place_id'),
+        'destination_place_id': session.get('destination_place_id'),
+        'vehicle_type': session['vehicle_type'],
+        'fare': session['fare'],
+        'vehicle_condition': session['vehicle_condition'],
+        'tracks': tracks,
+        'waypoints': session['gpx_data']['waypoints'],
+        'cleaning_report': cleaning_report
+    }
     try:
-        if 'source' not in user_data[user_id] or 'destination' not in user_data[user_id] or 'vehicle_type' not in user_data[user_id]:
-            logging.info("Not all necessary data is available yet. Waiting for user input.")
-            return
-        session_id = user_data[user_id]['session_id']
-        username = user_data[user_id]['username']
-        source = user_data[user_id].get('source', 'unknown')
-        destination = user_data[user_id].get('destination', 'unknown')
-        vehicle_type = user_data[user_id]['vehicle_type']
-        fare = user_data[user_id]['fare']
-        vehicle_condition = user_data[user_id]['vehicle_condition']
-
-        tracks = user_data[user_id]['gpx_data']['tracks']
-        waypoints = user_data[user_id]['gpx_data']['waypoints']
-
-        with conn.cursor() as cur:
-            track_values = [
-                (
-                    user_id, username, session_id, vehicle_type, point_id,
-                    track['time'].date(), track['time'].time(), source, destination,
-                    track['lat'], track['lon'], 'bus_routing', False
-                ) for point_id, track in enumerate(tracks, start=1)
-            ]
+        # Once journaled the session survives a database outage or a restart
+        session_spool.append(record)
+    except Exception as e:
+        logging.error(f"Error journaling session data: {e}")
+        return False
+
+    if drain:
+        drain_session_spool()
+    return True
+
+def apply_spool_record(cur, record, canceled=()) -> None:
+    if record.get('type') == 'cancel':
+        cancel_session(cur, record['user_id'], record['session_id'])
+    elif (record['user_id'], record['session_id']) in canceled:
+        logging.info(f"Session {record['session_id']} was canceled before it was written, skipping")
+    else:
+        ingest_session(cur, record)
+
+def ingest_session(cur, record) -> bool:
+    user_id = record['user_id']
+    session_id = record['session_id']
+    username = record['username']
+    source = record['source']
+    destination = record['destination']
+    vehicle_type = record['vehicle_type']
+    tracks = record['tracks']
+    waypoints = record['waypoints']
+    cleaning_report = record['cleaning_report']
+
+    # Committed together with the session rows, so a replayed journal record is skipped
+    cur.execute(
+        """
+        INSERT INTO ingested_sessions (idempotency_key, user_id, session_id)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (idempotency_key) DO NOTHING
+        """, (record['idempotency_key'], user_id, session_id)
+    )
+    if cur.rowcount == 0:
+        logging.info(f"Session {session_id} was already ingested, skipping")
+        return False
 
-            waypoint_values = [
-                (
-                    user_id, username, session_id, vehicle_type, point_id,
-                    waypoint['time'].date(), waypoint['time'].time(), source, destination,
-                    waypoint['lat'], waypoint['lon'], 'passenger_on_off', False
-                ) for point_id, waypoint in enumerate(waypoints, start=1)
-            ]
+    # Session metadata is stored once, point rows only carry its id
+    cur.execute(
+        """
+        INSERT INTO sessions (user_id, telegram_username, session_id, vehicle_type, source, destination, source_place_id, destination_place_id, date, time)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (user_id, session_id) DO UPDATE SET telegram_username = EXCLUDED.telegram_username
+        RETURNING id
+        """, (user_id, username, session_id, vehicle_type, source, destination, record.get('source_place_id'),
+              record.get('destination_place_id'), datetime.now().date(), datetime.now().time())
+    )
+    session_ref = cur.fetchone()[0]
 
-            sql_query = """
-                INSERT INTO bus_routes (user_id, telegram_username, session_id, vehicle_type, point_id, date, time, source, destination, lat, lon, point_type, cancel)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    if trip_storage_mode == 'trips':
+        cur.execute(
             """
-            extras.execute_batch(cur, sql_query, track_values + waypoint_values)
-
-            cur.execute(
-                """
-                INSERT INTO fares (user_id, telegram_username, session_id, date, time, source, destination, fare, vehicle_condition, vehicle_type)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (user_id, username, session_id, datetime.now().date(), datetime.now().time(), source, destination, fare, vehicle_condition, vehicle_type)
+            INSERT INTO bus_trips (user_id, telegram_username, session_id, vehicle_type, date, time, source, destination, cancel, geom_track, waypoints)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, ST_GeomFromText(%s, 4326), ST_GeomFromText(%s, 4326))
+            """, (user_id, username, session_id, vehicle_type, datetime.now().date(), datetime.now().time(), source, destination, False,
+                  linestring_m_wkt(tracks), multipoint_m_wkt(waypoints))
+        )
+    else:
+        point_values = [
+            (
+                session_ref, POINT_TYPE_CODES[point_type], point_id, recorded_at(point), point['lon'], point['lat']
             )
-
-            conn.commit()
-
-        track_update_values = [
-            (Point(track['lon'], track['lat']).wkt, session_id, track['lat'], track['lon'])
-            for track in tracks
-        ]
-        waypoint_update_values = [
-            (Point(waypoint['lon'], waypoint['lat']).wkt, session_id, waypoint['lat'], waypoint['lon'])
-            for waypoint in waypoints
+            for point_type, points in (('bus_routing', tracks), ('passenger_on_off', waypoints))
+            for point_id, point in enumerate(points, start=1)
         ]
+        extras.execute_batch(cur, """
+            INSERT INTO route_points (session_ref, point_type, point_id, recorded_at, geom_point)
+            VALUES (%s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+        """, point_values)
 
-        track_update_query = """
-            UPDATE bus_routes
-            SET geom_point = ST_SetSRID(ST_GeomFromText(%s), 4326)
-            WHERE session_id = %s AND point_type = 'bus_routing' AND lat = %s AND lon = %s
-        """
-        waypoint_update_query = """
-            UPDATE bus_routes
-            SET geom_point = ST_SetSRID(ST_GeomFromText(%s), 4326)
-            WHERE session_id = %s AND point_type = 'passenger_on_off' AND lat = %s AND lon = %s
+    cur.execute(
         """
+        INSERT INTO fares (user_id, telegram_username, session_id, date, time, source, destination, fare, vehicle_condition, vehicle_type,
+                           source_place_id, destination_place_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (user_id, username, session_id, datetime.now().date(), datetime.now().time(), source, destination,
+              record['fare'], record['vehicle_condition'], vehicle_type, record.get('source_place_id'), record.get('destination_place_id'))
+    )
 
-        with conn.cursor() as cur:
-            extras.execute_batch(cur, track_update_query, track_update_values)
-            extras.execute_batch(cur, waypoint_update_query, waypoint_update_values)
-            conn.commit()
+    cur.execute(
+        """
+        INSERT INTO gps_cleaning_reports (user_id, session_id, raw_points, duplicates, speed_outliers, stationary_points, kept_points)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (user_id, session_id, cleaning_report['raw_points'], cleaning_report['duplicates'], cleaning_report['speed_outliers'],
+              cleaning_report['stationary_points'], cleaning_report['kept_points'])
+    )
 
-        df = get_route_points(session_id, 'bus_routing')
-        route_points = list(zip(df['lon'], df['lat']))
-        simplified_points = simplify_route(route_points)
-        logging.info("Calling save_to_simplified_table...")
-        save_to_simplified_table(user_id, username, vehicle_type, session_id, source, destination, simplified_points)
-        logging.info("save_to_simplified_table called successfully")
-        logging.info("All data saved to the database")
-    except Exception as e:
-        conn.rollback()
-        logging.error(f"Error saving all data: {e}")
+    save_passenger_events(cur, user_id, session_id, vehicle_type, tracks, waypoints)
+    # Coverage counts are added per session, so /coverage never has to aggregate the raw points
+    recorded_times = [recorded_at(track) for track in tracks if track['time'] is not None]
+    last_seen = max(recorded_times) if recorded_times else datetime.now()
+    save_coverage(cur, vehicle_type, tracks, last_seen)
+    # Segment speeds are added per corridor and hour of day the same way
+    save_speed_profile(cur, tracks, last_seen, local_timezone)
+
+    # The cleaned points are already in time order, no need to read them back from bus_routes
+    route_points = [(track['lon'], track['lat']) for track in tracks]
+    simplified_points = simplify_route(route_points)
+    logging.info("Calling save_to_simplified_table...")
+    save_to_simplified_table(user_id, username, vehicle_type, session_id, source, destination, simplified_points, cur=cur)
+    logging.info("save_to_simplified_table called successfully")
+    # Delivered on commit, the query API drops its cached responses
+    notify_changes(cur)
+    return True
+
+def save_passenger_events(cur, user_id, session_id, vehicle_type, tracks, waypoints) -> None:
+    events = analyze_passenger_events(tracks, waypoints)
+    if not events:
+        return
 
+    event_values = [
+        (
+            user_id, session_id, vehicle_type, event['time'], event['lat'], event['lon'], event['snapped_lat'], event['snapped_lon'],
+            event['snap_distance_m'], event['distance_along_m'], event['dwell_seconds'], event['cell_x'], event['cell_y']
+        ) for event in events
+    ]
+    extras.execute_batch(cur, """
+        INSERT INTO passenger_events (user_id, session_id, vehicle_type, event_time, lat, lon, snapped_lat, snapped_lon,
+                                      snap_distance_m, distance_along_m, dwell_seconds, cell_x, cell_y)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, event_values)
 
-def main() -> None:
-    application = ApplicationBuilder().token(TOKEN).build()
+    save_hotspots(cur, events)
+    logging.info(f"Saved {len(events)} passenger events for session {session_id}")
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_choice))
-    application.add_handler(MessageHandler(filters.LOCATION, location_handler))
-    application.add_handler(MessageHandler(filters.Document.FileExtension("gpx"), gpx_handler))
+def rollback_quietly() -> None:
+    try:
+        if not conn.closed:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+
+def drain_session_spool() -> None:
+    global conn
+    while True:
+        records = session_spool.pending(spool_batch_size)
+        if not records:
+            return
+        # Sessions canceled while still journaled are skipped, their cancel record then finds nothing to update
+        canceled = {(record['user_id'], record['session_id']) for _, record in records if record.get('type') == 'cancel'}
+        try:
+            if conn.closed:
+                conn = connect_db()
+            with conn.cursor() as cur:
+                for _, record in records:
+                    apply_spool_record(cur, record, canceled)
+            conn.commit()
+            session_spool.mark_drained(records[-1][0])
+            logging.info(f"All data saved to the database for {len(records)} journaled sessions")
+            continue
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            rollback_quietly()
+            logging.warning(f"Database unavailable, {session_spool.size()} bytes of sessions stay journaled: {e}")
+            return
+        except Exception as e:
+            rollback_quietly()
+            logging.error(f"Error saving journaled batch, retrying sessions one by one: {e}")
+
+        # Find the record the database rejects so the rest of the batch still goes in
+        for end_offset, record in records:
+            try:
+                with conn.cursor() as cur:
+                    apply_spool_record(cur, record, canceled)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                rollback_quietly()
+                logging.warning(f"Database unavailable, sessions stay journaled: {e}")
+                return
+            except Exception as e:
+                rollback_quietly()
+                session_spool.dead_letter(record, e)
+            session_spool.mark_drained(end_offset)
+
+async def spool_drainer() -> None:
+    while True:
+        await asyncio.sleep(spool_drain_interval)
+        drain_session_spool()
+        refresh_stop_index()
+        refresh_place_index()
+
+async def start_spool_drainer(application) -> None:
+    refresh_stop_index()
+    refresh_place_index()
+    logging.info(f"Loaded {len(stop_index)} bus stops and {len(place_index)} places into the lookup indexes")
+    # Sessions journaled before a restart go in first
+    drain_session_spool()
+    application.create_task(spool_drainer())
+
+def build_application():
+    rate_limiter = FloodControlRateLimiter(
+        overall_rate=float(os.getenv('SEND_GLOBAL_RATE', 30)),
+        private_chat_rate=float(os.getenv('SEND_CHAT_RATE', 1))
+    )
+    builder = ApplicationBuilder().token(TOKEN).rate_limiter(rate_limiter).post_init(start_spool_drainer)
+    # Point the bot at another Bot API server, e.g. the fake one started by load_test.py
+    if os.getenv('BOT_API_URL'):
+        builder = builder.base_url(os.getenv('BOT_API_URL')).base_file_url(os.getenv('BOT_FILE_URL'))
+    application = builder.build()
+    with_user_state = bind_user_state(state_store, user_data)
+
+    application.add_handler(CommandHandler("start", with_user_state(start)))
+    application.add_handler(CommandHandler("help", with_user_state(help_command)))
+    application.add_handler(CommandHandler("coverage", with_user_state(coverage_command)))
+    application.add_handler(CallbackQueryHandler(with_user_state(button)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, with_user_state(handle_choice)))
+    application.add_handler(MessageHandler(filters.LOCATION, with_user_state(location_handler)))
+    track_upload_filter = filters.Document.FileExtension("zip")
+    for extension in TRACK_EXTENSIONS:
+        track_upload_filter = track_upload_filter | filters.Document.FileExtension(extension)
+    application.add_handler(MessageHandler(track_upload_filter, with_user_state(gpx_handler)))
 
     logging.getLogger('httpx').setLevel(logging.WARNING)
+    return application
 
+def main() -> None:
+    application = build_application()
     application.run_polling()
 
 if __name__ == '__main__':
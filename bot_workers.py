@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+
+from dotenv import load_dotenv
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter
+
+from session_spool import SessionSpool
+from shared_state import shard_for
+
+# Runs the bot as several worker processes. This process is the only getUpdates consumer and
+# routes every update to the worker owning the user's shard, so one user's updates are always
+# handled in order by one worker. Set STATE_STORE_URL to a Redis URL so conversation state and
+# session locks are shared, which lets the worker count change between runs or span several hosts.
+# Journals left by workers that no longer exist after the count went down, or by a single-process run,
+# are moved to worker 0's journal before the workers start, so their sessions are still written.
+# A worker that exits is started again on its queue, one that keeps exiting stops the whole bot.
+
+load_dotenv()
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+# getUpdates is retried after network errors, waiting twice as long each time up to this many seconds
+MAX_RETRY_DELAY = 30
+# A worker that exits this many times within the window is not started again
+MAX_WORKER_RESTARTS = 5
+RESTART_WINDOW_SECONDS = 300
+
+
+async def serve_worker(application, queue):
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        if application.post_init:
+            await application.post_init(application)
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+        await application.stop()
+
+
+# Returns the number of records moved to worker 0's journal
+def adopt_orphaned_spools(directory, workers):
+    if not os.path.isdir(directory):
+        return 0
+    target = None
+    adopted = 0
+    for file_name in sorted(os.listdir(directory)):
+        match = re.fullmatch(r'sessions(?:-(\d+))?\.journal', file_name)
+        if not match or (match.group(1) is not None and int(match.group(1)) < workers):
+            continue
+        spool = SessionSpool(directory, file_name[:-len('.journal')])
+        target = target or SessionSpool(directory, 'sessions-0')
+        # Records keep their idempotency keys, so a crash in between only journals them twice
+        while True:
+            records = spool.pending(500)
+            if not records:
+                break
+            for _, record in records:
+                target.append(record)
+            spool.mark_drained(records[-1][0])
+            adopted += len(records)
+            logging.info(f"Moved {len(records)} journaled sessions from {file_name} to worker 0")
+    return adopted
+
+
+def run_worker(bot_module, queue, worker_index):
+    # Each worker journals finished sessions to its own spool file
+    os.environ['SPOOL_NAME'] = f'sessions-{worker_index}'
+    module = importlib.import_module(bot_module)
+    logging.info(f"Worker {worker_index} started")
+    asyncio.run(serve_worker(module.build_application(), queue))
+
+
+async def route_updates(token, queues):
+    bot = Bot(token)
+    async with bot:
+        offset = None
+        delay = 1
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                logging.warning(f"getUpdates is flood limited, retrying in {e.retry_after} seconds")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except NetworkError as e:
+                # Also covers TimedOut, the workers keep running while the connection is down
+                logging.warning(f"getUpdates failed, retrying in {delay} seconds: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = 1
+            for update in updates:
+                offset = update.update_id + 1
+                user = update.effective_user
+                queues[shard_for(user.id if user else 0, len(queues))].put(update.to_json())
+
+
+# Starts the workers that exited again, their queue keeps the updates routed to them in the meantime.
+# restarts maps a worker index to the times it was restarted.
+def restart_exited_workers(workers, start_worker, restarts, now):
+    for index, worker in enumerate(workers):
+        if worker.is_alive():
+            continue
+        recent = [restarted for restarted in restarts.get(index, []) if now - restarted < RESTART_WINDOW_SECONDS]
+        if len(recent) >= MAX_WORKER_RESTARTS:
+            raise RuntimeError(
+                f"Worker {index} exited with code {worker.exitcode} {len(recent) + 1} times in {RESTART_WINDOW_SECONDS} seconds"
+            )
+        logging.error(f"Worker {index} exited with code {worker.exitcode}, starting it again")
+        restarts[index] = recent + [now]
+        workers[index] = start_worker(index)
+
+
+async def supervise_workers(workers, start_worker, interval=1):
+    restarts = {}
+    while True:
+        restart_exited_workers(workers, start_worker, restarts, time.monotonic())
+        await asyncio.sleep(interval)
+
+
+# Routes updates until a worker cannot be kept running, which then ends the bot with the error
+async def run_router(token, queues, workers, start_worker):
+    tasks = [asyncio.create_task(route_updates(token, queues)), asyncio.create_task(supervise_workers(workers, start_worker))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the collector bot as sharded worker processes")
+    parser.add_argument('--bot', default='TransitlabBotEN', help="bot module to run, e.g. TransitlabBotAR")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # Every worker has its own sender, so they share the global Telegram limit
+    global_rate = float(os.getenv('SEND_GLOBAL_RATE', 30))
+    os.environ['SEND_GLOBAL_RATE'] = str(global_rate / args.workers)
+
+    adopt_orphaned_spools(os.getenv('SPOOL_DIR', os.path.join(os.getcwd(), 'spool')), args.workers)
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(args.workers)]
+
+    def start_worker(index):
+        worker = context.Process(target=run_worker, args=(args.bot, queues[index], index), daemon=True)
+        worker.start()
+        return worker
+
+    workers = [start_worker(index) for index in range(args.workers)]
+
+    try:
+        asyncio.run(run_router(os.getenv('BOT_TOKEN'), queues, workers, start_worker))
+    except KeyboardInterrupt:
+        logging.info("Stopping workers")
+    except Exception:
+        logging.critical("Stopping workers after a fatal error")
+        raise
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import logging
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from track_parser import TRACK_EXTENSIONS, read_track_file, track_file_suffix
+
+# Guard against archives that expand to something far bigger than a set of phone recordings
+MAX_ARCHIVE_MEMBERS = 500
+MAX_ARCHIVE_BYTES = 500 * 1024 * 1024
+EXTRACT_CHUNK_BYTES = 1024 * 1024
+
+METADATA_KEYS = {
+    'vehicle': 'vehicle_type', 'vehicle type': 'vehicle_type', 'المركبة': 'vehicle_type', 'نوع المركبة': 'vehicle_type',
+    'source': 'source', 'from': 'source', 'الانطلاق': 'source', 'مكان الانطلاق': 'source',
+    'destination': 'destination', 'to': 'destination', 'الوجهة': 'destination',
+    'fare': 'fare', 'الأجرة': 'fare', 'الاجرة': 'fare',
+    'condition': 'vehicle_condition', 'الحالة': 'vehicle_condition', 'حالة المركبة': 'vehicle_condition',
+}
+
+VEHICLE_TYPES = {
+    'kia': 'Kia', 'كيا': 'Kia',
+    'coaster': 'Coaster', 'كوستر': 'Coaster',
+    'bus': 'Bus', 'باص': 'Bus',
+}
+
+VEHICLE_CONDITIONS = {
+    'very bad': 'very_bad', 'very_bad': 'very_bad', 'سيئة جداً': 'very_bad', 'سيئة جدا': 'very_bad',
+    'bad': 'bad', 'سيئة': 'bad',
+    'good': 'good', 'جيدة': 'good',
+    'very good': 'very_good', 'very_good': 'very_good', 'جيدة جداً': 'very_good', 'جيدة جدا': 'very_good',
+}
+
+REQUIRED_METADATA = ['vehicle_type', 'source', 'destination', 'fare']
+
+
+# Parses the shared metadata sheet typed by a coordinator, one "key: value" pair per line.
+# Returns the metadata and the list of required fields that are missing or invalid.
+def parse_metadata_sheet(text):
+    metadata = {}
+    for line in text.splitlines():
+        match = re.match(r'\s*([^:=]+?)\s*[:=]\s*(.+)', line)
+        if not match:
+            continue
+        field = METADATA_KEYS.get(match.group(1).lower())
+        if field:
+            metadata[field] = match.group(2).strip()
+
+    if 'vehicle_type' in metadata:
+        vehicle_type = VEHICLE_TYPES.get(metadata['vehicle_type'].lower())
+        if vehicle_type:
+            metadata['vehicle_type'] = vehicle_type
+        else:
+            metadata.pop('vehicle_type')
+    if 'fare' in metadata:
+        fare = re.sub(r'[^\d]', '', metadata['fare'])
+        if fare:
+            metadata['fare'] = fare
+        else:
+            metadata.pop('fare')
+    if 'vehicle_condition' in metadata:
+        metadata['vehicle_condition'] = VEHICLE_CONDITIONS.get(metadata['vehicle_condition'].lower(), 'unknown')
+    else:
+        metadata['vehicle_condition'] = 'unknown'
+
+    missing = [field for field in REQUIRED_METADATA if field not in metadata]
+    return metadata, missing
+
+
+class ArchiveTooLarge(Exception):
+    pass
+
+
+# Copies in chunks and counts the bytes actually decompressed, the sizes in the archive's directory
+# are written by the sender and cannot be trusted
+def _extract_member(archive, member, member_path, budget):
+    with archive.open(member) as source, open(member_path, 'wb') as target:
+        while True:
+            chunk = source.read(EXTRACT_CHUNK_BYTES)
+            if not chunk:
+                return budget
+            budget -= len(chunk)
+            if budget < 0:
+                raise ArchiveTooLarge()
+            target.write(chunk)
+
+
+# Replaces every ZIP archive in the upload list with the track files it contains.
+# Returns (display_name, path, error) tuples; error is None for files that can be parsed.
+def expand_uploads(uploads, target_dir):
+    files = []
+    for display_name, path in uploads:
+        if not zipfile.is_zipfile(path):
+            files.append((display_name, path, None))
+            continue
+        try:
+            with zipfile.ZipFile(path) as archive:
+                members = [
+                    member for member in archive.infolist()
+                    if not member.is_dir()
+                    and not os.path.basename(member.filename).startswith('.')
+                    and '__MACOSX' not in member.filename
+                    and member.filename.lower().endswith(tuple('.' + extension for extension in TRACK_EXTENSIONS))
+                ]
+                if len(members) > MAX_ARCHIVE_MEMBERS or sum(member.file_size for member in members) > MAX_ARCHIVE_BYTES:
+                    files.append((display_name, path, 'archive is too large'))
+                    continue
+                if not members:
+                    files.append((display_name, path, 'no track files in archive'))
+                    continue
+                extracted = []
+                budget = MAX_ARCHIVE_BYTES
+                try:
+                    for index, member in enumerate(members, start=1):
+                        # Extract under a generated name so member paths cannot escape the target directory
+                        member_path = os.path.join(target_dir, f'{os.path.basename(path)}_{index}{track_file_suffix(member.filename)}')
+                        extracted.append(member_path)
+                        budget = _extract_member(archive, member, member_path, budget)
+                except ArchiveTooLarge:
+                    for member_path in extracted:
+                        os.remove(member_path)
+                    files.append((display_name, path, 'archive is too large'))
+                    continue
+                files.extend(
+                    (f'{display_name}/{member.filename}', member_path, None) for member, member_path in zip(members, extracted)
+                )
+        except zipfile.BadZipFile as e:
+            files.append((display_name, path, f'bad archive: {e}'))
+    return files
+
+
+def _parse_file(path):
+    try:
+        return read_track_file(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+# Parses all files on a process pool. Returns (display_name, path, gpx_data, error) in input order.
+def parse_files_parallel(files, max_workers=None):
+    results = []
+    parsable = [(name, path) for name, path, error in files if error is None]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed = dict(zip(
+            [path for _, path in parsable],
+            executor.map(_parse_file, [path for _, path in parsable])
+        ))
+    for name, path, error in files:
+        if error is not None:
+            results.append((name, path, None, error))
+        else:
+            gpx_data, parse_error = parsed[path]
+            if gpx_data is not None and not gpx_data['tracks']:
+                gpx_data, parse_error = None, 'no track points'
+            results.append((name, path, gpx_data, parse_error))
+    logging.info(f"Parsed {len(parsable)} bulk upload files")
+    return results
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import logging
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from trip_storage import POINT_TYPE_CODES
+
+# Moves the GPS points of old sessions out of route_points into date-partitioned Parquet files, so the
+# live table stays small and analysts read history from files instead of the production database.
+# Coordinates are stored as integer microdegrees (about 0.1 m) and times as epoch milliseconds, both
+# delta-encoded by Parquet and compressed with zstd. Every session is one row group, and
+# manifest.parquet maps sessions and dates to their file and row group. Files are written under a
+# temporary name, fsync'd and renamed, and the directory is fsync'd too, so the points are on disk before
+# their rows are deleted from the database.
+
+COORDINATE_SCALE = 1_000_000
+EPOCH = datetime(1970, 1, 1)
+POINT_TYPE_NAMES = {code: name for name, code in POINT_TYPE_CODES.items()}
+MANIFEST_NAME = 'manifest.parquet'
+DELTA_COLUMNS = ['point_type', 'point_id', 'recorded_at_ms', 'lat_e6', 'lon_e6']
+
+
+def _point_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('session_ref', pa.int64()),
+        ('point_type', pa.int8()),
+        ('point_id', pa.int32()),
+        ('recorded_at_ms', pa.int64()),
+        ('lat_e6', pa.int32()),
+        ('lon_e6', pa.int32()),
+    ])
+
+
+def _to_ms(value):
+    return None if value is None else (value - EPOCH) // timedelta(milliseconds=1)
+
+
+def _from_ms(value):
+    return None if value is None else EPOCH + timedelta(milliseconds=value)
+
+
+def _fsync_file(path):
+    with open(path, 'rb') as written:
+        os.fsync(written.fileno())
+
+
+def _fsync_directory(path):
+    # Makes renames and new entries in the directory durable, Windows cannot open a directory for this
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace_durably(temporary_path, path):
+    _fsync_file(temporary_path)
+    os.replace(temporary_path, path)
+    _fsync_directory(os.path.dirname(path))
+
+
+class ColdArchive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+
+    def manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return pd.DataFrame(columns=[
+                'session_ref', 'user_id', 'session_id', 'vehicle_type', 'source', 'destination', 'date', 'cancel',
+                'file', 'row_group', 'point_count', 'first_recorded_at', 'last_recorded_at'
+            ])
+        return pd.read_parquet(self.manifest_path)
+
+    # Writes one file per date for the given sessions, points_by_session maps session_ref to its rows of
+    # (point_type, point_id, recorded_at, lat, lon) in point order
+    def write_sessions(self, sessions, points_by_session):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        entries = []
+        by_date = {}
+        for session in sessions:
+            by_date.setdefault(session['date'], []).append(session)
+
+        for date, date_sessions in sorted(by_date.items()):
+            relative_path = os.path.join(f'date={date.isoformat()}', f'part-{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.parquet')
+            path = os.path.join(self.directory, relative_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+                _fsync_directory(self.directory)
+            temporary_path = path + '.tmp'
+
+            with pq.ParquetWriter(
+                temporary_path, _point_schema(), compression='zstd', compression_level=9,
+                use_dictionary=False, column_encoding={column: 'DELTA_BINARY_PACKED' for column in DELTA_COLUMNS}
+            ) as writer:
+                for row_group, session in enumerate(date_sessions):
+                    points = points_by_session.get(session['session_ref'], [])
+                    times = [_to_ms(point[2]) for point in points]
+                    coordinates = np.array([(point[3], point[4]) for point in points], dtype=float).reshape(-1, 2)
+                    writer.write_table(pa.table({
+                        'session_ref': pa.array([session['session_ref']] * len(points), pa.int64()),
+                        'point_type': pa.array([point[0] for point in points], pa.int8()),
+                        'point_id': pa.array([point[1] for point in points], pa.int32()),
+                        'recorded_at_ms': pa.array(times, pa.int64()),
+                        'lat_e6': pa.array(np.round(coordinates[:, 0] * COORDINATE_SCALE).astype(np.int32), pa.int32()),
+                        'lon_e6': pa.array(np.round(coordinates[:, 1] * COORDINATE_SCALE).astype(np.int32), pa.int32()),
+                    }, schema=_point_schema()))
+                    known_times = [time for time in times if time is not None]
+                    entries.append(dict(
+                        session,
+                        file=relative_path,
+                        row_group=row_group,
+                        point_count=len(points),
+                        first_recorded_at=_from_ms(min(known_times)) if known_times else None,
+                        last_recorded_at=_from_ms(max(known_times)) if known_times else None,
+                    ))
+            _replace_durably(temporary_path, path)
+
+        self._update_manifest(entries)
+        return entries
+
+    def _update_manifest(self, entries):
+        if not entries:
+            return
+        manifest = pd.DataFrame(entries)
+        if os.path.exists(self.manifest_path):
+            manifest = pd.concat([self.manifest(), manifest], ignore_index=True)
+        # A session archived again after an interrupted run points at its newest copy
+        manifest = manifest.drop_duplicates('session_ref', keep='last').sort_values(['date', 'session_ref'])
+        temporary_path = self.manifest_path + '.tmp'
+        manifest.to_parquet(temporary_path, index=False, compression='zstd')
+        _replace_durably(temporary_path, self.manifest_path)
+
+    def find_sessions(self, session_ids=None, date_from=None, date_to=None):
+        manifest = self.manifest()
+        if session_ids:
+            manifest = manifest[manifest['session_id'].isin(session_ids)]
+        if date_from is not None:
+            manifest = manifest[manifest['date'] >= date_from]
+        if date_to is not None:
+            manifest = manifest[manifest['date'] <= date_to]
+        return manifest
+
+    # Streams the archived points one row group at a time, so reading a month never loads it all at once
+    def iter_points(self, session_ids=None, date_from=None, date_to=None):
+        import pyarrow.parquet as pq
+
+        sessions = self.find_sessions(session_ids, date_from, date_to)
+        for relative_path, file_sessions in sessions.groupby('file', sort=False):
+            parquet_file = pq.ParquetFile(os.path.join(self.directory, relative_path))
+            for session in file_sessions.itertuples(index=False):
+                columns = parquet_file.read_row_group(session.row_group).to_pydict()
+                for point_type, point_id, recorded_at_ms, lat_e6, lon_e6 in zip(
+                    columns['point_type'], columns['point_id'], columns['recorded_at_ms'], columns['lat_e6'], columns['lon_e6']
+                ):
+                    yield {
+                        'user_id': session.user_id,
+                        'session_id': session.session_id,
+                        'vehicle_type': session.vehicle_type,
+                        'point_type': POINT_TYPE_NAMES[point_type],
+                        'point_id': point_id,
+                        'recorded_at': _from_ms(recorded_at_ms),
+                        'lat': lat_e6 / COORDINATE_SCALE,
+                        'lon': lon_e6 / COORDINATE_SCALE,
+                    }
+
+
+# Archives sessions older than the given age in batches. The files and manifest are on disk before the
+# rows are deleted, so an interrupted run or a crash at worst archives a session twice and never loses it.
+def archive_old_sessions(conn, archive, older_than_days, batch_size=200, dry_run=False):
+    if dry_run:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(DISTINCT s.id), COUNT(*)
+                FROM sessions s
+                JOIN route_points p ON p.session_ref = s.id
+                WHERE s.archived_at IS NULL AND s.date < CURRENT_DATE - %s
+                """, (older_than_days,)
+            )
+            sessions, points = cur.fetchone()
+        conn.rollback()
+        logging.info(f"Would archive {sessions} sessions with {points} points")
+        return sessions
+
+    archived = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT s.id, s.user_id, s.session_id, s.vehicle_type, s.source, s.destination, s.date, s.cancel
+                FROM sessions s
+                WHERE s.archived_at IS NULL AND s.date < CURRENT_DATE - %s
+                  AND EXISTS (SELECT 1 FROM route_points p WHERE p.session_ref = s.id)
+                ORDER BY s.date, s.id
+                LIMIT %s
+                """, (older_than_days, batch_size)
+            )
+            sessions = [
+                dict(zip(('session_ref', 'user_id', 'session_id', 'vehicle_type', 'source', 'destination', 'date', 'cancel'), row))
+                for row in cur.fetchall()
+            ]
+        if not sessions:
+            break
+        session_refs = [session['session_ref'] for session in sessions]
+
+        points_by_session = {}
+        # Server-side cursor, the points of a batch are streamed instead of loaded in one response
+        with conn.cursor(name='cold_archive_points') as cur:
+            cur.itersize = 10000
+            cur.execute(
+                """
+                SELECT session_ref, point_type, point_id, recorded_at, ST_Y(geom_point), ST_X(geom_point)
+                FROM route_points
+                WHERE session_ref = ANY(%s)
+                ORDER BY session_ref, point_type, point_id
+                """, (session_refs,)
+            )
+            for session_ref, *point in cur:
+                points_by_session.setdefault(session_ref, []).append(point)
+
+        point_count = sum(len(points) for points in points_by_session.values())
+        archive.write_sessions(sessions, points_by_session)
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM route_points WHERE session_ref = ANY(%s)", (session_refs,))
+            cur.execute("UPDATE sessions SET archived_at = NOW() WHERE id = ANY(%s)", (session_refs,))
+        conn.commit()
+        archived += len(sessions)
+        logging.info(f"Archived {len(sessions)} sessions with {point_count} points")
+    return archived
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Archive old GPS points to Parquet files and read them back")
+    parser.add_argument('--dir', default=os.getenv('ARCHIVE_DIR', os.path.join(os.getcwd(), 'archive')), help="archive directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    archive_command = commands.add_parser('archive', help="move sessions older than the given age out of route_points")
+    archive_command.add_argument('--older-than-days', type=int, default=int(os.getenv('ARCHIVE_AFTER_DAYS', 180)))
+    archive_command.add_argument('--batch-size', type=int, default=200, help="sessions per file and transaction")
+    archive_command.add_argument('--dry-run', action='store_true', help="only report what would be archived")
+    read_command = commands.add_parser('read', help="write archived points as CSV to stdout")
+    read_command.add_argument('--session-id', action='append', help="session to read, can be repeated")
+    read_command.add_argument('--from', dest='date_from', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date())
+    read_command.add_argument('--to', dest='date_to', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date())
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, stream=sys.stderr)
+    archive = ColdArchive(args.dir)
+
+    if args.command == 'read':
+        writer = None
+        for point in archive.iter_points(args.session_id, args.date_from, args.date_to):
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(point))
+                writer.writeheader()
+            writer.writerow(point)
+        return
+
+    import psycopg2
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME')
+    )
+    try:
+        count = archive_old_sessions(conn, archive, args.older_than_days, args.batch_size, args.dry_run)
+        if not args.dry_run:
+            logging.info(f"{count} sessions archived to {args.dir}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
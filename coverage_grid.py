@@ -0,0 +1,192 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+# Hierarchical square grid of recorded coverage. Every level's cells are four times the size of the
+# level below (about 220 m, 890 m and 3.5 km in Baghdad), and each ingested session adds its counts
+# to the cells it passed through, so no query ever has to aggregate the raw points. A canceled session
+# takes its counts off again.
+
+COVERAGE_LEVELS = {0: 0.002, 1: 0.008, 2: 0.032}
+# min_lon, min_lat, max_lon, max_lat of the area volunteers are asked to cover, Baghdad by default
+SERVICE_AREA = (44.20, 33.15, 44.60, 33.50)
+VEHICLE_COLUMNS = {'Kia': 'kia_sessions', 'Coaster': 'coaster_sessions', 'Bus': 'bus_sessions'}
+
+UPSERT_QUERY = """
+    INSERT INTO coverage_cells (level, cell_x, cell_y, point_count, session_count, kia_sessions, coaster_sessions, bus_sessions, last_seen)
+    VALUES (%s, %s, %s, %s, 1, %s, %s, %s, %s)
+    ON CONFLICT (level, cell_x, cell_y) DO UPDATE SET
+        point_count = coverage_cells.point_count + EXCLUDED.point_count,
+        session_count = coverage_cells.session_count + 1,
+        kia_sessions = coverage_cells.kia_sessions + EXCLUDED.kia_sessions,
+        coaster_sessions = coverage_cells.coaster_sessions + EXCLUDED.coaster_sessions,
+        bus_sessions = coverage_cells.bus_sessions + EXCLUDED.bus_sessions,
+        last_seen = GREATEST(coverage_cells.last_seen, EXCLUDED.last_seen)
+"""
+
+SUBTRACT_QUERY = """
+    UPDATE coverage_cells SET
+        point_count = point_count - %s,
+        session_count = session_count - 1,
+        kia_sessions = kia_sessions - %s,
+        coaster_sessions = coaster_sessions - %s,
+        bus_sessions = bus_sessions - %s
+    WHERE level = %s AND cell_x = %s AND cell_y = %s
+"""
+
+DELETE_EMPTY_QUERY = """
+    DELETE FROM coverage_cells
+    WHERE level = %s AND cell_x = %s AND cell_y = %s AND session_count <= 0
+"""
+
+
+def _cells(values, size):
+    # Rounded first so coordinates sitting exactly on a cell edge do not fall into the previous cell
+    return np.floor(np.round(values / size, 9)).astype(np.int64)
+
+
+# Returns (level, cell_x, cell_y, point_count) for every cell the track passes through
+def session_cells(tracks):
+    if not tracks:
+        return []
+    coordinates = np.array([(point['lon'], point['lat']) for point in tracks], dtype=float)
+    rows = []
+    for level, size in COVERAGE_LEVELS.items():
+        cells, counts = np.unique(_cells(coordinates, size), axis=0, return_counts=True)
+        rows.extend((level, int(cell_x), int(cell_y), int(count)) for (cell_x, cell_y), count in zip(cells, counts))
+    return rows
+
+
+def cell_center(level, cell_x, cell_y):
+    size = COVERAGE_LEVELS[level]
+    return (cell_y + 0.5) * size, (cell_x + 0.5) * size
+
+
+def parse_bbox(text):
+    try:
+        min_lon, min_lat, max_lon, max_lat = map(float, text.split(','))
+    except ValueError:
+        raise ValueError(f"bounding box must be min_lon,min_lat,max_lon,max_lat, not {text!r}")
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise ValueError(f"bounding box {text!r} is empty")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def _vehicle_counts(vehicle_type):
+    return [int(VEHICLE_COLUMNS.get(vehicle_type) == column) for column in ('kia_sessions', 'coaster_sessions', 'bus_sessions')]
+
+
+def save_coverage(cur, vehicle_type, tracks, last_seen):
+    from psycopg2 import extras
+
+    vehicle_counts = _vehicle_counts(vehicle_type)
+    extras.execute_batch(cur, UPSERT_QUERY, [
+        (level, cell_x, cell_y, point_count, *vehicle_counts, last_seen)
+        for level, cell_x, cell_y, point_count in session_cells(tracks)
+    ])
+
+
+# Takes a canceled session's counts off the cells save_coverage added them to, computed from the same
+# stored track, and drops the cells no other session passed through. last_seen keeps its value until
+# the next rebuild_coverage.
+def remove_coverage(cur, vehicle_type, tracks):
+    from psycopg2 import extras
+
+    vehicle_counts = _vehicle_counts(vehicle_type)
+    cells = session_cells(tracks)
+    extras.execute_batch(cur, SUBTRACT_QUERY, [
+        (point_count, *vehicle_counts, level, cell_x, cell_y) for level, cell_x, cell_y, point_count in cells
+    ])
+    extras.execute_batch(cur, DELETE_EMPTY_QUERY, [(level, cell_x, cell_y) for level, cell_x, cell_y, _ in cells])
+
+
+# Cells of the service area with the fewest sessions. Cells nobody recorded yet have no row and come
+# first, those next to recorded cells (where the road network is known to go on) before the rest, nearest
+# to the middle of the area first. Then the recorded cells with the fewest sessions, oldest first. Only the
+# area's rows are read, so the cost does not grow with the number of recorded points.
+def least_covered_cells(cur, level=1, limit=10, bbox=SERVICE_AREA):
+    size = COVERAGE_LEVELS[level]
+    min_x, min_y = (int(value) for value in _cells(np.array(bbox[:2]), size))
+    max_x, max_y = (int(value) for value in _cells(np.array(bbox[2:]), size))
+    cur.execute(
+        """
+        SELECT cell_x, cell_y, session_count, point_count, kia_sessions, coaster_sessions, bus_sessions, last_seen
+        FROM coverage_cells
+        WHERE level = %s AND cell_x BETWEEN %s AND %s AND cell_y BETWEEN %s AND %s
+        """, (level, min_x, max_x, min_y, max_y)
+    )
+    fields = ('cell_x', 'cell_y', 'session_count', 'point_count', 'kia_sessions', 'coaster_sessions', 'bus_sessions', 'last_seen')
+    recorded = {(row[0], row[1]): dict(zip(fields, row)) for row in cur.fetchall()}
+
+    center_x, center_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    empty = []
+    for cell_x in range(min_x, max_x + 1):
+        for cell_y in range(min_y, max_y + 1):
+            if (cell_x, cell_y) in recorded:
+                continue
+            neighbours = sum(
+                (cell_x + dx, cell_y + dy) in recorded for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy
+            )
+            empty.append((-neighbours, (cell_x - center_x) ** 2 + (cell_y - center_y) ** 2, cell_x, cell_y))
+    empty.sort()
+    cells = [
+        dict(zip(fields, (cell_x, cell_y, 0, 0, 0, 0, 0, None)))
+        for _, _, cell_x, cell_y in empty[:limit]
+    ]
+    if len(cells) < limit:
+        # last_seen is never NULL in stored rows
+        cells.extend(sorted(recorded.values(), key=lambda cell: (cell['session_count'], cell['last_seen']))[:limit - len(cells)])
+    return cells
+
+
+# Recomputes every cell from route_points, for the first run or after changing the levels.
+# Points already moved to the cold archive are not counted again.
+def rebuild_coverage(conn):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM coverage_cells")
+        for level, size in COVERAGE_LEVELS.items():
+            cur.execute(
+                """
+                INSERT INTO coverage_cells (level, cell_x, cell_y, point_count, session_count, kia_sessions, coaster_sessions, bus_sessions, last_seen)
+                SELECT %(level)s, FLOOR(ST_X(p.geom_point) / %(size)s)::int, FLOOR(ST_Y(p.geom_point) / %(size)s)::int,
+                       COUNT(*), COUNT(DISTINCT s.id),
+                       COUNT(DISTINCT s.id) FILTER (WHERE s.vehicle_type = 'Kia'),
+                       COUNT(DISTINCT s.id) FILTER (WHERE s.vehicle_type = 'Coaster'),
+                       COUNT(DISTINCT s.id) FILTER (WHERE s.vehicle_type = 'Bus'),
+                       MAX(COALESCE(p.recorded_at, s.date + s.time))
+                FROM route_points p
+                JOIN sessions s ON s.id = p.session_ref
+                WHERE p.point_type = 0 AND s.cancel = FALSE
+                GROUP BY 2, 3
+                """, {'level': level, 'size': size}
+            )
+            logging.info(f"Level {level}: {cur.rowcount} cells")
+    conn.commit()
+
+
+def main() -> None:
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Rebuild the coverage grid from the stored route points")
+    parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME')
+    )
+    try:
+        rebuild_coverage(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+# A city bus or kia never goes faster than this, anything above is a GPS jump
+MAX_SPEED_KMH = 120
+MAX_ACCELERATION_MS2 = 8.0
+# Points that stay within this radius for this long are the vehicle waiting at a terminal or in traffic
+STATIONARY_RADIUS_M = 15
+STATIONARY_SECONDS = 60
+# Tracks without times count a dwell as more than twice this many points instead
+STATIONARY_WINDOW = 5
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _drop_duplicates(lat, lon, seconds, has_time):
+    keep = np.ones(len(lat), dtype=bool)
+    if len(lat) < 2:
+        return keep
+    same_position = (np.diff(lat) == 0) & (np.diff(lon) == 0)
+    if has_time:
+        keep[1:] = ~((np.diff(seconds) == 0) | same_position)
+    else:
+        keep[1:] = ~same_position
+    return keep
+
+
+def _flag_jumps(lat, lon, seconds, max_speed, max_acceleration):
+    # A jump is a point that is reached and left again at an impossible speed or acceleration
+    count = len(lat)
+    flagged = np.zeros(count, dtype=bool)
+    if count < 3:
+        return flagged
+    dt = np.maximum(np.diff(seconds), 1e-3)
+    speed = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:]) / dt
+
+    speed_in = np.concatenate(([0.0], speed))
+    speed_out = np.concatenate((speed, [0.0]))
+    too_fast = (speed_in > max_speed) & ((speed_out > max_speed) | (np.arange(count) == count - 1))
+
+    # acceleration[k] is the speed change across point k + 1, a spike speeds up before the point and slows down after it
+    acceleration = np.diff(speed) / ((dt[:-1] + dt[1:]) / 2)
+    acceleration_before = np.concatenate(([0.0, 0.0], acceleration, [0.0]))[:count]
+    acceleration_after = np.concatenate((acceleration, [0.0, 0.0]))
+    # Only points reached and left fast count, so ordinary position noise in slow traffic is kept
+    spike = (
+        (acceleration_before > max_acceleration) & (acceleration_after < -max_acceleration)
+        & (speed_in > max_speed / 2) & (speed_out > max_speed / 2)
+    )
+
+    flagged[1:] = (too_fast | spike)[1:]
+    return flagged
+
+
+def _run_end(lat, lon, start, radius):
+    # Index of the first point after start that is outside the radius around it, looked for in growing blocks
+    count, block = len(lat), 32
+    while True:
+        stop = min(start + 1 + block, count)
+        outside = np.flatnonzero(haversine_m(lat[start], lon[start], lat[start + 1:stop], lon[start + 1:stop]) >= radius)
+        if len(outside):
+            return start + 1 + int(outside[0])
+        if stop == count:
+            return count
+        block *= 2
+
+
+def _flag_stationary(lat, lon, seconds, radius, min_seconds, window):
+    # A dwell is a run of points that all stay within the radius of its first point for at least
+    # min_seconds. Every dwell is collapsed to its first and last point so dwell time is kept, while
+    # slow but steady movement leaves the radius in time and is kept whole.
+    count = len(lat)
+    flagged = np.zeros(count, dtype=bool)
+    if count < 3:
+        return flagged
+    # reach[i] is the point a dwell starting at i has to stay in the radius up to
+    if seconds is not None:
+        reach = np.searchsorted(seconds, seconds + min_seconds)
+    else:
+        reach = np.arange(count) + 2 * window
+    # Only points still within the radius at their reach can start a dwell, which rules out moving
+    # points without looking at each of them
+    ahead = np.flatnonzero(reach < count)
+    near = haversine_m(lat[ahead], lon[ahead], lat[reach[ahead]], lon[reach[ahead]]) < radius
+    candidates = ahead[near & (reach[ahead] > ahead)]
+
+    position = 0
+    while position < len(candidates):
+        start = int(candidates[position])
+        end = _run_end(lat, lon, start, radius)
+        if end > reach[start]:
+            flagged[start + 1:end - 1] = True
+            # The next dwell starts after this one
+            position = int(np.searchsorted(candidates, end))
+        else:
+            position += 1
+    return flagged
+
+
+def _smooth(values, window):
+    if window < 2 or len(values) <= window:
+        return values
+    kernel = np.ones(window) / window
+    padded = np.pad(values, (window // 2, window - 1 - window // 2), mode='edge')
+    smoothed = np.convolve(padded, kernel, mode='valid')
+    smoothed[0], smoothed[-1] = values[0], values[-1]
+    return smoothed
+
+
+def clean_track(tracks, max_speed_kmh=MAX_SPEED_KMH, max_acceleration=MAX_ACCELERATION_MS2,
+                stationary_radius=STATIONARY_RADIUS_M, stationary_seconds=STATIONARY_SECONDS, stationary_window=STATIONARY_WINDOW,
+                smoothing_window=0):
+    report = {'raw_points': len(tracks), 'duplicates': 0, 'speed_outliers': 0, 'stationary_points': 0, 'kept_points': len(tracks)}
+    if not tracks:
+        return tracks, report
+
+    lat = np.array([point['lat'] for point in tracks], dtype=float)
+    lon = np.array([point['lon'] for point in tracks], dtype=float)
+    has_time = all(point['time'] is not None for point in tracks)
+    if has_time:
+        seconds = np.array([point['time'].timestamp() for point in tracks], dtype=float)
+        order = np.argsort(seconds, kind='stable')
+    else:
+        seconds = None
+        order = np.arange(len(tracks))
+    lat, lon = lat[order], lon[order]
+    if has_time:
+        seconds = seconds[order]
+
+    keep = _drop_duplicates(lat, lon, seconds, has_time)
+    report['duplicates'] = int((~keep).sum())
+    index = order[keep]
+    lat, lon = lat[keep], lon[keep]
+    if has_time:
+        seconds = seconds[keep]
+
+        # Removing one jump can expose the next one behind it, so run a few passes
+        for _ in range(3):
+            jumps = _flag_jumps(lat, lon, seconds, max_speed_kmh / 3.6, max_acceleration)
+            if not jumps.any():
+                break
+            report['speed_outliers'] += int(jumps.sum())
+            index, lat, lon, seconds = index[~jumps], lat[~jumps], lon[~jumps], seconds[~jumps]
+
+    stationary = _flag_stationary(lat, lon, seconds, stationary_radius, stationary_seconds, stationary_window)
+    report['stationary_points'] = int(stationary.sum())
+    index, lat, lon = index[~stationary], lat[~stationary], lon[~stationary]
+
+    lat, lon = _smooth(lat, smoothing_window), _smooth(lon, smoothing_window)
+
+    cleaned = [
+        dict(tracks[original], lat=float(point_lat), lon=float(point_lon))
+        for original, point_lat, point_lon in zip(index, lat, lon)
+    ]
+    report['kept_points'] = len(cleaned)
+    return cleaned, report
@@ -0,0 +1,553 @@
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import statistics
+import zipfile
+from datetime import date, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from gps_cleaning import haversine_m
+from place_index import PlaceIndex, phonetic_key
+from speed_profiles import LOCAL_TIMEZONE
+
+# Builds a GTFS feed of the collected network: bus_stops become stops, every (vehicle type, source place,
+# destination place) becomes a route, and every recorded session of it a trip with its simplified line
+# as shape and the median reported fare. Each route's rows are cached as JSON with a fingerprint of its
+# sessions and fares, so a refresh only reads the geometries of routes that gained or lost sessions.
+# The feed is validated before it replaces the previous one.
+# Stops are not recorded as part of a session, so a trip's stop_times are the stops within
+# STOP_MATCH_RADIUS_M of its shape, in order along it. Times are approximate: the trip starts at its first
+# GPS fix and passes the stops at the average speed of the whole recording. They are computed when the feed
+# is assembled, so a new stop appears in every cached trip that passes it.
+
+ROUTE_TYPE_BUS = 3
+SERVICE_ID = 'daily'
+CURRENCY = 'IQD'
+CACHE_VERSION = 2
+STOP_MATCH_RADIUS_M = 30
+# For trips without GPS times, e.g. archived ones or those stored as bus_trips
+AVERAGE_SPEED_KMH = 20
+METERS_PER_DEGREE = 111320
+
+FEED_COLUMNS = {
+    'agency.txt': ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang'],
+    'calendar.txt': ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+    'stops.txt': ['stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon'],
+    'routes.txt': ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type'],
+    'trips.txt': ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'shape_id'],
+    'stop_times.txt': ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'shape_dist_traveled', 'timepoint'],
+    'shapes.txt': ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence', 'shape_dist_traveled'],
+    'fare_attributes.txt': ['fare_id', 'price', 'currency_type', 'payment_method', 'transfers', 'agency_id'],
+    'fare_rules.txt': ['fare_id', 'route_id'],
+}
+REQUIRED_FIELDS = {
+    'agency.txt': ['agency_name', 'agency_url', 'agency_timezone'],
+    'calendar.txt': ['service_id', 'start_date', 'end_date'],
+    'stops.txt': ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+    'routes.txt': ['route_id', 'route_type'],
+    'trips.txt': ['route_id', 'service_id', 'trip_id'],
+    'stop_times.txt': ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'],
+    'shapes.txt': ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+    'fare_attributes.txt': ['fare_id', 'price', 'currency_type', 'payment_method'],
+    'fare_rules.txt': ['fare_id'],
+}
+UNIQUE_FIELDS = {
+    'agency.txt': 'agency_id', 'calendar.txt': 'service_id', 'stops.txt': 'stop_id', 'routes.txt': 'route_id',
+    'trips.txt': 'trip_id', 'fare_attributes.txt': 'fare_id',
+}
+
+SESSIONS_QUERY = """
+    SELECT s.id, s.vehicle_type, s.source, s.destination, s.source_place_id, s.destination_place_id, f.fare
+    FROM sessions s
+    JOIN simplified_bus_routes r ON r.user_id = s.user_id AND r.session_id = s.session_id AND r.cancel = FALSE
+    LEFT JOIN fares f ON f.user_id = s.user_id AND f.session_id = s.session_id
+    WHERE s.cancel = FALSE AND r.geom_line IS NOT NULL
+    ORDER BY s.id
+"""
+
+# recorded_at is UTC, the session's date and time are local
+SHAPES_QUERY = """
+    SELECT s.id, ST_AsText(r.geom_line), s.date + s.time, t.first_at, t.last_at
+    FROM sessions s
+    JOIN simplified_bus_routes r ON r.user_id = s.user_id AND r.session_id = s.session_id AND r.cancel = FALSE
+    CROSS JOIN LATERAL (
+        SELECT MIN(p.recorded_at) AS first_at, MAX(p.recorded_at) AS last_at
+        FROM route_points p
+        WHERE p.session_ref = s.id AND p.point_type = 0
+    ) t
+    WHERE s.id = ANY(%s) AND r.geom_line IS NOT NULL
+"""
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', (text or '').lower()).strip('-') or 'unknown'
+
+
+def _endpoint(places, place_id, text):
+    # Sessions without a chosen place are matched by their spelling, and kept apart by its phonetic key otherwise
+    if place_id is None:
+        place_id = places.lookup(text or '')
+    if place_id is not None:
+        return f'p{place_id}', places.places.get(place_id, (text or 'unknown').strip())
+    key = phonetic_key(text or '') or 'unknown'
+    return 't' + hashlib.sha1(key.encode()).hexdigest()[:8], (text or 'unknown').strip()
+
+
+def group_sessions(rows, places):
+    routes = {}
+    for session_ref, vehicle_type, source, destination, source_place_id, destination_place_id, fare in rows:
+        source_key, source_name = _endpoint(places, source_place_id, source)
+        destination_key, destination_name = _endpoint(places, destination_place_id, destination)
+        route_id = f'{_slug(vehicle_type)}-{source_key}-{destination_key}'
+        route = routes.setdefault(route_id, {
+            'route_id': route_id, 'vehicle_type': vehicle_type, 'source': source_name, 'destination': destination_name,
+            'sessions': [], 'fares': [],
+        })
+        # A session joined to several fares rows is still one trip
+        if not route['sessions'] or route['sessions'][-1] != session_ref:
+            route['sessions'].append(session_ref)
+        if fare is not None and fare > 0:
+            route['fares'].append(fare)
+    for route in routes.values():
+        route['fingerprint'] = hashlib.sha1(json.dumps([
+            CACHE_VERSION, route['source'], route['destination'], route['sessions'], sorted(route['fares'])
+        ]).encode()).hexdigest()
+    return routes
+
+
+def _line_points(line_wkt):
+    return [(float(lon), float(lat)) for lon, lat in re.findall(r'(-?[\d.]+) (-?[\d.]+)', line_wkt or '')]
+
+
+def shape_rows(shape_id, points):
+    coordinates = np.array(points, dtype=float).reshape(-1, 2)
+    lon, lat = coordinates[:, 0], coordinates[:, 1]
+    distance_km = np.concatenate(([0.0], np.cumsum(haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])) / 1000))
+    return [
+        [shape_id, f'{point_lat:.6f}', f'{point_lon:.6f}', sequence, f'{distance:.3f}']
+        for sequence, (point_lat, point_lon, distance) in enumerate(zip(lat, lon, distance_km), start=1)
+    ]
+
+
+# Seconds after local midnight the trip starts, and its average speed in m/s
+def trip_timing(length_m, session_time, first_at, last_at, timezone_name=LOCAL_TIMEZONE):
+    speed = AVERAGE_SPEED_KMH / 3.6
+    if first_at is not None:
+        start = first_at.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(timezone_name))
+        duration = (last_at - first_at).total_seconds()
+        if duration > 0 and length_m > 0:
+            speed = length_m / duration
+    elif session_time is not None:
+        start = session_time
+    else:
+        return 0, speed
+    return start.hour * 3600 + start.minute * 60 + start.second, speed
+
+
+def build_route_artifact(route, lines, timings=None, timezone_name=LOCAL_TIMEZONE):
+    long_name = f"{route['source']} - {route['destination']}"
+    artifact = {
+        'fingerprint': route['fingerprint'],
+        'routes': [[route['route_id'], 'transitlab', '', long_name, route['vehicle_type'] or '', ROUTE_TYPE_BUS]],
+        'trips': [],
+        'shapes': [],
+        'timings': {},
+        'fare_attributes': [],
+        'fare_rules': [],
+    }
+    for session_ref in route['sessions']:
+        points = lines.get(session_ref)
+        if not points or len(points) < 2:
+            continue
+        shape_id = f's{session_ref}'
+        trip_id = f"{route['route_id']}-{session_ref}"
+        artifact['trips'].append([route['route_id'], SERVICE_ID, trip_id, route['destination'], shape_id])
+        shape = shape_rows(shape_id, points)
+        artifact['shapes'].extend(shape)
+        session_time, first_at, last_at = (timings or {}).get(session_ref, (None, None, None))
+        artifact['timings'][trip_id] = trip_timing(float(shape[-1][4]) * 1000, session_time, first_at, last_at, timezone_name)
+    if route['fares']:
+        artifact['fare_attributes'].append([route['route_id'], f"{statistics.median(route['fares']):.0f}", CURRENCY, 0, 0, 'transitlab'])
+        artifact['fare_rules'].append([route['route_id'], route['route_id']])
+    return artifact
+
+
+class FeedCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'routes'), exist_ok=True)
+
+    def _path(self, route_id):
+        return os.path.join(self.directory, 'routes', f'{route_id}.json')
+
+    def route_ids(self):
+        return [name[:-5] for name in os.listdir(os.path.join(self.directory, 'routes')) if name.endswith('.json')]
+
+    def get(self, route_id):
+        try:
+            with open(self._path(route_id), encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, route_id, artifact):
+        temporary_path = self._path(route_id) + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(artifact, file, ensure_ascii=False)
+        os.replace(temporary_path, self._path(route_id))
+
+    def remove(self, route_id):
+        try:
+            os.remove(self._path(route_id))
+        except FileNotFoundError:
+            pass
+
+
+# Refreshes the cached route artifacts, returns (rebuilt, removed) route counts
+def refresh_routes(conn, cache, full=False, timezone_name=LOCAL_TIMEZONE):
+    places = PlaceIndex()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, canonical_name FROM places")
+        places.load_places(cur.fetchall())
+        cur.execute("SELECT id, alias, place_id FROM place_aliases")
+        places.load_aliases(cur.fetchall())
+        cur.execute(SESSIONS_QUERY)
+        routes = group_sessions(cur.fetchall(), places)
+
+        stale = []
+        for route_id, route in routes.items():
+            cached = None if full else cache.get(route_id)
+            if cached is None or cached.get('fingerprint') != route['fingerprint']:
+                stale.append(route)
+
+        session_refs = [session_ref for route in stale for session_ref in route['sessions']]
+        lines, timings = {}, {}
+        if session_refs:
+            cur.execute(SHAPES_QUERY, (session_refs,))
+            for session_ref, line_wkt, session_time, first_at, last_at in cur.fetchall():
+                lines[session_ref] = _line_points(line_wkt)
+                timings[session_ref] = (session_time, first_at, last_at)
+    conn.rollback()
+
+    for route in stale:
+        cache.put(route['route_id'], build_route_artifact(route, lines, timings, timezone_name))
+    removed = [route_id for route_id in cache.route_ids() if route_id not in routes]
+    for route_id in removed:
+        cache.remove(route_id)
+    return len(stale), len(removed)
+
+
+def stop_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, destination, vehicle_type, lat, lon
+            FROM bus_stops
+            WHERE cancel = FALSE AND same_as_stop_id IS NULL AND lat IS NOT NULL AND lon IS NOT NULL
+            ORDER BY id
+            """
+        )
+        rows = [
+            [stop_id, f'Stop {stop_id}' if not destination else f'{destination} ({stop_id})', vehicle_type or '', f'{lat:.6f}', f'{lon:.6f}']
+            for stop_id, destination, vehicle_type, lat, lon in cur.fetchall()
+        ]
+    conn.rollback()
+    return rows
+
+
+def _clock(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+# The stops within radius_m of a trip's shape rows, ordered along it and timed from the trip's start.
+# stops is (ids, lat, lon) as arrays. Returns stop_times.txt rows.
+def stop_time_rows(trip_id, shape, start_seconds, speed, stops, radius_m=STOP_MATCH_RADIUS_M):
+    stop_ids, stop_lat, stop_lon = stops
+    lat = np.array([float(row[1]) for row in shape])
+    lon = np.array([float(row[2]) for row in shape])
+    distance_m = np.array([float(row[4]) for row in shape]) * 1000
+    pad = radius_m / METERS_PER_DEGREE
+    lon_pad = pad / max(np.cos(np.radians(lat.mean())), 1e-6)
+    candidates = np.flatnonzero(
+        (stop_lat >= lat.min() - pad) & (stop_lat <= lat.max() + pad) & (stop_lon >= lon.min() - lon_pad) & (stop_lon <= lon.max() + lon_pad)
+    )
+    if not len(candidates):
+        return []
+
+    # Flat metres around the shape, plenty accurate within a city
+    scale = np.cos(np.radians(lat.mean())) * METERS_PER_DEGREE
+    x, y = lon * scale, lat * METERS_PER_DEGREE
+    stop_x, stop_y = stop_lon[candidates, None] * scale, stop_lat[candidates, None] * METERS_PER_DEGREE
+    dx, dy = np.diff(x), np.diff(y)
+    length_sq = np.maximum(dx ** 2 + dy ** 2, 1e-9)
+    # Position of every candidate's foot point on every segment, clamped to the segment
+    t = np.clip(((stop_x - x[:-1]) * dx + (stop_y - y[:-1]) * dy) / length_sq, 0, 1)
+    offset = np.hypot(x[:-1] + t * dx - stop_x, y[:-1] + t * dy - stop_y)
+    segment = np.argmin(offset, axis=1)
+    rows = np.arange(len(candidates))
+    near = offset[rows, segment] <= radius_m
+    along = distance_m[segment] + t[rows, segment] * (distance_m[segment + 1] - distance_m[segment])
+
+    rows = []
+    for sequence, (along_m, stop_id) in enumerate(sorted(zip(along[near].tolist(), stop_ids[candidates[near]].tolist())), start=1):
+        # timepoint 0, the times are estimates
+        clock = _clock(start_seconds + along_m / speed)
+        rows.append([trip_id, clock, clock, stop_id, sequence, f'{along_m / 1000:.3f}', 0])
+    return rows
+
+
+# Trips passing fewer than two stops have no stop_times and are left out, with routes left without trips
+def assemble_feed(cache, stops, agency_name, agency_url, timezone_name=LOCAL_TIMEZONE, today=None, radius_m=STOP_MATCH_RADIUS_M):
+    today = today or date.today()
+    tables = {name: [] for name in FEED_COLUMNS}
+    tables['agency.txt'].append(['transitlab', agency_name, agency_url, timezone_name, 'ar'])
+    # Informal services run every day, the calendar only has to cover the feed's lifetime
+    tables['calendar.txt'].append([SERVICE_ID, 1, 1, 1, 1, 1, 1, 1, today.strftime('%Y%m%d'), (today + timedelta(days=365)).strftime('%Y%m%d')])
+    tables['stops.txt'] = stops
+    stop_arrays = (
+        np.array([row[0] for row in stops], dtype=object),
+        np.array([float(row[3]) for row in stops], dtype=float),
+        np.array([float(row[4]) for row in stops], dtype=float),
+    )
+
+    skipped = 0
+    for route_id in sorted(cache.route_ids()):
+        artifact = cache.get(route_id)
+        if artifact is None or not artifact['trips']:
+            continue
+        shapes = {}
+        for row in artifact['shapes']:
+            shapes.setdefault(row[0], []).append(row)
+        trips, stop_times = [], []
+        for trip in artifact['trips']:
+            start_seconds, speed = artifact['timings'][trip[2]]
+            rows = stop_time_rows(trip[2], shapes[trip[4]], start_seconds, speed, stop_arrays, radius_m)
+            if len(rows) < 2:
+                skipped += 1
+                continue
+            trips.append(trip)
+            stop_times.extend(rows)
+        if not trips:
+            continue
+        used_shapes = {trip[4] for trip in trips}
+        tables['routes.txt'].extend(artifact['routes'])
+        tables['trips.txt'].extend(trips)
+        tables['stop_times.txt'].extend(stop_times)
+        tables['shapes.txt'].extend(row for row in artifact['shapes'] if row[0] in used_shapes)
+        tables['fare_attributes.txt'].extend(artifact['fare_attributes'])
+        tables['fare_rules.txt'].extend(artifact['fare_rules'])
+    if skipped:
+        logging.info(f"{skipped} trips pass fewer than two stops and are left out")
+    return tables
+
+
+def _seconds(clock):
+    hours, minutes, seconds = map(int, clock.split(':'))
+    if not (0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError(clock)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _check_coordinate(errors, file_name, row_number, lat, lon):
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        errors.append(f"{file_name} row {row_number}: coordinates are not numbers")
+        return
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or (lat == 0 and lon == 0):
+        errors.append(f"{file_name} row {row_number}: invalid coordinates {lat}, {lon}")
+
+
+# Returns (errors, warnings). Tables map file names to lists of rows in FEED_COLUMNS order.
+def validate_feed(tables):
+    errors, warnings = [], []
+    records = {name: [dict(zip(FEED_COLUMNS[name], row)) for row in rows] for name, rows in tables.items()}
+
+    for name, required in REQUIRED_FIELDS.items():
+        if name in ('fare_attributes.txt', 'fare_rules.txt') and not records.get(name):
+            continue
+        if not records.get(name):
+            errors.append(f"{name} is empty")
+            continue
+        for row_number, record in enumerate(records[name], start=2):
+            missing = [field for field in required if record.get(field) in (None, '')]
+            if missing:
+                errors.append(f"{name} row {row_number}: missing {', '.join(missing)}")
+        unique_field = UNIQUE_FIELDS.get(name)
+        if unique_field:
+            values = [record[unique_field] for record in records[name]]
+            if len(values) != len(set(values)):
+                errors.append(f"{name}: duplicate {unique_field}")
+
+    for row_number, record in enumerate(records.get('stops.txt', []), start=2):
+        _check_coordinate(errors, 'stops.txt', row_number, record['stop_lat'], record['stop_lon'])
+
+    route_ids = {record['route_id'] for record in records.get('routes.txt', [])}
+    service_ids = {record['service_id'] for record in records.get('calendar.txt', [])}
+    fare_ids = {record['fare_id'] for record in records.get('fare_attributes.txt', [])}
+
+    shape_points = {}
+    for row_number, record in enumerate(records.get('shapes.txt', []), start=2):
+        _check_coordinate(errors, 'shapes.txt', row_number, record['shape_pt_lat'], record['shape_pt_lon'])
+        shape_points.setdefault(record['shape_id'], []).append((int(record['shape_pt_sequence']), float(record['shape_dist_traveled'])))
+    for shape_id, points in shape_points.items():
+        sequences = [sequence for sequence, _ in points]
+        distances = [distance for _, distance in points]
+        if len(points) < 2:
+            errors.append(f"shapes.txt: shape {shape_id} has fewer than two points")
+        if any(later <= earlier for earlier, later in zip(sequences, sequences[1:])):
+            errors.append(f"shapes.txt: shape {shape_id} sequence is not increasing")
+        if any(later < earlier for earlier, later in zip(distances, distances[1:])):
+            errors.append(f"shapes.txt: shape {shape_id} shape_dist_traveled decreases")
+
+    used_routes = set()
+    for row_number, record in enumerate(records.get('trips.txt', []), start=2):
+        used_routes.add(record['route_id'])
+        if record['route_id'] not in route_ids:
+            errors.append(f"trips.txt row {row_number}: unknown route_id {record['route_id']}")
+        if record['service_id'] not in service_ids:
+            errors.append(f"trips.txt row {row_number}: unknown service_id {record['service_id']}")
+        if record['shape_id'] and record['shape_id'] not in shape_points:
+            errors.append(f"trips.txt row {row_number}: unknown shape_id {record['shape_id']}")
+    for route_id in route_ids - used_routes:
+        warnings.append(f"routes.txt: route {route_id} has no trips")
+
+    trip_ids = {record['trip_id'] for record in records.get('trips.txt', [])}
+    stop_ids = {str(record['stop_id']) for record in records.get('stops.txt', [])}
+    trip_stops = {}
+    for row_number, record in enumerate(records.get('stop_times.txt', []), start=2):
+        if record['trip_id'] not in trip_ids:
+            errors.append(f"stop_times.txt row {row_number}: unknown trip_id {record['trip_id']}")
+        if str(record['stop_id']) not in stop_ids:
+            errors.append(f"stop_times.txt row {row_number}: unknown stop_id {record['stop_id']}")
+        try:
+            arrival, departure = _seconds(str(record['arrival_time'])), _seconds(str(record['departure_time']))
+        except ValueError:
+            errors.append(f"stop_times.txt row {row_number}: times must be HH:MM:SS")
+            continue
+        if departure < arrival:
+            errors.append(f"stop_times.txt row {row_number}: departure before arrival")
+        trip_stops.setdefault(record['trip_id'], []).append((int(record['stop_sequence']), arrival, departure))
+    for trip_id in trip_ids:
+        stop_times = trip_stops.get(trip_id, [])
+        if len(stop_times) < 2:
+            errors.append(f"stop_times.txt: trip {trip_id} has fewer than two stops")
+        if any(later[0] <= earlier[0] for earlier, later in zip(stop_times, stop_times[1:])):
+            errors.append(f"stop_times.txt: trip {trip_id} stop_sequence is not increasing")
+        if any(later[1] < earlier[2] for earlier, later in zip(stop_times, stop_times[1:])):
+            errors.append(f"stop_times.txt: trip {trip_id} times go backwards")
+
+    for row_number, record in enumerate(records.get('fare_attributes.txt', []), start=2):
+        try:
+            if float(record['price']) < 0:
+                errors.append(f"fare_attributes.txt row {row_number}: negative price")
+        except (TypeError, ValueError):
+            errors.append(f"fare_attributes.txt row {row_number}: price is not a number")
+    for row_number, record in enumerate(records.get('fare_rules.txt', []), start=2):
+        if record['fare_id'] not in fare_ids:
+            errors.append(f"fare_rules.txt row {row_number}: unknown fare_id {record['fare_id']}")
+        if record['route_id'] and record['route_id'] not in route_ids:
+            errors.append(f"fare_rules.txt row {row_number}: unknown route_id {record['route_id']}")
+    return errors, warnings
+
+
+def write_feed(tables, path):
+    temporary_path = path + '.tmp'
+    with zipfile.ZipFile(temporary_path, 'w', compression=zipfile.ZIP_DEFLATED) as feed:
+        for name, rows in tables.items():
+            if not rows and name in ('fare_attributes.txt', 'fare_rules.txt'):
+                continue
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(FEED_COLUMNS[name])
+            writer.writerows(rows)
+            feed.writestr(name, buffer.getvalue())
+    os.replace(temporary_path, path)
+
+
+def read_feed(path):
+    tables = {}
+    with zipfile.ZipFile(path) as feed:
+        for name in FEED_COLUMNS:
+            if name not in feed.namelist():
+                tables[name] = []
+                continue
+            reader = csv.DictReader(io.TextIOWrapper(feed.open(name), encoding='utf-8-sig'))
+            tables[name] = [[record.get(column, '') for column in FEED_COLUMNS[name]] for record in reader]
+    return tables
+
+
+# Refreshes the cache and writes the feed. An invalid feed is not written, the previous one stays in place.
+def build_feed(conn, cache, path, agency_name, agency_url, timezone_name=LOCAL_TIMEZONE, full=False):
+    rebuilt, removed = refresh_routes(conn, cache, full, timezone_name)
+    logging.info(f"Rebuilt {rebuilt} routes, removed {removed}")
+    tables = assemble_feed(cache, stop_rows(conn), agency_name, agency_url, timezone_name)
+    errors, warnings = validate_feed(tables)
+    for warning in warnings:
+        logging.warning(warning)
+    if errors:
+        for error in errors:
+            logging.error(error)
+        return False
+    write_feed(tables, path)
+    logging.info(
+        f"Wrote {path}: {len(tables['stops.txt'])} stops, {len(tables['routes.txt'])} routes, {len(tables['trips.txt'])} trips, "
+        f"{len(tables['stop_times.txt'])} stop times"
+    )
+    return True
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build and validate a GTFS feed of the collected stops, routes and fares")
+    parser.add_argument('--output', default=os.getenv('GTFS_PATH', os.path.join(os.getcwd(), 'gtfs.zip')))
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_command = commands.add_parser('build', help="rebuild the routes changed since the last build and write the feed")
+    build_command.add_argument('--cache-dir', default=os.getenv('GTFS_CACHE_DIR', os.path.join(os.getcwd(), 'gtfs_cache')))
+    build_command.add_argument('--full', action='store_true', help="ignore the cache and rebuild every route")
+    commands.add_parser('validate', help="validate an existing feed")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.command == 'validate':
+        errors, warnings = validate_feed(read_feed(args.output))
+        for warning in warnings:
+            logging.warning(warning)
+        for error in errors:
+            logging.error(error)
+        raise SystemExit(1 if errors else 0)
+
+    import psycopg2
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME')
+    )
+    try:
+        built = build_feed(
+            conn, FeedCache(args.cache_dir), args.output,
+            os.getenv('GTFS_AGENCY_NAME', 'Baghdad informal transit (Transit Lab)'),
+            os.getenv('GTFS_AGENCY_URL', 'https://transit-labb.com'),
+            os.getenv('LOCAL_TIMEZONE', LOCAL_TIMEZONE), args.full
+        )
+    finally:
+        conn.close()
+    raise SystemExit(0 if built else 1)
+
+
+if __name__ == '__main__':
+    main()
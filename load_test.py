@@ -0,0 +1,444 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Load-test harness: a local fake Telegram Bot API server plus virtual volunteers.
+# The bot is pointed at the fake server through BOT_API_URL / BOT_FILE_URL, then either scripted
+# route-recording conversations are run for many users at once, or a log of recorded updates
+# (one getUpdates JSON object per line) is replayed at a fixed rate. End-to-end latency is the
+# time from delivering an update to the bot's first visible answer in that chat.
+# A bot started with --bot writes every scripted session, so it only runs against the database named
+# in LOAD_TEST_DB_NAME, never the one in DB_NAME, and journals into a spool directory of its own.
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+VISIBLE_METHODS = {'sendMessage', 'editMessageText', 'sendVideo', 'sendDocument', 'editMessageReplyMarkup'}
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Collector', 'username': 'collector_test_bot'}
+
+CONVERSATION = [
+    ('start', 'command', '/start'),
+    ('record_bus_route', 'callback', 'record_bus_route'),
+    ('phone_installed', 'callback', 'phone_installed'),
+    ('upload_gpx', 'document', 'route.gpx'),
+    ('vehicle_type', 'callback', 'vehicle_kia'),
+    ('source', 'text', 'Alawi'),
+    ('destination', 'text', 'Bayaa'),
+    ('fare', 'callback', 'fare_750'),
+    ('vehicle_condition', 'callback', 'condition_good'),
+]
+
+
+def sample_gpx(points=600):
+    start = datetime(2024, 1, 1, 8, tzinfo=timezone.utc)
+    trkpts = ''.join(
+        f'<trkpt lat="{33.30 + index * 0.0001:.6f}" lon="{44.35 + index * 0.00005:.6f}">'
+        f'<time>{(start + timedelta(seconds=index * 2)).strftime("%Y-%m-%dT%H:%M:%SZ")}</time></trkpt>'
+        for index in range(points)
+    )
+    return (
+        '<?xml version="1.0"?><gpx version="1.1" creator="load_test" xmlns="http://www.topografix.com/GPX/1/1">'
+        f'<wpt lat="33.31" lon="44.355"><time>{start.strftime("%Y-%m-%dT%H:%M:%SZ")}</time></wpt>'
+        f'<trk><trkseg>{trkpts}</trkseg></trk></gpx>'
+    ).encode()
+
+
+class LatencyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def record(self, name, latency):
+        with self.lock:
+            self.counts[name] += 1
+            if latency is None:
+                self.errors[name] += 1
+            else:
+                self.samples[name].append(latency)
+
+    def report(self, elapsed):
+        lines = [f"{'step':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        total = errors = 0
+        for name in self.counts:
+            samples = sorted(self.samples[name])
+            total += self.counts[name]
+            errors += self.errors[name]
+
+            def percentile(fraction):
+                if not samples:
+                    return float('nan')
+                return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+            lines.append(
+                f"{name:<20}{self.counts[name]:>8}{self.errors[name]:>8}"
+                f"{percentile(0.5):>10.1f}{percentile(0.9):>10.1f}{percentile(0.99):>10.1f}{percentile(1.0):>10.1f}"
+            )
+        lines.append(
+            f"{total} updates in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f}/s), "
+            f"error rate {errors / total * 100 if total else 0:.2f}%"
+        )
+        return '\n'.join(lines)
+
+
+class FakeBotApi:
+    def __init__(self, gpx_data, api_rate=0):
+        self.gpx_data = gpx_data
+        self.api_rate = api_rate
+        self.files = {}
+        self.updates = deque()
+        self.updates_ready = threading.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url = None
+        # chat_id -> list of (time, method, payload) sent by the bot
+        self.outbox = defaultdict(list)
+        self.outbox_ready = threading.Condition()
+        self.call_times = deque()
+        self.flood_errors = 0
+
+    # Updates
+
+    def push_update(self, update):
+        update['update_id'] = next(self.update_ids)
+        if self.webhook_url:
+            threading.Thread(target=self._post_webhook, args=(update,), daemon=True).start()
+            return
+        with self.updates_ready:
+            self.updates.append(update)
+            self.updates_ready.notify_all()
+
+    def _post_webhook(self, update):
+        request = urllib.request.Request(
+            self.webhook_url, data=json.dumps(update).encode(), headers={'Content-Type': 'application/json'}
+        )
+        try:
+            urllib.request.urlopen(request, timeout=30).read()
+        except Exception as e:
+            logging.error(f"Webhook delivery failed: {e}")
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.updates_ready:
+            while offset is not None and self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    # Bot calls
+
+    def _message(self, chat_id, payload, message_id=None):
+        message = {
+            'message_id': message_id or next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in payload:
+            message['text'] = payload['text']
+        if 'caption' in payload:
+            message['caption'] = payload['caption']
+        if 'reply_markup' in payload:
+            message['reply_markup'] = json.loads(payload['reply_markup']) if isinstance(payload['reply_markup'], str) else payload['reply_markup']
+        return message
+
+    def _throttled(self):
+        if not self.api_rate:
+            return False
+        now = time.monotonic()
+        with self.outbox_ready:
+            while self.call_times and now - self.call_times[0] > 1:
+                self.call_times.popleft()
+            if len(self.call_times) >= self.api_rate:
+                self.flood_errors += 1
+                return True
+            self.call_times.append(now)
+        return False
+
+    def call(self, method, payload):
+        if method in ('getMe',):
+            return BOT_USER
+        if method in ('deleteWebhook', 'setMyCommands', 'close', 'logOut'):
+            return True
+        if method == 'setWebhook':
+            self.webhook_url = payload.get('url') or None
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+        if method == 'getUpdates':
+            offset = int(payload['offset']) if payload.get('offset') not in (None, '') else None
+            return self.get_updates(offset, float(payload.get('timeout') or 0))
+        if method == 'getFile':
+            file_id = payload['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.gpx_data), 'file_path': f'documents/{file_id}.gpx'}
+        if self._throttled():
+            raise FloodError(1)
+        if method == 'answerCallbackQuery':
+            return True
+
+        chat_id = int(payload.get('chat_id', 0))
+        if method.startswith('edit'):
+            result = self._message(chat_id, payload, message_id=int(payload.get('message_id') or 0))
+        else:
+            result = self._message(chat_id, payload)
+        with self.outbox_ready:
+            self.outbox[chat_id].append((time.monotonic(), method, result))
+            self.outbox_ready.notify_all()
+        return result
+
+    def wait_for_answer(self, chat_id, after_index, timeout):
+        deadline = time.monotonic() + timeout
+        with self.outbox_ready:
+            while True:
+                for sent_at, method, result in self.outbox[chat_id][after_index:]:
+                    if method in VISIBLE_METHODS:
+                        return sent_at, result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, None
+                self.outbox_ready.wait(remaining)
+
+    def outbox_size(self, chat_id):
+        with self.outbox_ready:
+            return len(self.outbox[chat_id])
+
+
+class FloodError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too Many Requests: retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _payload(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                return json.loads(body or b'{}')
+            if content_type.startswith('multipart/form-data'):
+                message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+                payload = {}
+                for part in message.get_payload():
+                    name = part.get_param('name', header='content-disposition')
+                    if part.get_filename() is None:
+                        payload[name] = part.get_payload(decode=True).decode()
+                return payload
+            return {key: values[-1] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+        def _send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith('/file/'):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(api.gpx_data)))
+                self.end_headers()
+                self.wfile.write(api.gpx_data)
+                return
+            self.do_POST()
+
+        def do_POST(self):
+            method = self.path.rstrip('/').rsplit('/', 1)[-1].split('?')[0]
+            try:
+                result = api.call(method, self._payload())
+                self._send_json(200, {'ok': True, 'result': result})
+            except FloodError as e:
+                self._send_json(429, {'ok': False, 'error_code': 429, 'description': str(e), 'parameters': {'retry_after': e.retry_after}})
+            except Exception as e:
+                logging.error(f"Fake API error in {method}: {e}")
+                self._send_json(400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'})
+
+    return Handler
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Volunteer {user_id}', 'username': f'volunteer_{user_id}'}
+
+
+def _chat(user_id):
+    return {'id': user_id, 'type': 'private', 'first_name': f'Volunteer {user_id}'}
+
+
+def build_update(user_id, kind, value, last_message):
+    now = int(time.time())
+    if kind == 'callback':
+        message = last_message or {'message_id': 1, 'date': now, 'chat': _chat(user_id), 'from': BOT_USER, 'text': ''}
+        return {'callback_query': {
+            'id': f'{user_id}-{time.monotonic_ns()}', 'from': _user(user_id), 'chat_instance': str(user_id),
+            'data': value, 'message': message,
+        }}
+    message = {'message_id': int(time.monotonic_ns() % 2 ** 31), 'date': now, 'chat': _chat(user_id), 'from': _user(user_id)}
+    if kind == 'command':
+        message['text'] = value
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(value)}]
+    elif kind == 'text':
+        message['text'] = value
+    elif kind == 'document':
+        message['document'] = {
+            'file_id': f'gpx-{user_id}', 'file_unique_id': f'gpx-{user_id}', 'file_name': value,
+            'mime_type': 'application/gpx+xml',
+        }
+    return {'message': message}
+
+
+def run_conversation(api, stats, user_id, timeout):
+    last_message = None
+    for name, kind, value in CONVERSATION:
+        before = api.outbox_size(user_id)
+        sent_at = time.monotonic()
+        api.push_update(build_update(user_id, kind, value, last_message))
+        answered_at, answer = api.wait_for_answer(user_id, before, timeout)
+        if answered_at is None:
+            stats.record(name, None)
+            return
+        stats.record(name, answered_at - sent_at)
+        last_message = answer
+
+        # Typed places the bot already knows are answered with suggestion buttons, pick the first one
+        suggestion = _place_suggestion(answer)
+        if suggestion:
+            before = api.outbox_size(user_id)
+            sent_at = time.monotonic()
+            api.push_update(build_update(user_id, 'callback', suggestion, last_message))
+            answered_at, answer = api.wait_for_answer(user_id, before, timeout)
+            if answered_at is None:
+                stats.record(f'{name}_place', None)
+                return
+            stats.record(f'{name}_place', answered_at - sent_at)
+            last_message = answer
+
+
+def _place_suggestion(message):
+    keyboard = (message.get('reply_markup') or {}).get('inline_keyboard') or []
+    for row in keyboard:
+        for button in row:
+            if str(button.get('callback_data', '')).startswith('place_'):
+                return button['callback_data']
+    return None
+
+
+def replay_updates(api, stats, path, rate, timeout, workers):
+    with open(path) as log, ThreadPoolExecutor(max_workers=workers) as executor:
+        interval = 1 / rate if rate else 0
+        next_send = time.monotonic()
+        for line in log:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            update.pop('update_id', None)
+            kind = next((key for key in update if key != 'update_id'), 'unknown')
+            body = update.get(kind) or {}
+            user = body.get('from') or {}
+            chat = (body.get('chat') or (body.get('message') or {}).get('chat') or user)
+            chat_id = chat.get('id', 0)
+
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+
+            before = api.outbox_size(chat_id)
+            sent_at = time.monotonic()
+            api.push_update(update)
+
+            def wait(chat_id=chat_id, before=before, sent_at=sent_at, kind=kind):
+                answered_at, _ = api.wait_for_answer(chat_id, before, timeout)
+                stats.record(kind, None if answered_at is None else answered_at - sent_at)
+
+            executor.submit(wait)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load-test the collector bot against a local fake Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--bot', help="bot module to start against the fake API, e.g. TransitlabBotEN; omit if it is already running")
+    parser.add_argument('--users', type=int, default=50, help="number of concurrent scripted volunteers")
+    parser.add_argument('--ramp', type=float, default=10, help="seconds over which the volunteers start")
+    parser.add_argument('--replay', help="replay a JSON-lines log of recorded updates instead of scripted conversations")
+    parser.add_argument('--rate', type=float, default=10, help="updates per second when replaying")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for the bot to answer an update")
+    parser.add_argument('--gpx', help="GPX file served for every upload, a synthetic route by default")
+    parser.add_argument('--api-rate', type=int, default=0, help="emulate Telegram flood control above this many calls per second")
+    args = parser.parse_args()
+
+    if args.bot:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        test_db_name = os.getenv('LOAD_TEST_DB_NAME')
+        if not test_db_name:
+            parser.error("--bot needs LOAD_TEST_DB_NAME, the name of a database the scripted sessions may be written to")
+        if test_db_name == os.getenv('DB_NAME'):
+            parser.error(f"LOAD_TEST_DB_NAME is the bot's own database {test_db_name!r}, use a separate one")
+
+    gpx_data = open(args.gpx, 'rb').read() if args.gpx else sample_gpx()
+    api = FakeBotApi(gpx_data, api_rate=args.api_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Fake Bot API listening on http://127.0.0.1:{args.port}")
+
+    bot_process = None
+    if args.bot:
+        # Set in the environment, so the bot's own load_dotenv does not replace them with the production values
+        env = dict(
+            os.environ,
+            BOT_TOKEN=os.getenv('BOT_TOKEN') or '123456:load-test',
+            BOT_API_URL=f'http://127.0.0.1:{args.port}/bot',
+            BOT_FILE_URL=f'http://127.0.0.1:{args.port}/file/bot',
+            DB_NAME=test_db_name,
+            SPOOL_DIR=tempfile.mkdtemp(prefix='load_test_spool_'),
+        )
+        bot_process = subprocess.Popen([sys.executable, f'{args.bot}.py'], env=env)
+        time.sleep(3)
+
+    stats = LatencyStats()
+    started = time.monotonic()
+    try:
+        if args.replay:
+            replay_updates(api, stats, args.replay, args.rate, args.timeout, workers=max(args.users, 1))
+        else:
+            with ThreadPoolExecutor(max_workers=args.users) as executor:
+                for index in range(args.users):
+                    executor.submit(run_conversation, api, stats, 100000 + index, args.timeout)
+                    time.sleep(args.ramp / args.users if args.users else 0)
+        print(stats.report(time.monotonic() - started))
+        if args.api_rate:
+            print(f"{api.flood_errors} calls rejected by emulated flood control")
+    finally:
+        # Stop the bot first so its last getUpdates call still reaches the fake server
+        if bot_process:
+            bot_process.terminate()
+            bot_process.wait(timeout=30)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+-- Adds what canceling a session across all tables needs to an existing database: cancel columns on fares and
+-- passenger_events, the same_as_stop_id column of bus_stops, (user_id, session_id) indexes for the cancel updates, and partial indexes on the rows
+-- that are not canceled. CREATE INDEX CONCURRENTLY cannot run in a transaction, so this script has none
+-- and can run while the bot is running:
+--     psql -d bot_db -f migrate_cancellation.sql
+
+-- Adding a column with a constant default does not rewrite the table
+ALTER TABLE fares ADD COLUMN IF NOT EXISTS cancel BOOLEAN DEFAULT FALSE;
+ALTER TABLE passenger_events ADD COLUMN IF NOT EXISTS cancel BOOLEAN DEFAULT FALSE;
+-- Set when the volunteer confirmed an already recorded stop, bus_stops_active_idx below leaves those out
+ALTER TABLE bus_stops ADD COLUMN IF NOT EXISTS same_as_stop_id INT REFERENCES bus_stops(id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bus_stops_session_idx ON bus_stops (user_id, session_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS fares_session_idx ON fares (user_id, session_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS simplified_bus_routes_session_idx ON simplified_bus_routes (user_id, session_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bus_trips_session_idx ON bus_trips (user_id, session_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS passenger_events_user_session_idx ON passenger_events (user_id, session_id);
+DROP INDEX CONCURRENTLY IF EXISTS passenger_events_session_idx;
+ALTER INDEX passenger_events_user_session_idx RENAME TO passenger_events_session_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_active_idx ON sessions (id) WHERE cancel = FALSE;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bus_stops_active_idx ON bus_stops (id) WHERE cancel = FALSE AND same_as_stop_id IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS simplified_bus_routes_active_geom_idx ON simplified_bus_routes USING GIST (geom_line) WHERE cancel = FALSE;
+
+-- Sessions canceled before the other tables were included
+BEGIN;
+UPDATE fares f SET cancel = TRUE FROM sessions s
+WHERE s.cancel = TRUE AND f.user_id = s.user_id AND f.session_id = s.session_id AND f.cancel = FALSE;
+UPDATE passenger_events e SET cancel = TRUE FROM sessions s
+WHERE s.cancel = TRUE AND e.user_id = s.user_id AND e.session_id = s.session_id AND e.cancel = FALSE;
+UPDATE simplified_bus_routes r SET cancel = TRUE FROM sessions s
+WHERE s.cancel = TRUE AND r.user_id = s.user_id AND r.session_id = s.session_id AND r.cancel = FALSE;
+UPDATE bus_stops b SET cancel = TRUE FROM sessions s
+WHERE s.cancel = TRUE AND b.user_id = s.user_id AND b.session_id = s.session_id AND b.cancel = FALSE;
+
+-- Hotspots still counting the events of canceled sessions are summed again from the events that are not
+DELETE FROM passenger_hotspots h
+WHERE NOT EXISTS (SELECT 1 FROM passenger_events e WHERE e.cell_x = h.cell_x AND e.cell_y = h.cell_y AND e.cancel = FALSE);
+UPDATE passenger_hotspots h SET
+    event_count = a.event_count,
+    session_count = a.session_count,
+    total_dwell_seconds = a.total_dwell_seconds,
+    sum_lat = a.sum_lat,
+    sum_lon = a.sum_lon
+FROM (
+    SELECT cell_x, cell_y, COUNT(*) AS event_count, COUNT(DISTINCT (user_id, session_id)) AS session_count,
+           SUM(COALESCE(dwell_seconds, 0)) AS total_dwell_seconds, SUM(snapped_lat) AS sum_lat, SUM(snapped_lon) AS sum_lon
+    FROM passenger_events
+    WHERE cancel = FALSE
+    GROUP BY cell_x, cell_y
+) a
+WHERE h.cell_x = a.cell_x AND h.cell_y = a.cell_y;
+COMMIT;
+
+-- If any routes or stops were canceled above, delete tiles.mbtiles and run vector_tiles.py build again.
+-- Canceled sessions are taken off coverage_cells and speed_profiles from now on, rebuild them once with
+-- python coverage_grid.py and python speed_profiles.py for the sessions canceled before.
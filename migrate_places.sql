@@ -0,0 +1,24 @@
+-- Adds the canonical places behind place suggestions to an existing database: the places and place_aliases
+-- tables and the place ids of fares and sessions. Every statement is skipped when its table or column
+-- exists already, so the script can run again:
+--     psql -d bot_db -f migrate_places.sql
+-- Then group the names recorded so far into places with python place_index.py
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS places (
+    id SERIAL PRIMARY KEY,
+    canonical_name VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS place_aliases (
+    id SERIAL PRIMARY KEY,
+    alias VARCHAR(255) UNIQUE NOT NULL,
+    place_id INT NOT NULL REFERENCES places(id)
+);
+
+-- Nullable columns without a default, no table is rewritten
+ALTER TABLE fares ADD COLUMN IF NOT EXISTS source_place_id INT, ADD COLUMN IF NOT EXISTS destination_place_id INT;
+-- Databases still on the wide bus_routes rows get sessions from migrate_sessions.sql, with these columns
+ALTER TABLE IF EXISTS sessions ADD COLUMN IF NOT EXISTS source_place_id INT, ADD COLUMN IF NOT EXISTS destination_place_id INT;
+
+COMMIT;
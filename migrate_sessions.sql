@@ -0,0 +1,115 @@
+-- Moves an existing database from one wide bus_routes row per point to sessions + route_points.
+-- Session metadata is stored once per session and every point only carries the integer session_ref.
+-- bus_routes becomes a view with the old columns, so existing queries keep working.
+-- Run with the bot stopped; new sessions journaled to the spool meanwhile are written after restart:
+--     psql -d bot_db -f migrate_sessions.sql
+BEGIN;
+
+-- Databases from before TRIP_STORAGE_MODE=trips and place suggestions lack tables and columns read below
+CREATE TABLE IF NOT EXISTS bus_trips (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    telegram_username VARCHAR(255),
+    session_id VARCHAR(255),
+    vehicle_type VARCHAR(50),
+    date DATE,
+    time TIME,
+    source VARCHAR(255),
+    destination VARCHAR(255),
+    cancel BOOLEAN DEFAULT FALSE,
+    geom_track GEOMETRY(LineStringM, 4326),
+    waypoints GEOMETRY(MultiPointM, 4326)
+);
+CREATE INDEX IF NOT EXISTS bus_trips_session_idx ON bus_trips (user_id, session_id);
+ALTER TABLE fares ADD COLUMN IF NOT EXISTS source_place_id INT, ADD COLUMN IF NOT EXISTS destination_place_id INT;
+
+CREATE TABLE sessions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    telegram_username VARCHAR(255),
+    session_id VARCHAR(255) NOT NULL,  -- the bot's timestamp label, only unique per user
+    vehicle_type VARCHAR(50),
+    source VARCHAR(255),
+    destination VARCHAR(255),
+    source_place_id INT,
+    destination_place_id INT,
+    date DATE,
+    time TIME,
+    cancel BOOLEAN DEFAULT FALSE,
+    archived_at TIMESTAMP,             -- set once the points were moved to the Parquet archive
+    UNIQUE (user_id, session_id)
+);
+
+CREATE TABLE route_points (
+    session_ref BIGINT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    point_type SMALLINT NOT NULL,  -- 0 bus_routing, 1 passenger_on_off
+    point_id INT NOT NULL,
+    recorded_at TIMESTAMP,         -- UTC time from the track file, as in the old date and time columns
+    geom_point GEOMETRY(Point, 4326),
+    PRIMARY KEY (session_ref, point_type, point_id)
+);
+
+INSERT INTO sessions (user_id, telegram_username, session_id, vehicle_type, source, destination, date, time, cancel)
+SELECT user_id, MIN(telegram_username), session_id, MIN(vehicle_type), MIN(source), MIN(destination),
+       MIN(date), MIN(time), BOOL_OR(COALESCE(cancel, FALSE))
+FROM bus_routes
+WHERE session_id IS NOT NULL
+GROUP BY user_id, session_id;
+
+-- Sessions stored with TRIP_STORAGE_MODE=trips have no bus_routes rows
+INSERT INTO sessions (user_id, telegram_username, session_id, vehicle_type, source, destination, date, time, cancel)
+SELECT user_id, telegram_username, session_id, vehicle_type, source, destination, date, time, COALESCE(cancel, FALSE)
+FROM bus_trips
+WHERE session_id IS NOT NULL
+ON CONFLICT (user_id, session_id) DO NOTHING;
+
+UPDATE sessions
+SET source_place_id = fares.source_place_id, destination_place_id = fares.destination_place_id
+FROM fares
+WHERE fares.user_id = sessions.user_id AND fares.session_id = sessions.session_id;
+
+-- Old rows saved twice under one session keep their first copy
+INSERT INTO route_points (session_ref, point_type, point_id, recorded_at, geom_point)
+SELECT s.id, CASE r.point_type WHEN 'passenger_on_off' THEN 1 ELSE 0 END, r.point_id, r.date + r.time,
+       COALESCE(r.geom_point, ST_SetSRID(ST_MakePoint(r.lon, r.lat), 4326))
+FROM bus_routes r
+JOIN sessions s ON s.user_id = r.user_id AND s.session_id = r.session_id
+WHERE r.point_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+CREATE INDEX route_points_geom_idx ON route_points USING GIST (geom_point);
+
+-- bus_route_points reads bus_routes, it is recreated on top of the view
+DROP VIEW IF EXISTS bus_route_points;
+ALTER TABLE bus_routes RENAME TO bus_routes_legacy;
+
+CREATE VIEW bus_routes AS
+SELECT s.user_id, s.telegram_username, s.session_id, s.vehicle_type, p.point_id,
+       p.recorded_at::date AS date, p.recorded_at::time AS time, s.source, s.destination,
+       ST_Y(p.geom_point) AS lat, ST_X(p.geom_point) AS lon,
+       CASE p.point_type WHEN 1 THEN 'passenger_on_off' ELSE 'bus_routing' END AS point_type,
+       s.cancel, p.geom_point, p.session_ref
+FROM route_points p
+JOIN sessions s ON s.id = p.session_ref;
+
+CREATE VIEW bus_route_points AS
+SELECT user_id, telegram_username, session_id, vehicle_type, point_id, date, time, source, destination,
+       lat, lon, point_type, cancel, geom_point
+FROM bus_routes
+UNION ALL
+SELECT t.user_id, t.telegram_username, t.session_id, t.vehicle_type, p.path[1],
+       (to_timestamp(NULLIF(ST_M(p.geom), -1)) AT TIME ZONE 'UTC')::date,
+       (to_timestamp(NULLIF(ST_M(p.geom), -1)) AT TIME ZONE 'UTC')::time,
+       t.source, t.destination, ST_Y(p.geom), ST_X(p.geom), 'bus_routing', t.cancel, ST_Force2D(p.geom)
+FROM bus_trips t CROSS JOIN LATERAL ST_DumpPoints(t.geom_track) AS p
+UNION ALL
+SELECT t.user_id, t.telegram_username, t.session_id, t.vehicle_type, p.path[1],
+       (to_timestamp(NULLIF(ST_M(p.geom), -1)) AT TIME ZONE 'UTC')::date,
+       (to_timestamp(NULLIF(ST_M(p.geom), -1)) AT TIME ZONE 'UTC')::time,
+       t.source, t.destination, ST_Y(p.geom), ST_X(p.geom), 'passenger_on_off', t.cancel, ST_Force2D(p.geom)
+FROM bus_trips t CROSS JOIN LATERAL ST_DumpPoints(t.waypoints) AS p;
+
+COMMIT;
+
+-- Once the row counts of bus_routes and bus_routes_legacy have been compared:
+--     DROP TABLE bus_routes_legacy;
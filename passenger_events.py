@@ -0,0 +1,197 @@
+import numpy as np
+from shapely import STRtree, points
+
+from gps_cleaning import haversine_m
+
+METERS_PER_DEGREE = 111320
+# Waypoints are snapped to the nearest track point recorded within this many seconds of the waypoint
+SNAP_TIME_WINDOW = 30
+# The vehicle counts as standing at the stop while it stays within this distance of the snapped point
+DWELL_RADIUS_M = 30
+# Hotspot grid cell size, about 110 m north-south and 90 m east-west in Baghdad
+HOTSPOT_CELL_DEGREES = 0.001
+
+# Hotspots are updated incrementally per session instead of being rebuilt from all events
+HOTSPOT_UPSERT_QUERY = """
+    INSERT INTO passenger_hotspots (cell_x, cell_y, event_count, session_count, total_dwell_seconds, sum_lat, sum_lon, last_seen)
+    VALUES (%s, %s, %s, 1, %s, %s, %s, NOW())
+    ON CONFLICT (cell_x, cell_y) DO UPDATE SET
+        event_count = passenger_hotspots.event_count + EXCLUDED.event_count,
+        session_count = passenger_hotspots.session_count + 1,
+        total_dwell_seconds = passenger_hotspots.total_dwell_seconds + EXCLUDED.total_dwell_seconds,
+        sum_lat = passenger_hotspots.sum_lat + EXCLUDED.sum_lat,
+        sum_lon = passenger_hotspots.sum_lon + EXCLUDED.sum_lon,
+        last_seen = NOW()
+"""
+
+HOTSPOT_SUBTRACT_QUERY = """
+    UPDATE passenger_hotspots SET
+        event_count = event_count - %s,
+        session_count = session_count - 1,
+        total_dwell_seconds = total_dwell_seconds - %s,
+        sum_lat = sum_lat - %s,
+        sum_lon = sum_lon - %s
+    WHERE cell_x = %s AND cell_y = %s
+"""
+
+HOTSPOT_DELETE_EMPTY_QUERY = """
+    DELETE FROM passenger_hotspots
+    WHERE cell_x = %s AND cell_y = %s AND session_count <= 0
+"""
+
+
+def grid_cell(degrees):
+    # Rounded first so coordinates sitting exactly on a cell edge do not fall into the previous cell
+    return int(np.floor(round(degrees / HOTSPOT_CELL_DEGREES, 9)))
+
+
+def _seconds(points):
+    if not points or any(point['time'] is None for point in points):
+        return None
+    return np.array([point['time'].timestamp() for point in points], dtype=float)
+
+
+def _local_points(lat, lon, origin_lat):
+    # Metres on a plane through the track, close enough to find the nearest fix within a city
+    scale = np.cos(np.radians(origin_lat))
+    return points(lon * METERS_PER_DEGREE * scale, lat * METERS_PER_DEGREE)
+
+
+def _nearest_in_time(lat, lon, track_seconds, waypoint_lat, waypoint_lon, waypoint_seconds, time_window):
+    # The fixes within the time window form a contiguous range of the time-ordered track, one padded row
+    # per waypoint. Returns -1 for waypoints without any fix in their window.
+    first = np.searchsorted(track_seconds, waypoint_seconds - time_window, side='left')
+    last = np.searchsorted(track_seconds, waypoint_seconds + time_window, side='right')
+    width = int((last - first).max())
+    best = np.full(len(waypoint_lat), -1)
+    if width == 0:
+        return best
+    candidates = first[:, None] + np.arange(width)[None, :]
+    inside = candidates < last[:, None]
+    candidates = np.minimum(candidates, len(lat) - 1)
+    distances = haversine_m(waypoint_lat[:, None], waypoint_lon[:, None], lat[candidates], lon[candidates])
+    distances[~inside] = np.inf
+    nearest = candidates[np.arange(len(waypoint_lat)), np.argmin(distances, axis=1)]
+    return np.where(last > first, nearest, -1)
+
+
+def _dwell_edge(lat, lon, index, radius, step):
+    # Last fix from index in the direction of step that is still within the radius of it, looked for in
+    # growing blocks so a short stop only reads the fixes around it
+    count, block, edge = len(lat), 32, index
+    while True:
+        if step > 0:
+            positions = np.arange(edge + 1, min(edge + 1 + block, count))
+        else:
+            positions = np.arange(edge - 1, max(edge - 1 - block, -1), -1)
+        if not len(positions):
+            return edge
+        far = np.flatnonzero(haversine_m(lat[index], lon[index], lat[positions], lon[positions]) > radius)
+        if len(far):
+            return int(positions[far[0]]) - step
+        edge = int(positions[-1])
+        block *= 2
+
+
+# Snaps every passenger_on_off waypoint onto the track by time and position and measures how far
+# along the route it happened and how long the vehicle stood there.
+def analyze_passenger_events(tracks, waypoints, time_window=SNAP_TIME_WINDOW, dwell_radius=DWELL_RADIUS_M):
+    if not tracks or not waypoints:
+        return []
+
+    lat = np.array([point['lat'] for point in tracks], dtype=float)
+    lon = np.array([point['lon'] for point in tracks], dtype=float)
+    track_seconds = _seconds(tracks)
+    cumulative = np.concatenate(([0.0], np.cumsum(haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:]))))
+
+    waypoint_lat = np.array([point['lat'] for point in waypoints], dtype=float)
+    waypoint_lon = np.array([point['lon'] for point in waypoints], dtype=float)
+    waypoint_seconds = _seconds(waypoints)
+
+    if track_seconds is not None and waypoint_seconds is not None:
+        best = _nearest_in_time(lat, lon, track_seconds, waypoint_lat, waypoint_lon, waypoint_seconds, time_window)
+    else:
+        best = np.full(len(waypoints), -1)
+    # Waypoints without times, or without a fix near their time, take the nearest fix of the whole track
+    untimed = np.flatnonzero(best < 0)
+    if len(untimed):
+        tree = STRtree(_local_points(lat, lon, lat[0]))
+        query, nearest = tree.query_nearest(_local_points(waypoint_lat[untimed], waypoint_lon[untimed], lat[0]))
+        # Ties return every nearest fix, the first one in track order wins
+        order = np.lexsort((nearest, query))
+        query, nearest = query[order], nearest[order]
+        first = np.concatenate(([True], query[1:] != query[:-1]))
+        best[untimed[query[first]]] = nearest[first]
+    snap_distance = haversine_m(waypoint_lat, waypoint_lon, lat[best], lon[best])
+
+    events = []
+    for waypoint, index, snapped in zip(waypoints, best, snap_distance):
+        dwell_seconds = None
+        if track_seconds is not None:
+            start = _dwell_edge(lat, lon, index, dwell_radius, -1)
+            end = _dwell_edge(lat, lon, index, dwell_radius, 1)
+            dwell_seconds = float(track_seconds[end] - track_seconds[start])
+        events.append({
+            'time': waypoint['time'],
+            'lat': waypoint['lat'],
+            'lon': waypoint['lon'],
+            'snapped_lat': float(lat[index]),
+            'snapped_lon': float(lon[index]),
+            'snap_distance_m': float(snapped),
+            'distance_along_m': float(cumulative[index]),
+            'dwell_seconds': dwell_seconds,
+            'cell_x': grid_cell(lon[index]),
+            'cell_y': grid_cell(lat[index]),
+        })
+    return events
+
+
+# Sums one session's events per grid cell, ready to be added onto the hotspot table
+def aggregate_hotspots(events):
+    if not events:
+        return []
+    cells = np.array([(event['cell_x'], event['cell_y']) for event in events], dtype=np.int64)
+    dwell = np.array([event['dwell_seconds'] or 0.0 for event in events], dtype=float)
+    lat = np.array([event['snapped_lat'] for event in events], dtype=float)
+    lon = np.array([event['snapped_lon'] for event in events], dtype=float)
+
+    unique_cells, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    return [
+        {
+            'cell_x': int(cell_x),
+            'cell_y': int(cell_y),
+            'event_count': int(count),
+            'total_dwell_seconds': float(total_dwell),
+            'sum_lat': float(sum_lat),
+            'sum_lon': float(sum_lon),
+        }
+        for (cell_x, cell_y), count, total_dwell, sum_lat, sum_lon in zip(
+            unique_cells, counts,
+            np.bincount(inverse, weights=dwell, minlength=len(unique_cells)),
+            np.bincount(inverse, weights=lat, minlength=len(unique_cells)),
+            np.bincount(inverse, weights=lon, minlength=len(unique_cells)),
+        )
+    ]
+
+
+def save_hotspots(cur, events):
+    from psycopg2 import extras
+
+    extras.execute_batch(cur, HOTSPOT_UPSERT_QUERY, [
+        (cell['cell_x'], cell['cell_y'], cell['event_count'], cell['total_dwell_seconds'], cell['sum_lat'], cell['sum_lon'])
+        for cell in aggregate_hotspots(events)
+    ])
+
+
+# Takes a canceled session's events off their hotspot cells, from the stored passenger_events rows, and
+# drops the cells no other session has events in. last_seen keeps its value.
+def remove_hotspots(cur, events):
+    from psycopg2 import extras
+
+    cells = aggregate_hotspots(events)
+    extras.execute_batch(cur, HOTSPOT_SUBTRACT_QUERY, [
+        (cell['event_count'], cell['total_dwell_seconds'], cell['sum_lat'], cell['sum_lon'], cell['cell_x'], cell['cell_y'])
+        for cell in cells
+    ])
+    extras.execute_batch(cur, HOTSPOT_DELETE_EMPTY_QUERY, [(cell['cell_x'], cell['cell_y']) for cell in cells])
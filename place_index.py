@@ -0,0 +1,194 @@
+import argparse
+import difflib
+import logging
+import os
+import re
+import unicodedata
+from collections import Counter
+
+# In-memory index of canonical place names and every spelling volunteers used for them, so free text
+# like "Alawi", "allawi" or "علاوي" can be matched to one place. Names are reduced to a phonetic key
+# shared by Arabic and Latin spellings, a trie over the keys answers prefixes and a bigram index
+# finds misspellings.
+
+ARABIC_LETTERS = str.maketrans({
+    'ا': 'a', 'ب': 'b', 'ت': 't', 'ث': 'th', 'ج': 'j', 'ح': 'h', 'خ': 'kh', 'د': 'd', 'ذ': 'z', 'ر': 'r',
+    'ز': 'z', 'س': 's', 'ش': 'sh', 'ص': 's', 'ض': 'd', 'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'gh', 'ف': 'f',
+    'ق': 'k', 'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'u', 'ي': 'i', 'ى': 'a', 'ة': 'a',
+    'ء': '', 'گ': 'g', 'چ': 'ch', 'پ': 'p', 'ڤ': 'v',
+})
+# Spellings that sound the same in transliterated Iraqi place names
+LATIN_SOUNDS = [('ph', 'f'), ('q', 'k'), ('c', 'k'), ('w', 'u'), ('y', 'i'), ('e', 'a'), ('o', 'u'), ('dh', 'z')]
+ARTICLE = re.compile(r'\b(?:al|el)[\s\-]+|\bال')
+
+MIN_SCORE = 0.65
+MAX_FUZZY_CANDIDATES = 50
+
+
+def phonetic_key(name):
+    text = unicodedata.normalize('NFKD', name.strip().lower())
+    # Drops Latin accents and Arabic diacritics, and turns hamza forms of alef into plain alef
+    text = ''.join(char for char in text if unicodedata.category(char) != 'Mn').replace('ـ', '')
+    text = ARTICLE.sub('', text).translate(ARABIC_LETTERS)
+    text = re.sub(r'[^a-z0-9]', '', text)
+    for spelling, sound in LATIN_SOUNDS:
+        text = text.replace(spelling, sound)
+    text = re.sub(r'(.)\1+', r'\1', text)
+    return re.sub(r'(?<=[aiu])h$', '', text)
+
+
+def _bigrams(key):
+    padded = f'^{key}$'
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+class PlaceIndex:
+    def __init__(self):
+        self.places = {}
+        self.key_places = {}
+        self.trie = {}
+        self.bigrams = {}
+        self.last_place_id = 0
+        self.last_alias_id = 0
+
+    def add_place(self, place_id, canonical_name):
+        self.places[place_id] = canonical_name
+        self.add_alias(place_id, canonical_name)
+
+    def add_alias(self, place_id, alias):
+        key = phonetic_key(alias)
+        if not key or place_id in self.key_places.get(key, ()):
+            return
+        self.key_places.setdefault(key, set()).add(place_id)
+        node = self.trie
+        for char in key:
+            node = node.setdefault(char, {})
+            # Every node keeps the places below it, so a prefix lookup is one walk down the trie
+            node.setdefault(None, set()).add(place_id)
+        for bigram in _bigrams(key):
+            self.bigrams.setdefault(bigram, set()).add(key)
+
+    def load_places(self, rows):
+        for place_id, canonical_name in rows:
+            self.add_place(place_id, canonical_name)
+            self.last_place_id = max(self.last_place_id, place_id)
+
+    def load_aliases(self, rows):
+        for alias_id, alias, place_id in rows:
+            if place_id in self.places:
+                self.add_alias(place_id, alias)
+            self.last_alias_id = max(self.last_alias_id, alias_id)
+
+    def __len__(self):
+        return len(self.places)
+
+    # Place with exactly this spelling once reduced to its key, or None
+    def lookup(self, text):
+        place_ids = self.key_places.get(phonetic_key(text))
+        return min(place_ids) if place_ids else None
+
+    # Returns up to limit (place_id, canonical_name, score) tuples, best first
+    def suggest(self, text, limit=3, min_score=MIN_SCORE):
+        key = phonetic_key(text)
+        if not key:
+            return []
+        scores = {}
+
+        node = self.trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            for place_id in node.get(None, ()):
+                scores[place_id] = 1.0 if place_id in self.key_places.get(key, ()) else 0.9
+
+        shared = Counter(candidate for bigram in _bigrams(key) for candidate in self.bigrams.get(bigram, ()))
+        for candidate, _ in shared.most_common(MAX_FUZZY_CANDIDATES):
+            score = difflib.SequenceMatcher(None, key, candidate).ratio()
+            if score < min_score:
+                continue
+            for place_id in self.key_places[candidate]:
+                scores[place_id] = max(scores.get(place_id, 0.0), min(score, 0.95))
+
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(place_id, self.places[place_id], score) for place_id, score in best]
+
+
+# Groups the free-text sources and destinations already in the fares table into places, most
+# used spelling first so it becomes the canonical name, and fills in the place ids of old rows.
+def seed_places(conn, min_score=0.85, dry_run=False):
+    index = PlaceIndex()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, canonical_name FROM places")
+        index.load_places(cur.fetchall())
+        cur.execute("SELECT id, alias, place_id FROM place_aliases")
+        index.load_aliases(cur.fetchall())
+        cur.execute(
+            """
+            SELECT name, COUNT(*)
+            FROM (SELECT source AS name FROM fares UNION ALL SELECT destination FROM fares) names
+            WHERE name IS NOT NULL AND name <> 'unknown'
+            GROUP BY name
+            ORDER BY COUNT(*) DESC, name
+            """
+        )
+        names = cur.fetchall()
+
+        for name, count in names:
+            suggestions = index.suggest(name, limit=1, min_score=min_score)
+            if suggestions:
+                place_id = suggestions[0][0]
+                logging.info(f"{name!r} ({count} rows) -> {index.places[place_id]!r}")
+            else:
+                logging.info(f"{name!r} ({count} rows) -> new place")
+                cur.execute("INSERT INTO places (canonical_name) VALUES (%s) RETURNING id", (name,))
+                place_id = cur.fetchone()[0]
+                index.add_place(place_id, name)
+            cur.execute(
+                "INSERT INTO place_aliases (alias, place_id) VALUES (%s, %s) ON CONFLICT (alias) DO NOTHING", (name, place_id)
+            )
+            index.add_alias(place_id, name)
+
+        for column in ('source', 'destination'):
+            cur.execute(
+                f"""
+                UPDATE fares SET {column}_place_id = place_aliases.place_id
+                FROM place_aliases
+                WHERE fares.{column}_place_id IS NULL AND place_aliases.alias = fares.{column}
+                """
+            )
+
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    logging.info(f"{len(names)} spellings grouped into {len(index)} places")
+
+
+def main() -> None:
+    import psycopg2
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Group the existing source and destination names into canonical places")
+    parser.add_argument('--min-score', type=float, default=0.85, help="similarity needed to treat a spelling as an existing place")
+    parser.add_argument('--dry-run', action='store_true', help="print the grouping without writing it")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME')
+    )
+    try:
+        seed_places(conn, min_score=args.min_score, dry_run=args.dry_run)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Read-only HTTP API for analysts and dashboards, so they stop querying the tables the bot writes to.
+# Queries go through a pool of read-only connections, which can point at a read replica. Responses are
+# kept in an LRU cache with a TTL. The bot sends NOTIFY on CHANGES_CHANNEL in every transaction that
+# writes sessions, stops or cancellations, and the API drops the cache when it arrives. ETags carry the
+# cache generation, so a dashboard reloading unchanged data gets 304 without a database query.
+# Large results are streamed from a server-side cursor. With the pool on a replica, a response computed
+# just after a notification can still come from before the commit, so the cache TTL is kept short there.
+
+CHANGES_CHANNEL = 'transitlab_changes'
+MAX_ROUTES = 50000
+MAX_STOPS = 500
+# Seconds, the cache TTL when the pool reads from a replica that may lag behind the notifications
+REPLICA_CACHE_TTL = 10
+SESSION_URL = re.compile(r'^/sessions/(\d+)/([^/]+)$')
+
+ROUTES_QUERY = """
+    SELECT session_id, vehicle_type, source, destination, date::text, ST_AsGeoJSON(geom_line, 6)
+    FROM simplified_bus_routes
+    WHERE cancel = FALSE AND geom_line && ST_MakeEnvelope(%(min_lon)s, %(min_lat)s, %(max_lon)s, %(max_lat)s, 4326)
+      AND (%(vehicle_type)s IS NULL OR vehicle_type = %(vehicle_type)s)
+    ORDER BY id
+    LIMIT %(limit)s
+"""
+
+STOPS_QUERY = """
+    SELECT id, destination, vehicle_type, lat, lon, distance_m
+    FROM (
+        SELECT id, destination, vehicle_type, lat, lon,
+               ST_DistanceSphere(ST_MakePoint(lon, lat), ST_MakePoint(%(lon)s, %(lat)s)) AS distance_m
+        FROM bus_stops
+        WHERE cancel = FALSE AND same_as_stop_id IS NULL
+          AND lat BETWEEN %(min_lat)s AND %(max_lat)s AND lon BETWEEN %(min_lon)s AND %(max_lon)s
+    ) candidates
+    WHERE distance_m <= %(radius)s
+    ORDER BY distance_m
+    LIMIT %(limit)s
+"""
+
+# Fares without a chosen place are grouped by their typed name
+FARES_QUERY = """
+    SELECT f.vehicle_type, MIN(f.source_place_id), MIN(COALESCE(source_place.canonical_name, f.source)),
+           MIN(f.destination_place_id), MIN(COALESCE(destination_place.canonical_name, f.destination)),
+           COUNT(*), MIN(f.fare), PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY f.fare), MAX(f.fare), AVG(f.fare)
+    FROM fares f
+    LEFT JOIN places source_place ON source_place.id = f.source_place_id
+    LEFT JOIN places destination_place ON destination_place.id = f.destination_place_id
+    WHERE f.cancel = FALSE AND f.fare > 0
+      AND (%(vehicle_type)s IS NULL OR f.vehicle_type = %(vehicle_type)s)
+      AND (%(source_place_id)s IS NULL OR f.source_place_id = %(source_place_id)s)
+      AND (%(destination_place_id)s IS NULL OR f.destination_place_id = %(destination_place_id)s)
+    GROUP BY f.vehicle_type, f.source_place_id, CASE WHEN f.source_place_id IS NULL THEN LOWER(TRIM(f.source)) END,
+             f.destination_place_id, CASE WHEN f.destination_place_id IS NULL THEN LOWER(TRIM(f.destination)) END
+    HAVING COUNT(*) >= %(min_count)s
+    ORDER BY COUNT(*) DESC
+    LIMIT %(limit)s
+"""
+
+SESSION_QUERY = """
+    SELECT s.id, s.user_id, s.session_id, s.vehicle_type, s.source, s.destination, s.source_place_id, s.destination_place_id,
+           s.date::text, s.time::text, s.cancel, s.archived_at::text,
+           (SELECT COUNT(*) FROM route_points p WHERE p.session_ref = s.id AND p.point_type = 0),
+           (SELECT COUNT(*) FROM route_points p WHERE p.session_ref = s.id AND p.point_type = 1),
+           f.fare, f.vehicle_condition,
+           (SELECT ST_AsGeoJSON(r.geom_line, 6) FROM simplified_bus_routes r
+            WHERE r.user_id = s.user_id AND r.session_id = s.session_id ORDER BY r.id DESC LIMIT 1)
+    FROM sessions s
+    LEFT JOIN fares f ON f.user_id = s.user_id AND f.session_id = s.session_id
+    WHERE s.user_id = %s AND s.session_id = %s
+    LIMIT 1
+"""
+
+SESSION_FIELDS = (
+    'session_ref', 'user_id', 'session_id', 'vehicle_type', 'source', 'destination', 'source_place_id', 'destination_place_id',
+    'date', 'time', 'cancel', 'archived_at', 'route_points', 'passenger_points', 'fare', 'vehicle_condition', 'simplified_route'
+)
+
+
+# Called by the bot in the transactions that change what the API serves, delivered on commit
+def notify_changes(cur):
+    cur.execute(f"NOTIFY {CHANGES_CHANNEL}")
+
+
+class ResponseCache:
+    def __init__(self, max_entries=512, ttl=300, max_entry_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.generation = 0
+        # Keeps ETags of an earlier process from matching after a restart
+        self.instance = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+
+    # The TTL window is part of the tag, so clients revalidate at least as often as the cache expires
+    def etag(self, key, generation):
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return f'"{self.instance}-{generation}-{int(time.time() // self.ttl)}-{digest}"'
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, generation, body = entry
+            if generation != self.generation or time.monotonic() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, generation, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            # Computed before an invalidation arrived, it may already be stale
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), generation, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+def _number(params, name, default=None, kind=float, minimum=None, maximum=None):
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise ValueError(f"{name} is required")
+        return default
+    try:
+        value = kind(values[0])
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"{name} must be at most {maximum}")
+    return value
+
+
+def _text(params, name):
+    values = params.get(name)
+    return values[0] if values and values[0] else None
+
+
+def _optional_int(params, name):
+    return _number(params, name, kind=int) if _text(params, name) is not None else None
+
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _single(body):
+    yield body
+
+
+class QueryApi:
+    def __init__(self, pool, wait_timeout=30):
+        self.pool = pool
+        self.wait_timeout = wait_timeout
+        # getconn raises once the pool is exhausted, so requests wait here for a free connection instead
+        self._available = threading.BoundedSemaphore(pool.maxconn)
+
+    def _connection(self):
+        if not self._available.acquire(timeout=self.wait_timeout):
+            raise TimeoutError("all database connections are busy")
+        try:
+            conn = self.pool.getconn()
+            if not conn.readonly:
+                conn.set_session(readonly=True)
+        except Exception:
+            self._available.release()
+            raise
+        return conn
+
+    def _release(self, conn):
+        try:
+            conn.rollback()
+            self.pool.putconn(conn)
+        finally:
+            self._available.release()
+
+    # Rows from a server-side cursor in the pool's read-only transaction, the connection goes back to
+    # the pool when the generator finishes or is closed
+    def _stream(self, query, params, itersize=500):
+        conn = self._connection()
+        try:
+            with conn.cursor(name=f'query_api_{uuid.uuid4().hex[:8]}') as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+                yield from cur
+        finally:
+            self._release(conn)
+
+    def _fetch(self, query, params):
+        conn = self._connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                return cur.fetchall()
+        finally:
+            self._release(conn)
+
+    # Each endpoint validates its parameters first and returns an iterator of body chunks
+    def routes(self, params):
+        bbox = _text(params, 'bbox')
+        try:
+            min_lon, min_lat, max_lon, max_lat = map(float, (bbox or '').split(','))
+        except ValueError:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        query_params = {
+            'min_lon': min_lon, 'min_lat': min_lat, 'max_lon': max_lon, 'max_lat': max_lat,
+            'vehicle_type': _text(params, 'vehicle_type'),
+            'limit': _number(params, 'limit', 5000, int, 1, MAX_ROUTES),
+        }
+
+        def chunks():
+            rows = self._stream(ROUTES_QUERY, query_params)
+            try:
+                # Runs the query before the first chunk is yielded
+                first = next(rows, None)
+                yield b'{"type":"FeatureCollection","features":['
+                separator = b''
+                for session_id, vehicle_type, source, destination, date, geometry in (itertools.chain((first,), rows) if first else ()):
+                    properties = {'session_id': session_id, 'vehicle_type': vehicle_type, 'source': source, 'destination': destination, 'date': date}
+                    yield separator + b'{"type":"Feature","geometry":' + geometry.encode() + b',"properties":' + _json(properties) + b'}'
+                    separator = b','
+                yield b']}'
+            finally:
+                rows.close()
+        return chunks()
+
+    def stops_near(self, params):
+        lat = _number(params, 'lat', minimum=-90, maximum=90)
+        lon = _number(params, 'lon', minimum=-180, maximum=180)
+        radius = _number(params, 'radius', 300.0, minimum=1, maximum=5000)
+        # Bounding box first, so only the stops around the point are measured
+        lat_span = radius / 111320
+        lon_span = radius / (111320 * max(math.cos(math.radians(lat)), 1e-6))
+        rows = self._fetch(STOPS_QUERY, {
+            'lat': lat, 'lon': lon, 'radius': radius, 'limit': _number(params, 'limit', 20, int, 1, MAX_STOPS),
+            'min_lat': lat - lat_span, 'max_lat': lat + lat_span, 'min_lon': lon - lon_span, 'max_lon': lon + lon_span,
+        })
+        return _single(_json([
+            {'id': stop_id, 'destination': destination, 'vehicle_type': vehicle_type, 'lat': stop_lat, 'lon': stop_lon, 'distance_m': round(distance, 1)}
+            for stop_id, destination, vehicle_type, stop_lat, stop_lon, distance in rows
+        ]))
+
+    def fare_summary(self, params):
+        rows = self._fetch(FARES_QUERY, {
+            'vehicle_type': _text(params, 'vehicle_type'),
+            'source_place_id': _optional_int(params, 'source_place_id'),
+            'destination_place_id': _optional_int(params, 'destination_place_id'),
+            'min_count': _number(params, 'min_count', 1, int, 1),
+            'limit': _number(params, 'limit', 200, int, 1, 10000),
+        })
+        return _single(_json([
+            {
+                'vehicle_type': vehicle_type, 'source_place_id': source_place_id, 'source': source,
+                'destination_place_id': destination_place_id, 'destination': destination, 'count': count,
+                'min': minimum, 'median': float(median), 'max': maximum, 'mean': round(float(mean), 1),
+            }
+            for vehicle_type, source_place_id, source, destination_place_id, destination, count, minimum, median, maximum, mean in rows
+        ]))
+
+    def session(self, user_id, session_id):
+        rows = self._fetch(SESSION_QUERY, (user_id, session_id))
+        if not rows:
+            raise LookupError(f"No session {session_id} for user {user_id}")
+        session = dict(zip(SESSION_FIELDS, rows[0]))
+        if session['simplified_route'] is not None:
+            session['simplified_route'] = json.loads(session['simplified_route'])
+        return _single(_json(session))
+
+    def dispatch(self, path, params):
+        if path == '/routes':
+            return self.routes(params)
+        if path == '/stops/near':
+            return self.stops_near(params)
+        if path == '/fares/summary':
+            return self.fare_summary(params)
+        match = SESSION_URL.match(path)
+        if match:
+            return self.session(int(match.group(1)), match.group(2))
+        raise LookupError(f"Unknown path {path}")
+
+
+def serve(api, cache, port):
+    class ApiHandler(BaseHTTPRequestHandler):
+        def _send_error(self, status, message):
+            body = _json({'error': message})
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_headers(self, etag, cache_status, length=None):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'private, max-age=0, must-revalidate')
+            self.send_header('X-Cache', cache_status)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if length is None:
+                # Streamed, the end of the body is the end of the connection
+                self.send_header('Connection', 'close')
+            else:
+                self.send_header('Content-Length', str(length))
+            self.end_headers()
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = parse_qs(url.query)
+            key = url.path + '?' + '&'.join(f'{name}={value}' for name, values in sorted(params.items()) for value in values)
+            generation = cache.generation
+            etag = cache.etag(key, generation)
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            body = cache.get(key)
+            if body is not None:
+                self._send_headers(etag, 'HIT', len(body))
+                self.wfile.write(body)
+                return
+
+            chunks = None
+            try:
+                chunks = api.dispatch(url.path, params)
+                # Every endpoint has run its query by its first chunk, so database errors still get an error status
+                first = next(chunks)
+            except Exception as e:
+                if chunks is not None:
+                    chunks.close()
+                if isinstance(e, ValueError):
+                    self._send_error(400, str(e))
+                elif isinstance(e, LookupError):
+                    self._send_error(404, str(e))
+                elif isinstance(e, TimeoutError):
+                    self._send_error(503, str(e))
+                else:
+                    logging.error(f"Error answering {self.path}: {e}")
+                    self._send_error(500, "query failed")
+                return
+
+            self._send_headers(etag, 'MISS')
+            body = [first]
+            size = len(first)
+            try:
+                self.wfile.write(first)
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+                    # Only responses small enough for the cache are kept in memory
+                    if body is not None:
+                        body.append(chunk)
+                        size += len(chunk)
+                        if size > cache.max_entry_bytes:
+                            body = None
+            except Exception as e:
+                logging.error(f"Error streaming {self.path}: {e}")
+                return
+            finally:
+                chunks.close()
+            if body is not None:
+                cache.put(key, generation, b''.join(body))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), ApiHandler)
+    logging.info(f"Serving the query API on http://127.0.0.1:{port}")
+    server.serve_forever()
+
+
+# Drops the cache whenever the bot commits a change. Runs on a connection to the primary, a replica does
+# not deliver notifications. A replica may not have replayed the commit yet when the notification
+# arrives, so responses cached right after it can hold the old data until the TTL expires.
+def listen_for_changes(connect, cache, retry_interval=10):
+    while True:
+        try:
+            conn = connect()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANGES_CHANNEL}")
+            # Changes made while not listening are not known, so start from an empty cache
+            cache.invalidate()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    cache.invalidate()
+        except Exception as e:
+            logging.warning(f"Change listener disconnected, the cache only expires by TTL until it reconnects: {e}")
+            time.sleep(retry_interval)
+
+
+def main() -> None:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Read-only HTTP API over the collected routes, stops, fares and sessions")
+    parser.add_argument('--port', type=int, default=int(os.getenv('API_PORT', 8091)))
+    parser.add_argument('--pool-size', type=int, default=int(os.getenv('API_POOL_SIZE', 8)))
+    parser.add_argument('--cache-entries', type=int, default=int(os.getenv('API_CACHE_ENTRIES', 512)))
+    parser.add_argument('--cache-ttl', type=float, default=float(os.getenv('API_CACHE_TTL', 300)), help="seconds")
+    parser.add_argument(
+        '--replica-cache-ttl', type=float, default=float(os.getenv('API_REPLICA_CACHE_TTL', REPLICA_CACHE_TTL)),
+        help="seconds, the cache TTL when READ_DB_* point the pool at a replica"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    primary = {
+        'host': os.getenv('DB_HOST'),
+        'port': os.getenv('DB_PORT'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'dbname': os.getenv('DB_NAME'),
+    }
+    # READ_DB_* point the pool at a read replica, unset ones fall back to the primary's settings
+    replica = {name: os.getenv(f'READ_DB_{name.upper()}') or value for name, value in primary.items() if name != 'dbname'}
+    replica['dbname'] = os.getenv('READ_DB_NAME') or primary['dbname']
+    pool = ThreadedConnectionPool(
+        1, args.pool_size, options=f"-c statement_timeout={int(os.getenv('API_STATEMENT_TIMEOUT_MS', 10000))}", **replica
+    )
+    cache_ttl = args.cache_ttl
+    if replica != primary:
+        # Bounds how long data from a lagging replica can outlive a notification
+        cache_ttl = min(cache_ttl, args.replica_cache_ttl)
+    cache = ResponseCache(args.cache_entries, cache_ttl)
+    threading.Thread(target=listen_for_changes, args=(lambda: psycopg2.connect(**primary), cache), daemon=True).start()
+    serve(QueryApi(pool), cache, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import argparse
+import itertools
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2 import extras
+from shapely import wkt
+from shapely.geometry import LineString
+
+from gps_cleaning import clean_track
+from query_api import notify_changes
+from trip_storage import simplify_route
+from vector_tiles import mark_tiles_dirty, tiles_for_line
+
+# Rebuilds simplified_bus_routes for past sessions, e.g. after changing the simplification tolerance
+# or the cleaning parameters. Sessions are streamed from route_points through a server-side cursor,
+# reprocessed in a process pool and written back in batches. Every batch commits together with its
+# checkpoint, so an interrupted run continues where it stopped. Sessions stored with
+# TRIP_STORAGE_MODE=trips or already moved to the cold archive have no route_points and are skipped.
+
+METERS_PER_DEGREE = 111320
+
+SESSION_POINTS_QUERY = """
+    SELECT s.id, s.user_id, s.telegram_username, s.session_id, s.vehicle_type, s.source, s.destination, s.date, s.time,
+           p.recorded_at, ST_X(p.geom_point), ST_Y(p.geom_point)
+    FROM sessions s
+    JOIN route_points p ON p.session_ref = s.id AND p.point_type = 0
+    WHERE s.id > %s AND s.cancel = FALSE
+    ORDER BY s.id, p.point_id
+"""
+
+SESSION_FIELDS = ('session_ref', 'user_id', 'username', 'session_id', 'vehicle_type', 'source', 'destination', 'date', 'time')
+
+
+def iter_sessions(rows):
+    for session_ref, session_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        session_rows = list(session_rows)
+        session = dict(zip(SESSION_FIELDS, session_rows[0][:9]))
+        session['tracks'] = [{'lat': lat, 'lon': lon, 'time': recorded_at} for *_, recorded_at, lon, lat in session_rows]
+        yield session
+
+
+# Runs in the worker processes, only plain data goes in and out
+def reprocess_session(session, tolerance, clean, smoothing_window):
+    tracks = session.pop('tracks')
+    if clean:
+        tracks, _ = clean_track(tracks, smoothing_window=smoothing_window)
+    route_points = [(track['lon'], track['lat']) for track in tracks]
+    session['simplified_points'] = simplify_route(route_points, tolerance) if len(route_points) >= 2 else []
+    return session
+
+
+def _reprocess(args):
+    return reprocess_session(*args)
+
+
+def _old_lines(cur, sessions):
+    cur.execute(
+        """
+        SELECT user_id, session_id, ST_AsText(geom_line)
+        FROM simplified_bus_routes
+        WHERE (user_id, session_id) IN (SELECT * FROM UNNEST(%s::bigint[], %s::varchar[]))
+        """, ([session['user_id'] for session in sessions], [session['session_id'] for session in sessions])
+    )
+    return {(user_id, session_id): line for user_id, session_id, line in cur.fetchall()}
+
+
+def _line_points(line_wkt):
+    return [(float(lon), float(lat)) for lon, lat in re.findall(r'(-?[\d.]+) (-?[\d.]+)', line_wkt or '')]
+
+
+def diff_line(old_wkt, new_points):
+    old = wkt.loads(old_wkt) if old_wkt else None
+    new = LineString(new_points) if len(new_points) >= 2 else None
+    return {
+        'old_vertices': len(old.coords) if old is not None else 0,
+        'new_vertices': len(new.coords) if new is not None else 0,
+        # Largest distance between the two lines, roughly in metres at Baghdad's latitude
+        'max_shift_m': old.hausdorff_distance(new) * METERS_PER_DEGREE if old is not None and new is not None else None,
+    }
+
+
+def write_batch(cur, results, old_lines):
+    keys = [(session['user_id'], session['session_id']) for session in results]
+    cur.execute(
+        """
+        DELETE FROM simplified_bus_routes
+        WHERE (user_id, session_id) IN (SELECT * FROM UNNEST(%s::bigint[], %s::varchar[]))
+        """, ([key[0] for key in keys], [key[1] for key in keys])
+    )
+    rows = [
+        (
+            session['session_id'], session['user_id'], session['username'], session['vehicle_type'], session['date'], session['time'],
+            session['source'], session['destination'], False, LineString(session['simplified_points']).wkt
+        )
+        for session in results if len(session['simplified_points']) >= 2
+    ]
+    extras.execute_batch(cur, """
+        INSERT INTO simplified_bus_routes (session_id, user_id, telegram_username, vehicle_type, date, time, source, destination, cancel, geom_line)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromText(%s), 4326))
+    """, rows)
+
+    # Tiles of both the old and the new line change
+    tiles = set()
+    for session in results:
+        tiles |= tiles_for_line(session['simplified_points'])
+        tiles |= tiles_for_line(_line_points(old_lines.get((session['user_id'], session['session_id']))))
+    mark_tiles_dirty(cur, tiles)
+    notify_changes(cur)
+
+
+def read_checkpoint(cur, run):
+    cur.execute("SELECT last_session_ref FROM reprocess_checkpoints WHERE run_name = %s", (run,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def save_checkpoint(cur, run, last_session_ref, processed):
+    cur.execute(
+        """
+        INSERT INTO reprocess_checkpoints (run_name, last_session_ref, processed, updated_at)
+        VALUES (%s, %s, %s, NOW())
+        ON CONFLICT (run_name) DO UPDATE SET
+            last_session_ref = EXCLUDED.last_session_ref,
+            processed = reprocess_checkpoints.processed + EXCLUDED.processed,
+            updated_at = NOW()
+        """, (run, last_session_ref, processed)
+    )
+
+
+def reprocess(read_conn, write_conn, run, tolerance, clean=False, smoothing_window=0, workers=None,
+              batch_size=200, limit=None, dry_run=False, restart=False):
+    with write_conn.cursor() as cur:
+        if restart and not dry_run:
+            cur.execute("DELETE FROM reprocess_checkpoints WHERE run_name = %s", (run,))
+        start_after = 0 if restart else read_checkpoint(cur, run)
+    write_conn.commit()
+    logging.info(f"Reprocessing sessions after {start_after} as run '{run}'")
+
+    processed = 0
+    diffs = []
+    # The read connection keeps one snapshot open for the whole run, the writes commit on their own connection
+    with read_conn.cursor(name='reprocess_sessions') as source, ProcessPoolExecutor(max_workers=workers) as executor:
+        source.itersize = 20000
+        source.execute(SESSION_POINTS_QUERY, (start_after,))
+        sessions = iter_sessions(source)
+        if limit:
+            sessions = itertools.islice(sessions, limit)
+
+        while True:
+            batch = list(itertools.islice(sessions, batch_size))
+            if not batch:
+                break
+            results = list(executor.map(
+                _reprocess, [(session, tolerance, clean, smoothing_window) for session in batch], chunksize=max(1, len(batch) // 32)
+            ))
+
+            with write_conn.cursor() as cur:
+                old_lines = _old_lines(cur, results)
+                if dry_run:
+                    for session in results:
+                        diff = diff_line(old_lines.get((session['user_id'], session['session_id'])), session['simplified_points'])
+                        diffs.append(dict(diff, session_id=session['session_id'], user_id=session['user_id']))
+                else:
+                    write_batch(cur, results, old_lines)
+                    save_checkpoint(cur, run, results[-1]['session_ref'], len(results))
+            if dry_run:
+                write_conn.rollback()
+            else:
+                write_conn.commit()
+            processed += len(results)
+            logging.info(f"{processed} sessions reprocessed, last session {results[-1]['session_ref']}")
+    read_conn.rollback()
+
+    if dry_run:
+        print_diff_summary(diffs)
+    return processed
+
+
+def print_diff_summary(diffs, top=20):
+    if not diffs:
+        print("No sessions to reprocess")
+        return
+    old_vertices = sum(diff['old_vertices'] for diff in diffs)
+    new_vertices = sum(diff['new_vertices'] for diff in diffs)
+    print(f"{len(diffs)} sessions, {old_vertices} -> {new_vertices} vertices ({new_vertices - old_vertices:+d})")
+    print(f"{sum(1 for diff in diffs if diff['old_vertices'] == 0)} sessions have no simplified route yet")
+    shifted = sorted((diff for diff in diffs if diff['max_shift_m'] is not None), key=lambda diff: -diff['max_shift_m'])
+    if shifted:
+        print("Largest changes (max distance between old and new line):")
+        for diff in shifted[:top]:
+            print(f"  user {diff['user_id']} session {diff['session_id']}: {diff['old_vertices']} -> {diff['new_vertices']} vertices, {diff['max_shift_m']:.1f} m")
+
+
+def main() -> None:
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Rebuild simplified_bus_routes for past sessions")
+    parser.add_argument('--run', default='simplified_bus_routes', help="checkpoint name, reuse it to resume an interrupted run")
+    parser.add_argument('--tolerance', type=float, default=0.000000001, help="Visvalingam-Whyatt area tolerance")
+    parser.add_argument('--clean', action='store_true', help="run the GPS cleaning again before simplifying")
+    parser.add_argument('--smoothing-window', type=int, default=int(os.getenv('GPS_SMOOTHING_WINDOW', 0)))
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the number of CPUs")
+    parser.add_argument('--batch-size', type=int, default=200, help="sessions per write transaction and checkpoint")
+    parser.add_argument('--limit', type=int, help="stop after this many sessions")
+    parser.add_argument('--dry-run', action='store_true', help="print how the routes would change without writing")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the first session")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    def connect():
+        return psycopg2.connect(
+            host=os.getenv('DB_HOST'),
+            port=os.getenv('DB_PORT'),
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD'),
+            dbname=os.getenv('DB_NAME')
+        )
+
+    read_conn, write_conn = connect(), connect()
+    try:
+        reprocess(
+            read_conn, write_conn, args.run, args.tolerance, clean=args.clean, smoothing_window=args.smoothing_window,
+            workers=args.workers, batch_size=args.batch_size, limit=args.limit, dry_run=args.dry_run, restart=args.restart
+        )
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Lower value is sent first, never zero: ExtBot drops falsy rate_limit_args before they reach the limiter.
+PRIORITY_CONFIRMATION = 1
+PRIORITY_PROMPT = 2
+PRIORITY_INFO = 3
+PRIORITIES = (PRIORITY_CONFIRMATION, PRIORITY_PROMPT, PRIORITY_INFO)
+
+# Edits that fully replace the previous content of the same message, so only the latest one matters
+COALESCED_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _OutboundRequest:
+    def __init__(self, priority, seq, callback, args, kwargs, chat_id, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.coalesce_key = coalesce_key
+        self.futures = []
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Outbound send scheduler plugged into the Bot API request path.
+# Every request waits for the global and its per-chat token bucket and is sent in priority order
+# (pass rate_limit_args=PRIORITY_... to a bot method). Superseded edits of the same message are
+# merged into one call, and RetryAfter pauses sending and re-queues the request.
+class FloodControlRateLimiter(BaseRateLimiter[int]):
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        private_chat_rate: float = 1,
+        private_chat_burst: float = 3,
+        group_chat_rate: float = 20 / 60,
+        group_chat_burst: float = 3,
+        max_retries: int = 3,
+    ) -> None:
+        self.overall_bucket = TokenBucket(overall_rate, overall_rate)
+        self.private_chat_rate = private_chat_rate
+        self.private_chat_burst = private_chat_burst
+        self.group_chat_rate = group_chat_rate
+        self.group_chat_burst = group_chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._queue = []
+        self._pending_edits = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+        self._in_flight = set()
+
+    async def initialize(self) -> None:
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for request in self._queue:
+            for future in request.futures:
+                if not future.done():
+                    future.cancel()
+        self._queue.clear()
+        self._pending_edits.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Forget chats whose bucket has refilled, they behave exactly like new ones
+                now = time.monotonic()
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items()
+                    if value.wait_time(now) > 0 or value.tokens < value.capacity
+                }
+            if isinstance(chat_id, int) and chat_id < 0 or isinstance(chat_id, str):
+                bucket = TokenBucket(self.group_chat_rate, self.group_chat_burst)
+            else:
+                bucket = TokenBucket(self.private_chat_rate, self.private_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self._dispatcher is None:
+            return await callback(*args, **kwargs)
+
+        # Requests sent without one of the priorities are prompts
+        priority = rate_limit_args if rate_limit_args in PRIORITIES else PRIORITY_PROMPT
+        if endpoint == 'answerCallbackQuery':
+            priority = min(priority, PRIORITY_CONFIRMATION)
+        chat_id = data.get('chat_id')
+        future = asyncio.get_running_loop().create_future()
+
+        coalesce_key = None
+        if endpoint in COALESCED_ENDPOINTS:
+            coalesce_key = (endpoint, chat_id, data.get('message_id'), data.get('inline_message_id'))
+            pending = self._pending_edits.get(coalesce_key)
+            if pending is not None:
+                # The queued edit has not been sent yet, replace its payload with the newer one
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.futures.append(future)
+                if priority < pending.priority:
+                    pending.priority = priority
+                    heapq.heapify(self._queue)
+                logging.debug(f"Coalesced superseded {endpoint} for chat {chat_id}")
+                self._wakeup.set()
+                return await future
+
+        request = _OutboundRequest(priority, next(self._seq), callback, args, kwargs, chat_id, coalesce_key)
+        request.futures.append(future)
+        if coalesce_key is not None:
+            self._pending_edits[coalesce_key] = request
+        heapq.heappush(self._queue, request)
+        self._wakeup.set()
+        return await future
+
+    def _next_ready(self, now: float):
+        # Highest-priority request whose chat is not throttled, so one busy chat does not block the others
+        wait = None
+        for request in sorted(self._queue):
+            if request.chat_id is None:
+                return request, 0.0
+            chat_wait = self._chat_bucket(request.chat_id).wait_time(now)
+            if chat_wait == 0:
+                return request, 0.0
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self.overall_bucket.wait_time(now))
+            request = None
+            if wait <= 0:
+                request, wait = self._next_ready(now)
+
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._queue.remove(request)
+            heapq.heapify(self._queue)
+            if request.coalesce_key is not None:
+                self._pending_edits.pop(request.coalesce_key, None)
+            self.overall_bucket.consume(now)
+            if request.chat_id is not None:
+                self._chat_bucket(request.chat_id).consume(now)
+
+            task = asyncio.create_task(self._send(request))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, request: _OutboundRequest) -> None:
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as exc:
+            retry_after = exc.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            request.attempts += 1
+            if request.attempts > self.max_retries:
+                logging.error(f"Giving up on request to chat {request.chat_id} after {request.attempts} flood waits")
+                self._resolve(request, exception=exc)
+                return
+            logging.warning(f"Flood limit hit, pausing outbound messages for {retry_after} seconds")
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+            newer = self._pending_edits.get(request.coalesce_key) if request.coalesce_key else None
+            if newer is not None:
+                # A newer edit of the same message was queued meanwhile, it supersedes this one
+                newer.futures.extend(request.futures)
+            else:
+                if request.coalesce_key is not None:
+                    self._pending_edits[request.coalesce_key] = request
+                heapq.heappush(self._queue, request)
+            self._wakeup.set()
+            return
+        except Exception as exc:
+            self._resolve(request, exception=exc)
+            return
+        self._resolve(request, result=result)
+
+    @staticmethod
+    def _resolve(request: _OutboundRequest, result=None, exception=None) -> None:
+        for future in request.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
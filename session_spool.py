@@ -0,0 +1,143 @@
+import logging
+import os
+import pickle
+import struct
+import threading
+import uuid
+import zlib
+
+# Append-only, fsync'd journal of finished sessions. A session is journaled before the volunteer is
+# told it was recorded, and a drainer replays the journal into the database afterwards.
+# Every record is framed as <length><crc32><pickled record> so a write torn by a crash is detected
+# and cut off when the spool is opened again. The drained offset lives in a side file that is only advanced after the database
+# commit, and every record carries an idempotency key that the database stores in the same
+# transaction, so a replay after a crash between the two never ingests a session twice.
+
+HEADER = struct.Struct('<II')
+
+
+class SessionSpool:
+    def __init__(self, directory, name='sessions'):
+        os.makedirs(directory, exist_ok=True)
+        self.journal_path = os.path.join(directory, f'{name}.journal')
+        self.offset_path = os.path.join(directory, f'{name}.offset')
+        self.dead_letter_path = os.path.join(directory, f'{name}.dead')
+        self._lock = threading.Lock()
+        self._recover()
+
+    def append(self, record):
+        record = dict(record, idempotency_key=record.get('idempotency_key') or uuid.uuid4().hex)
+        payload = pickle.dumps(record)
+        frame = memoryview(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        with self._lock:
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+            try:
+                start = os.lseek(fd, 0, os.SEEK_END)
+                try:
+                    while frame:
+                        frame = frame[os.write(fd, frame):]
+                    os.fsync(fd)
+                except BaseException:
+                    # Nothing was acknowledged, so the partial frame must not stay in front of later records
+                    os.ftruncate(fd, start)
+                    raise
+            finally:
+                os.close(fd)
+        return record['idempotency_key']
+
+    # Yields (end_offset, payload) for every intact frame from offset on, up to the first torn one
+    def _frames(self, journal, offset):
+        journal.seek(offset)
+        while True:
+            header = journal.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, checksum = HEADER.unpack(header)
+            payload = journal.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            offset += HEADER.size + length
+            yield offset, payload
+
+    # A crash while appending leaves a torn frame at the end of the journal. It was never acknowledged,
+    # and records appended behind it could not be read, so it is cut off before the spool is used.
+    def _recover(self):
+        try:
+            size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return
+        offset = self._read_offset()
+        if offset > size:
+            # The journal was started afresh after this offset was written
+            logging.warning(f"Drained offset {offset} is past the end of {self.journal_path}, draining it from the start")
+            offset = 0
+            self._write_offset(0)
+        with open(self.journal_path, 'r+b') as journal:
+            end = offset
+            for end, _ in self._frames(journal, offset):
+                pass
+            if end < size:
+                logging.warning(f"Cutting off {size - end} bytes of an incomplete record at offset {end} in {self.journal_path}")
+                journal.truncate(end)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        temporary_path = self.offset_path + '.tmp'
+        with open(temporary_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temporary_path, self.offset_path)
+
+    # Returns up to max_records undrained records as (end_offset, record) pairs
+    def pending(self, max_records=100):
+        records = []
+        with self._lock:
+            if not os.path.exists(self.journal_path):
+                return records
+            offset = self._read_offset()
+            with open(self.journal_path, 'rb') as journal:
+                for end_offset, payload in self._frames(journal, offset):
+                    records.append((end_offset, pickle.loads(payload)))
+                    offset = end_offset
+                    if len(records) >= max_records:
+                        break
+                else:
+                    if offset < os.fstat(journal.fileno()).st_size:
+                        # Appends never leave a torn frame behind, so this is damage on disk
+                        logging.error(f"Corrupt record at offset {offset} in {self.journal_path}, the journal is not drained past it")
+        return records
+
+    def mark_drained(self, offset):
+        with self._lock:
+            # Start a fresh journal once everything in it is in the database. The offset is reset first:
+            # a crash before the removal replays records the idempotency keys skip, while an offset left
+            # behind would skip the first records of the new journal.
+            if offset >= os.path.getsize(self.journal_path):
+                self._write_offset(0)
+                os.remove(self.journal_path)
+            else:
+                self._write_offset(offset)
+
+    def dead_letter(self, record, error):
+        # Records the database keeps rejecting are set aside instead of blocking the journal or being lost
+        logging.error(f"Moving session {record.get('session_id')} to {self.dead_letter_path}: {error}")
+        payload = pickle.dumps(dict(record, error=str(error)))
+        with self._lock, open(self.dead_letter_path, 'ab') as dead_letters:
+            dead_letters.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            dead_letters.flush()
+            os.fsync(dead_letters.fileno())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.journal_path) - self._read_offset()
+        except FileNotFoundError:
+            return 0
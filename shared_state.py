@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import logging
+import pickle
+import threading
+
+# Abandoned conversations expire from the shared store instead of piling up forever
+STATE_TTL_SECONDS = 7 * 24 * 3600
+LOCK_TIMEOUT_SECONDS = 300
+
+
+def shard_for(user_id, shards):
+    return user_id % shards
+
+
+# In-process stand-in for the shared store, used by tests and single-process runs
+class LocalStateStore:
+    def __init__(self):
+        self._states = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def get(self, user_id):
+        data = self._states.get(user_id)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, user_id, state):
+        self._states[user_id] = pickle.dumps(state)
+
+    def delete(self, user_id):
+        self._states.pop(user_id, None)
+
+    def lock(self, user_id):
+        with self._locks_guard:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+
+# Redis-compatible store, the conversation state of every user is one pickled key
+class RedisStateStore:
+    def __init__(self, url, prefix='transitlab:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, user_id):
+        data = self.client.get(f'{self.prefix}state:{user_id}')
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, user_id, state):
+        self.client.set(f'{self.prefix}state:{user_id}', pickle.dumps(state), ex=STATE_TTL_SECONDS)
+
+    def delete(self, user_id):
+        self.client.delete(f'{self.prefix}state:{user_id}')
+
+    def lock(self, user_id):
+        # Acquired and released from different worker threads, so the token must not be thread-local
+        return self.client.lock(
+            f'{self.prefix}lock:{user_id}', timeout=LOCK_TIMEOUT_SECONDS,
+            blocking_timeout=LOCK_TIMEOUT_SECONDS, thread_local=False
+        )
+
+
+def open_state_store(url):
+    if not url:
+        return None
+    if url == 'local://':
+        return LocalStateStore()
+    return RedisStateStore(url)
+
+
+# Wraps a handler so the user's entry of the module-level user_data dict is loaded from the
+# shared store before it runs and written back afterwards, while holding the user's lock.
+# Without a store the handler is returned unchanged and user_data stays process-local.
+def bind_user_state(store, user_data):
+    def wrap(handler):
+        if store is None:
+            return handler
+
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = update.effective_user
+            if user is None:
+                return await handler(update, context)
+
+            lock = store.lock(user.id)
+            acquired = await asyncio.to_thread(lock.acquire)
+            if not acquired:
+                logging.error(f"Could not lock conversation state for user {user.id}")
+                return
+            try:
+                state = await asyncio.to_thread(store.get, user.id)
+                if state is not None:
+                    user_data[user.id] = state
+                try:
+                    return await handler(update, context)
+                finally:
+                    if user.id in user_data:
+                        await asyncio.to_thread(store.set, user.id, user_data.pop(user.id))
+                    else:
+                        await asyncio.to_thread(store.delete, user.id)
+            finally:
+                await asyncio.to_thread(lock.release)
+
+        return wrapper
+
+    return wrap
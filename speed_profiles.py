@@ -0,0 +1,258 @@
+import argparse
+import itertools
+import logging
+import os
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+from coverage_grid import COVERAGE_LEVELS
+from gps_cleaning import haversine_m
+
+# Per-segment speeds and travel times of recorded tracks, aggregated into speed_profiles by corridor and
+# hour of day. A corridor is a cell of the finest coverage grid (about 220 m) travelled in one of eight
+# compass directions, so both directions of a road are kept apart. Each ingested session adds its sums
+# to the table, and a canceled session takes them off again. Travel times are estimated from it without
+# reading any raw points.
+
+LOCAL_TIMEZONE = 'Asia/Baghdad'
+CELL_SIZE = COVERAGE_LEVELS[0]
+HEADING_SECTORS = 8
+# Longer gaps between two fixes are lost signal, not travel, and are left out of the profiles
+MAX_SEGMENT_SECONDS = 600
+# Below this the vehicle is standing, the segment keeps the direction it was moving in
+MIN_MOVING_M = 2
+
+UPSERT_QUERY = """
+    INSERT INTO speed_profiles (cell_x, cell_y, heading, hour, segment_count, session_count, distance_m, seconds,
+                                speed_kmh_sum, speed_kmh_sq_sum, last_seen)
+    VALUES (%s, %s, %s, %s, %s, 1, %s, %s, %s, %s, %s)
+    ON CONFLICT (cell_x, cell_y, heading, hour) DO UPDATE SET
+        segment_count = speed_profiles.segment_count + EXCLUDED.segment_count,
+        session_count = speed_profiles.session_count + 1,
+        distance_m = speed_profiles.distance_m + EXCLUDED.distance_m,
+        seconds = speed_profiles.seconds + EXCLUDED.seconds,
+        speed_kmh_sum = speed_profiles.speed_kmh_sum + EXCLUDED.speed_kmh_sum,
+        speed_kmh_sq_sum = speed_profiles.speed_kmh_sq_sum + EXCLUDED.speed_kmh_sq_sum,
+        last_seen = GREATEST(speed_profiles.last_seen, EXCLUDED.last_seen)
+"""
+
+SUBTRACT_QUERY = """
+    UPDATE speed_profiles SET
+        segment_count = segment_count - %s,
+        session_count = session_count - 1,
+        distance_m = distance_m - %s,
+        seconds = seconds - %s,
+        speed_kmh_sum = speed_kmh_sum - %s,
+        speed_kmh_sq_sum = speed_kmh_sq_sum - %s
+    WHERE cell_x = %s AND cell_y = %s AND heading = %s AND hour = %s
+"""
+
+DELETE_EMPTY_QUERY = """
+    DELETE FROM speed_profiles
+    WHERE cell_x = %s AND cell_y = %s AND heading = %s AND hour = %s AND session_count <= 0
+"""
+
+
+def _epoch_seconds(time):
+    # Times without an offset are UTC, as in track_parser
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def _headings(lat1, lon1, lat2, lon2, distance):
+    bearing = np.degrees(np.arctan2((lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2)), lat2 - lat1)) % 360
+    sector = (np.floor((bearing + 180 / HEADING_SECTORS) / (360 / HEADING_SECTORS)) % HEADING_SECTORS).astype(np.int64)
+    # Standing segments take the direction of the last moving one, or of the first one at the start of the track
+    moving = distance >= MIN_MOVING_M
+    if not moving.any():
+        return np.full(len(sector), -1, dtype=np.int64)
+    last_moving = np.maximum.accumulate(np.where(moving, np.arange(len(sector)), -1))
+    last_moving[last_moving < 0] = np.argmax(moving)
+    return sector[last_moving]
+
+
+# Splits a track into segments between consecutive fixes, in time order. Returns a DataFrame with one
+# row per segment: start time (UTC), local hour, length, duration, speed, the cumulative distance and
+# travel time at its end, its corridor and whether it counts for the profiles.
+def segment_profile(tracks, timezone_name=LOCAL_TIMEZONE):
+    timed = [point for point in tracks if point['time'] is not None]
+    if len(timed) < 2:
+        return pd.DataFrame(columns=[
+            'start_time', 'hour', 'distance_m', 'seconds', 'speed_kmh', 'cumulative_m', 'cumulative_seconds',
+            'cell_x', 'cell_y', 'heading', 'valid'
+        ])
+
+    seconds = np.array([_epoch_seconds(point['time']) for point in timed], dtype=float)
+    # Stable, so fixes with the same time keep their file order. Sorting absolute times also keeps trips
+    # that cross midnight in order.
+    order = np.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    lat = np.array([point['lat'] for point in timed], dtype=float)[order]
+    lon = np.array([point['lon'] for point in timed], dtype=float)[order]
+
+    duration = np.diff(seconds)
+    distance = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(duration > 0, distance / duration * 3.6, np.nan)
+    # Cells are taken at the segment midpoint, rounded like the coverage grid
+    mid_lat, mid_lon = (lat[:-1] + lat[1:]) / 2, (lon[:-1] + lon[1:]) / 2
+    start_time = pd.to_datetime(seconds[:-1], unit='s', utc=True)
+
+    profile = pd.DataFrame({
+        'start_time': start_time,
+        'hour': start_time.tz_convert(timezone_name).hour.to_numpy(),
+        'distance_m': distance,
+        'seconds': duration,
+        'speed_kmh': speed,
+        'cumulative_m': np.cumsum(distance),
+        'cumulative_seconds': seconds[1:] - seconds[0],
+        'cell_x': np.floor(np.round(mid_lon / CELL_SIZE, 9)).astype(np.int64),
+        'cell_y': np.floor(np.round(mid_lat / CELL_SIZE, 9)).astype(np.int64),
+        'heading': _headings(lat[:-1], lon[:-1], lat[1:], lon[1:], distance),
+    })
+    profile['valid'] = (duration > 0) & (duration <= MAX_SEGMENT_SECONDS) & (profile['heading'] >= 0)
+    return profile
+
+
+# Sums of the valid segments per (cell_x, cell_y, heading, hour)
+def aggregate_profile(profile):
+    valid = profile[profile['valid']]
+    if valid.empty:
+        return []
+    grouped = valid.assign(speed_kmh_sq=valid['speed_kmh'] ** 2).groupby(['cell_x', 'cell_y', 'heading', 'hour']).agg(
+        segment_count=('seconds', 'size'),
+        distance_m=('distance_m', 'sum'),
+        seconds=('seconds', 'sum'),
+        speed_kmh_sum=('speed_kmh', 'sum'),
+        speed_kmh_sq_sum=('speed_kmh_sq', 'sum'),
+    )
+    return [
+        (int(cell_x), int(cell_y), int(heading), int(hour), int(row.segment_count), float(row.distance_m), float(row.seconds),
+         float(row.speed_kmh_sum), float(row.speed_kmh_sq_sum))
+        for (cell_x, cell_y, heading, hour), row in grouped.iterrows()
+    ]
+
+
+def save_speed_profile(cur, tracks, last_seen, timezone_name=LOCAL_TIMEZONE):
+    from psycopg2 import extras
+
+    extras.execute_batch(cur, UPSERT_QUERY, [
+        (*row, last_seen) for row in aggregate_profile(segment_profile(tracks, timezone_name))
+    ])
+
+
+# Takes a canceled session's sums off the corridors save_speed_profile added them to, computed from the
+# same stored track, and drops the rows no other session contributes to
+def remove_speed_profile(cur, tracks, timezone_name=LOCAL_TIMEZONE):
+    from psycopg2 import extras
+
+    rows = aggregate_profile(segment_profile(tracks, timezone_name))
+    extras.execute_batch(cur, SUBTRACT_QUERY, [
+        (*sums, cell_x, cell_y, heading, hour) for cell_x, cell_y, heading, hour, *sums in rows
+    ])
+    extras.execute_batch(cur, DELETE_EMPTY_QUERY, [tuple(row[:4]) for row in rows])
+
+
+# Estimated travel time in seconds along a line of (lon, lat) points at the given local hour, from the
+# average speed of every corridor it passes. Corridors without samples at that hour fall back to the
+# whole day, and those never recorded to fallback_kmh.
+def estimate_travel_time(cur, points, hour, fallback_kmh=20):
+    if len(points) < 2:
+        return 0.0
+    coordinates = np.array(points, dtype=float).reshape(-1, 2)
+    lon, lat = coordinates[:, 0], coordinates[:, 1]
+    distance = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    cell_x = np.floor(np.round((lon[:-1] + lon[1:]) / 2 / CELL_SIZE, 9)).astype(np.int64)
+    cell_y = np.floor(np.round((lat[:-1] + lat[1:]) / 2 / CELL_SIZE, 9)).astype(np.int64)
+    heading = _headings(lat[:-1], lon[:-1], lat[1:], lon[1:], distance)
+    keys = sorted(set(zip(cell_x.tolist(), cell_y.tolist(), heading.tolist())))
+
+    cur.execute(
+        """
+        SELECT cell_x, cell_y, heading,
+               SUM(distance_m) FILTER (WHERE hour = %s) / NULLIF(SUM(seconds) FILTER (WHERE hour = %s), 0),
+               SUM(distance_m) / NULLIF(SUM(seconds), 0)
+        FROM speed_profiles
+        WHERE (cell_x, cell_y, heading) IN (SELECT * FROM UNNEST(%s::int[], %s::int[], %s::smallint[]))
+        GROUP BY cell_x, cell_y, heading
+        """, (hour, hour, [key[0] for key in keys], [key[1] for key in keys], [key[2] for key in keys])
+    )
+    speeds = {(x, y, h): hour_speed or day_speed for x, y, h, hour_speed, day_speed in cur.fetchall()}
+    fallback = fallback_kmh / 3.6
+    return float(sum(
+        length / (speeds.get(key) or fallback)
+        for length, key in zip(distance, zip(cell_x.tolist(), cell_y.tolist(), heading.tolist()))
+    ))
+
+
+# Recomputes the profiles from route_points, for the first run or after changing the corridors.
+# recorded_at is UTC, points already moved to the cold archive are not counted again.
+def rebuild_speed_profiles(conn, timezone_name=LOCAL_TIMEZONE):
+    totals = {}
+    last_seen = {}
+    sessions = 0
+    with conn.cursor(name='speed_profile_points') as cur:
+        cur.itersize = 20000
+        cur.execute(
+            """
+            SELECT p.session_ref, p.recorded_at, ST_Y(p.geom_point), ST_X(p.geom_point)
+            FROM route_points p
+            JOIN sessions s ON s.id = p.session_ref
+            WHERE p.point_type = 0 AND s.cancel = FALSE AND p.recorded_at IS NOT NULL
+            ORDER BY p.session_ref, p.point_id
+            """
+        )
+        for _, rows in itertools.groupby(cur, key=lambda row: row[0]):
+            tracks = [{'time': time, 'lat': lat, 'lon': lon} for _, time, lat, lon in rows]
+            session_last_seen = max(point['time'] for point in tracks)
+            for cell_x, cell_y, heading, hour, *sums in aggregate_profile(segment_profile(tracks, timezone_name)):
+                key = (cell_x, cell_y, heading, hour)
+                total = totals.setdefault(key, [0, 0, 0.0, 0.0, 0.0, 0.0])
+                total[0] += sums[0]
+                total[1] += 1
+                for index, value in enumerate(sums[1:], start=2):
+                    total[index] += value
+                last_seen[key] = max(last_seen.get(key, session_last_seen), session_last_seen)
+            sessions += 1
+
+    from psycopg2 import extras
+
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM speed_profiles")
+        extras.execute_batch(cur, """
+            INSERT INTO speed_profiles (cell_x, cell_y, heading, hour, segment_count, session_count, distance_m, seconds,
+                                        speed_kmh_sum, speed_kmh_sq_sum, last_seen)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, [(*key, *total, last_seen[key]) for key, total in totals.items()])
+    conn.commit()
+    logging.info(f"{len(totals)} speed profile rows from {sessions} sessions")
+
+
+def main() -> None:
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Rebuild the per-corridor speed profiles from the stored route points")
+    parser.add_argument('--timezone', default=os.getenv('LOCAL_TIMEZONE', LOCAL_TIMEZONE), help="time zone of the hour of day")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME')
+    )
+    try:
+        rebuild_speed_profiles(conn, args.timezone)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
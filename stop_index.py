@@ -0,0 +1,70 @@
+import math
+
+from gps_cleaning import EARTH_RADIUS_M
+
+METERS_PER_DEGREE = 111320
+# Grid cell size, about 110 m north-south, so a lookup of a few dozen metres touches at most four cells
+STOP_CELL_DEGREES = 0.001
+
+
+# In-memory grid index over the recorded bus stops, so a shared location can be matched against
+# existing stops without a database query. Loaded at startup, kept up to date on insert and cancel, and
+# synced with the database periodically for the stops other workers add or cancel.
+class StopIndex:
+    def __init__(self, cell_degrees=STOP_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        self.stops = {}
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def add(self, stop_id, lat, lon, destination=None):
+        if stop_id in self.stops:
+            return
+        self.stops[stop_id] = {'id': stop_id, 'lat': lat, 'lon': lon, 'destination': destination}
+        self.cells.setdefault(self._cell(lat, lon), []).append(stop_id)
+
+    def remove(self, stop_id):
+        stop = self.stops.pop(stop_id, None)
+        if stop is not None:
+            self.cells[self._cell(stop['lat'], stop['lon'])].remove(stop_id)
+
+    def load(self, rows):
+        for stop_id, lat, lon, destination in rows:
+            self.add(stop_id, lat, lon, destination)
+
+    # Drops the stops that are no longer active and returns the active ids that still need to be loaded
+    def sync(self, active_ids):
+        active_ids = set(active_ids)
+        for stop_id in set(self.stops) - active_ids:
+            self.remove(stop_id)
+        return active_ids - set(self.stops)
+
+    def __len__(self):
+        return len(self.stops)
+
+    # Returns the stops within radius_m of the point as (distance_m, stop) pairs, nearest first
+    def nearby(self, lat, lon, radius_m, limit=3):
+        lat_span = radius_m / METERS_PER_DEGREE
+        lon_span = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        min_y, min_x = self._cell(lat - lat_span, lon - lon_span)
+        max_y, max_x = self._cell(lat + lat_span, lon + lon_span)
+
+        # Plain math rather than NumPy, the handful of candidates in these cells is cheaper to check one by one
+        matches = []
+        for cell_y in range(min_y, max_y + 1):
+            for cell_x in range(min_x, max_x + 1):
+                for stop_id in self.cells.get((cell_y, cell_x), ()):
+                    stop = self.stops[stop_id]
+                    distance = _haversine_m(lat, lon, stop['lat'], stop['lon'])
+                    if distance <= radius_m:
+                        matches.append((distance, stop))
+        matches.sort(key=lambda match: match[0])
+        return matches[:limit]
+
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(max(a, 0.0), 1.0)))
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import queue
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+import bot_workers
+from bot_workers import adopt_orphaned_spools
+from session_spool import SessionSpool
+
+
+def test_journals_of_removed_workers_move_to_worker_zero(tmp_path):
+    directory = str(tmp_path)
+    SessionSpool(directory, 'sessions-0').append({'user_id': 1, 'session_id': 'w0'})
+    SessionSpool(directory, 'sessions-1').append({'user_id': 2, 'session_id': 'w1'})
+    orphan = SessionSpool(directory, 'sessions-3')
+    key = orphan.append({'user_id': 3, 'session_id': 'w3'})
+    orphan.append({'type': 'cancel', 'user_id': 3, 'session_id': 'w3'})
+    SessionSpool(directory, 'sessions').append({'user_id': 4, 'session_id': 'single'})
+
+    assert adopt_orphaned_spools(directory, 2) == 3
+
+    records = [record for _, record in SessionSpool(directory, 'sessions-0').pending()]
+    assert sorted(record['session_id'] for record in records) == ['single', 'w0', 'w3', 'w3']
+    adopted = [record for record in records if record['session_id'] == 'w3']
+    assert adopted[0]['idempotency_key'] == key
+    assert adopted[1]['type'] == 'cancel'
+    assert [record['session_id'] for _, record in SessionSpool(directory, 'sessions-1').pending()] == ['w1']
+    assert not os.path.exists(os.path.join(directory, 'sessions-3.journal'))
+    assert adopt_orphaned_spools(directory, 2) == 0
+
+
+def test_missing_spool_directory(tmp_path):
+    assert adopt_orphaned_spools(str(tmp_path / 'spool'), 4) == 0
+
+
+class FakeUpdate:
+    def __init__(self, update_id, user_id):
+        self.update_id = update_id
+        self.effective_user = SimpleNamespace(id=user_id)
+
+    def to_json(self):
+        return str(self.update_id)
+
+
+class Stop(Exception):
+    pass
+
+
+class FlakyBot:
+    def __init__(self, token):
+        self.results = [NetworkError('reset'), TimedOut(), RetryAfter(7), [FakeUpdate(10, 1), FakeUpdate(11, 2)], TimedOut(), Stop()]
+        self.offsets = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def get_updates(self, offset=None, **kwargs):
+        self.offsets.append(offset)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_router_retries_network_errors(monkeypatch):
+    delays = []
+    bots = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    def make_bot(token):
+        bots.append(FlakyBot(token))
+        return bots[-1]
+
+    monkeypatch.setattr(bot_workers, 'Bot', make_bot)
+    monkeypatch.setattr(bot_workers.asyncio, 'sleep', sleep)
+    queues = [queue.Queue(), queue.Queue()]
+    with pytest.raises(Stop):
+        asyncio.run(bot_workers.route_updates('token', queues))
+
+    # Backoff doubles and starts over after a successful call, flood control waits as long as asked
+    assert delays == [1, 2, 7, 1]
+    assert bots[0].offsets == [None, None, None, None, 12, 12]
+    assert sum(shard.qsize() for shard in queues) == 2
+
+
+class FakeWorker:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+def test_exited_workers_are_started_again():
+    workers = [FakeWorker(), FakeWorker(alive=False)]
+    started = []
+
+    def start_worker(index):
+        started.append(index)
+        return FakeWorker()
+
+    restarts = {}
+    bot_workers.restart_exited_workers(workers, start_worker, restarts, 0)
+    assert started == [1]
+    assert all(worker.is_alive() for worker in workers)
+
+    # A worker that keeps exiting stops the bot
+    for now in range(1, bot_workers.MAX_WORKER_RESTARTS):
+        workers[1] = FakeWorker(alive=False)
+        bot_workers.restart_exited_workers(workers, start_worker, restarts, now)
+    workers[1] = FakeWorker(alive=False)
+    with pytest.raises(RuntimeError):
+        bot_workers.restart_exited_workers(workers, start_worker, restarts, bot_workers.MAX_WORKER_RESTARTS)
+
+    # Restarts older than the window are forgotten
+    bot_workers.restart_exited_workers(workers, start_worker, restarts, bot_workers.RESTART_WINDOW_SECONDS + 10)
+    assert workers[1].is_alive()
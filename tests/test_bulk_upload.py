@@ -0,0 +1,61 @@
+import os
+import zipfile
+
+import pytest
+
+import bulk_upload
+from bulk_upload import ArchiveTooLarge, _extract_member, expand_uploads, parse_metadata_sheet
+
+GPX = b'<gpx><trk><trkseg><trkpt lat="33.3" lon="44.4"/></trkseg></trk></gpx>'
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+def test_archive_members_are_extracted_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_upload, 'EXTRACT_CHUNK_BYTES', 7)
+    path = make_zip(tmp_path / 'upload.zip', {'a.gpx': GPX, 'nested/b.GPX': GPX, 'notes.txt': b'x', '__MACOSX/._a.gpx': b'x'})
+    files = expand_uploads([('upload.zip', path)], str(tmp_path))
+
+    assert [(name, error) for name, _, error in files] == [('upload.zip/a.gpx', None), ('upload.zip/nested/b.GPX', None)]
+    for _, member_path, _ in files:
+        assert os.path.dirname(member_path) == str(tmp_path)
+        with open(member_path, 'rb') as extracted:
+            assert extracted.read() == GPX
+
+
+def test_extraction_stops_at_the_real_decompressed_size(tmp_path):
+    path = make_zip(tmp_path / 'upload.zip', {'a.gpx': b'0' * 100000})
+    with zipfile.ZipFile(path) as archive:
+        with pytest.raises(ArchiveTooLarge):
+            _extract_member(archive, archive.infolist()[0], str(tmp_path / 'a.gpx'), 1000)
+        assert _extract_member(archive, archive.infolist()[0], str(tmp_path / 'a.gpx'), 200000) == 100000
+
+
+def test_too_large_archive_leaves_no_files(tmp_path, monkeypatch):
+    path = make_zip(tmp_path / 'upload.zip', {'a.gpx': GPX, 'b.gpx': b'0' * 100000})
+    target = tmp_path / 'out'
+    target.mkdir()
+    # The second member turns out bigger than the archive's directory says
+    extract_member = _extract_member
+
+    def understated_extract(archive, member, member_path, budget):
+        return extract_member(archive, member, member_path, budget if member.filename == 'a.gpx' else 1000)
+
+    monkeypatch.setattr(bulk_upload, '_extract_member', understated_extract)
+
+    assert expand_uploads([('upload.zip', path)], str(target)) == [('upload.zip', path, 'archive is too large')]
+    assert os.listdir(target) == []
+
+
+def test_metadata_sheet():
+    metadata, missing = parse_metadata_sheet("Vehicle: كيا\nFrom: Bab Al-Sharqi\nالوجهة: Kadhimiya\nfare = 1,000 IQD")
+    assert metadata == {
+        'vehicle_type': 'Kia', 'source': 'Bab Al-Sharqi', 'destination': 'Kadhimiya', 'fare': '1000', 'vehicle_condition': 'unknown'
+    }
+    assert missing == []
+    assert parse_metadata_sheet("vehicle: tram")[1] == ['vehicle_type', 'source', 'destination', 'fare']
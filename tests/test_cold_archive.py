@@ -0,0 +1,82 @@
+import os
+from datetime import date, datetime
+
+from cold_archive import ColdArchive
+
+
+def session(session_ref, day):
+    return {
+        'session_ref': session_ref, 'user_id': 100 + session_ref, 'session_id': f's{session_ref}', 'vehicle_type': 'bus',
+        'source': 'Bab Al-Sharqi', 'destination': 'Kadhimiya', 'date': day, 'cancel': False,
+    }
+
+
+def test_round_trip(tmp_path):
+    archive = ColdArchive(str(tmp_path))
+    points = {
+        1: [
+            (0, 1, datetime(2024, 1, 5, 8, 0, 0, 250000), 33.3123456, 44.3654321),
+            (0, 2, datetime(2024, 1, 5, 8, 0, 5), 33.3124, 44.3655),
+            (1, 1, None, 33.31, 44.36),
+        ],
+        2: [(0, 1, datetime(2024, 1, 5, 9, 0), 33.4, 44.4)],
+        3: [(0, 1, datetime(2024, 1, 6, 7, 30), 33.5, 44.5)],
+    }
+    entries = archive.write_sessions([session(1, date(2024, 1, 5)), session(2, date(2024, 1, 5)), session(3, date(2024, 1, 6))], points)
+
+    # One file per date, one row group per session
+    assert [(entry['session_ref'], entry['row_group'], entry['point_count']) for entry in entries] == [(1, 0, 3), (2, 1, 1), (3, 0, 1)]
+    assert entries[0]['file'] == entries[1]['file'] != entries[2]['file']
+    assert entries[0]['first_recorded_at'] == datetime(2024, 1, 5, 8, 0, 0, 250000)
+    assert entries[0]['last_recorded_at'] == datetime(2024, 1, 5, 8, 0, 5)
+
+    read = list(archive.iter_points(session_ids=['s1']))
+    assert [(point['point_type'], point['point_id'], point['recorded_at']) for point in read] == [
+        ('bus_routing', 1, datetime(2024, 1, 5, 8, 0, 0, 250000)),
+        ('bus_routing', 2, datetime(2024, 1, 5, 8, 0, 5)),
+        ('passenger_on_off', 1, None),
+    ]
+    assert (read[0]['lat'], read[0]['lon']) == (33.312346, 44.365432)
+    assert read[0]['user_id'] == 101
+    assert read[0]['vehicle_type'] == 'bus'
+
+    assert {point['session_id'] for point in archive.iter_points(date_from=date(2024, 1, 6))} == {'s3'}
+    assert len(list(archive.iter_points())) == 5
+
+
+def test_archiving_again_points_at_the_newest_copy(tmp_path):
+    archive = ColdArchive(str(tmp_path))
+    archive.write_sessions([session(1, date(2024, 1, 5))], {1: [(0, 1, datetime(2024, 1, 5, 8, 0), 33.3, 44.3)]})
+    archive.write_sessions([session(1, date(2024, 1, 5))], {1: [
+        (0, 1, datetime(2024, 1, 5, 8, 0), 33.3, 44.3),
+        (0, 2, datetime(2024, 1, 5, 8, 1), 33.4, 44.4),
+    ]})
+
+    assert len(archive.manifest()) == 1
+    assert [point['point_id'] for point in archive.iter_points()] == [1, 2]
+
+
+def test_empty_archive(tmp_path):
+    archive = ColdArchive(str(tmp_path))
+    assert archive.manifest().empty
+    assert list(archive.iter_points()) == []
+
+
+def test_files_are_synced_before_they_are_used(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        synced.append(os.path.realpath(f'/proc/self/fd/{fd}'))
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', record_fsync)
+    archive = ColdArchive(str(tmp_path))
+    entries = archive.write_sessions([session(1, date(2024, 1, 5))], {1: [(0, 1, datetime(2024, 1, 5, 8, 0), 33.3, 44.3)]})
+
+    part = os.path.join(str(tmp_path), entries[0]['file'])
+    # Each file under its temporary name before the rename, then the directory holding the rename
+    assert synced.index(part + '.tmp') < synced.index(os.path.dirname(part))
+    assert synced.index(archive.manifest_path + '.tmp') < len(synced) - 1
+    assert synced[-1] == str(tmp_path)
+    assert not [name for name in os.listdir(os.path.dirname(part)) if name.endswith('.tmp')]
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import pytest
+
+from coverage_grid import cell_center, least_covered_cells, parse_bbox, session_cells
+
+# Level 1 cells 5525..5527 x 4162..4164
+AREA = (44.2001, 33.2961, 44.2239, 33.3199)
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params):
+        level, min_x, max_x, min_y, max_y = params
+        self.result = [row for row in self.rows if min_x <= row[0] <= max_x and min_y <= row[1] <= max_y]
+
+    def fetchall(self):
+        return self.result
+
+
+def recorded(cell_x, cell_y, sessions, day):
+    return (cell_x, cell_y, sessions, sessions * 100, sessions, 0, 0, datetime(2024, 5, day))
+
+
+def test_empty_cells_next_to_recorded_ones_come_first():
+    cur = FakeCursor([recorded(5525, 4162, 3, 1), recorded(5526, 4162, 1, 2), recorded(5600, 4162, 0, 1)])
+    cells = least_covered_cells(cur, level=1, limit=9, bbox=AREA)
+    assert len(cells) == 9
+    assert [cell['session_count'] for cell in cells] == [0] * 7 + [1, 3]
+    # Next to both recorded cells
+    assert {(cell['cell_x'], cell['cell_y']) for cell in cells[:2]} == {(5525, 4163), (5526, 4163)}
+    assert cells[-1]['last_seen'] == datetime(2024, 5, 1)
+    assert cells[0]['last_seen'] is None
+
+
+def test_without_recordings_the_middle_of_the_area_comes_first():
+    cells = least_covered_cells(FakeCursor([]), level=1, limit=1, bbox=AREA)
+    assert (cells[0]['cell_x'], cells[0]['cell_y']) == (5526, 4163)
+    lat, lon = cell_center(1, cells[0]['cell_x'], cells[0]['cell_y'])
+    assert AREA[0] < lon < AREA[2] and AREA[1] < lat < AREA[3]
+
+
+def test_session_cells_count_points_per_level():
+    rows = session_cells([{'lat': 33.3001, 'lon': 44.4001}, {'lat': 33.3002, 'lon': 44.4002}, {'lat': 33.31, 'lon': 44.41}])
+    assert sum(count for level, _, _, count in rows if level == 0) == 3
+    assert len([row for row in rows if row[0] == 2]) == 1
+
+
+def test_parse_bbox():
+    assert parse_bbox('44.2,33.15,44.6,33.5') == (44.2, 33.15, 44.6, 33.5)
+    with pytest.raises(ValueError):
+        parse_bbox('44.6,33.15,44.2,33.5')
+    with pytest.raises(ValueError):
+        parse_bbox('baghdad')
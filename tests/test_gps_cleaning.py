@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from gps_cleaning import clean_track, haversine_m
+
+START = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+METERS_PER_DEGREE = 111320
+
+
+def track(offsets_m, interval=1.0, lat=33.3, lon=44.4, times=True):
+    return [
+        {'lat': lat + north / METERS_PER_DEGREE, 'lon': lon, 'time': START + timedelta(seconds=index * interval) if times else None}
+        for index, north in enumerate(offsets_m)
+    ]
+
+
+def test_slow_crawl_is_kept():
+    # 600 fixes, one per second, 470 m at under 3 km/h in heavy traffic
+    tracks = track(np.linspace(0, 470, 600))
+    cleaned, report = clean_track(tracks)
+    assert report['stationary_points'] == 0
+    assert len(cleaned) == 600
+
+
+def test_dwell_is_collapsed_to_its_first_and_last_point():
+    rng = np.random.default_rng(1)
+    moving = list(np.arange(0, 200, 10.0))
+    waiting = list(200 + rng.uniform(-4, 4, 120))
+    leaving = list(np.arange(210, 400, 10.0))
+    tracks = track(moving + waiting + leaving)
+    cleaned, report = clean_track(tracks)
+
+    # The stop starts at the last moving fix, inside the radius of the waiting ones
+    assert report['stationary_points'] == len(waiting) - 1
+    first_leaving = len(moving) + len(waiting)
+    kept_times = [point['time'] for point in cleaned]
+    assert tracks[len(moving) - 1]['time'] in kept_times
+    assert tracks[first_leaving - 1]['time'] in kept_times
+    assert all(tracks[index]['time'] in kept_times for index in range(first_leaving, len(tracks)))
+
+
+def test_every_dwell_is_collapsed():
+    rng = np.random.default_rng(2)
+    offsets = []
+    for start in (0, 500, 1000):
+        offsets += list(start + np.arange(0, 300, 10.0)) + list(start + 300 + rng.uniform(-4, 4, 90))
+    cleaned, report = clean_track(track(offsets))
+    assert report['stationary_points'] == 3 * 89
+    assert len(cleaned) == 3 * 30 + 3
+
+
+def test_short_stop_is_kept():
+    tracks = track([0, 10, 20, 30, 30, 31, 30, 31, 40, 50, 60])
+    cleaned, report = clean_track(tracks)
+    assert report['stationary_points'] == 0
+
+
+def test_dwell_without_times_counts_points():
+    tracks = track([0, 20, 40] + [60 + (index % 3) for index in range(20)] + [80, 100], times=False)
+    cleaned, report = clean_track(tracks)
+    assert report['stationary_points'] == 18
+    assert [point['lat'] for point in cleaned][:3] == [point['lat'] for point in tracks][:3]
+
+
+def test_jump_is_removed():
+    offsets = list(np.arange(0, 300, 10.0))
+    offsets[15] += 2000
+    cleaned, report = clean_track(track(offsets))
+    assert report['speed_outliers'] == 1
+    assert len(cleaned) == len(offsets) - 1
+
+
+def test_duplicates_are_removed():
+    tracks = track([0, 10, 20, 30])
+    tracks.insert(2, dict(tracks[1]))
+    cleaned, report = clean_track(tracks)
+    assert report['duplicates'] == 1
+    assert len(cleaned) == 4
+
+
+def test_haversine_m():
+    assert abs(haversine_m(33.3, 44.4, 33.3 + 1 / METERS_PER_DEGREE * 1000, 44.4) - 1000) < 10
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pytest
+
+from gtfs_feed import FeedCache, assemble_feed, build_route_artifact, group_sessions, read_feed, validate_feed, write_feed
+from place_index import PlaceIndex
+
+METERS_PER_DEGREE = 111320
+# A straight line 2 km north from (33.30, 44.40)
+LINE = [(44.40, 33.30), (44.40, 33.30 + 1000 / METERS_PER_DEGREE), (44.40, 33.30 + 2000 / METERS_PER_DEGREE)]
+
+
+def stop(stop_id, north_m, east_m=0.0):
+    lat = 33.30 + north_m / METERS_PER_DEGREE
+    lon = 44.40 + east_m / (METERS_PER_DEGREE * 0.8358)
+    return [stop_id, f'Stop {stop_id}', 'Kia', f'{lat:.6f}', f'{lon:.6f}']
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = FeedCache(str(tmp_path / 'cache'))
+    places = PlaceIndex()
+    places.load_places([(1, 'Alawi'), (2, 'Bab Al-Sharqi')])
+    routes = group_sessions([
+        (10, 'Kia', 'Alawi', 'Bab Al-Sharqi', 1, 2, 1000),
+        (11, 'Kia', 'allawi', 'Bab Al-Sharqi', None, 2, 1500),
+    ], places)
+    (route,) = routes.values()
+    timings = {
+        # 2 km in 10 minutes, first fix at 05:00 UTC, 08:00 in Baghdad
+        10: (None, datetime(2024, 5, 1, 5, 0), datetime(2024, 5, 1, 5, 10)),
+        # No GPS times, starts at the session time at the default speed
+        11: (datetime(2024, 5, 1, 9, 30), None, None),
+    }
+    cache.put(route['route_id'], build_route_artifact(route, {10: LINE, 11: LINE}, timings))
+    return cache
+
+
+def test_stops_along_the_shape_are_timed_in_order(cache):
+    stops = [stop(1, 1500, 10), stop(2, 100, -5), stop(3, 1000, 200), stop(4, 3000)]
+    tables = assemble_feed(cache, stops, 'Agency', 'https://example.com', today=datetime(2024, 5, 1).date())
+    first_trip = [row for row in tables['stop_times.txt'] if row[0].endswith('-10')]
+    assert [row[3] for row in first_trip] == [2, 1]
+    assert [row[4] for row in first_trip] == [1, 2]
+    assert first_trip[0][1] == '08:00:30'
+    assert first_trip[1][1] == '08:07:30'
+    second_trip = [row for row in tables['stop_times.txt'] if row[0].endswith('-11')]
+    # 1.5 km at 20 km/h
+    assert second_trip[1][1] == '09:34:30'
+    assert validate_feed(tables) == ([], [])
+
+
+def test_trips_passing_fewer_than_two_stops_are_left_out(cache):
+    tables = assemble_feed(cache, [stop(1, 500), stop(2, 5000)], 'Agency', 'https://example.com')
+    assert tables['trips.txt'] == []
+    assert tables['routes.txt'] == []
+    assert tables['shapes.txt'] == []
+
+
+def test_written_feed_validates(cache, tmp_path):
+    path = str(tmp_path / 'gtfs.zip')
+    write_feed(assemble_feed(cache, [stop(1, 100), stop(2, 1900)], 'Agency', 'https://example.com'), path)
+    tables = read_feed(path)
+    assert len(tables['stop_times.txt']) == 4
+    assert validate_feed(tables) == ([], [])
+
+
+def test_missing_stop_times_is_an_error(cache):
+    tables = assemble_feed(cache, [stop(1, 100), stop(2, 1900)], 'Agency', 'https://example.com')
+    tables['stop_times.txt'] = []
+    errors, _ = validate_feed(tables)
+    assert 'stop_times.txt is empty' in errors
+
+
+def test_stop_times_going_backwards_is_an_error(cache):
+    tables = assemble_feed(cache, [stop(1, 100), stop(2, 1900)], 'Agency', 'https://example.com')
+    tables['stop_times.txt'][1][1] = tables['stop_times.txt'][1][2] = '07:00:00'
+    errors, _ = validate_feed(tables)
+    assert any('times go backwards' in error for error in errors)
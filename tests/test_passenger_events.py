@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from passenger_events import aggregate_hotspots, analyze_passenger_events
+
+START = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+METERS_PER_DEGREE = 111320
+
+
+def track(offsets_m, interval=1.0, times=True):
+    return [
+        {'lat': 33.3 + north / METERS_PER_DEGREE, 'lon': 44.4, 'time': START + timedelta(seconds=index * interval) if times else None}
+        for index, north in enumerate(offsets_m)
+    ]
+
+
+def waypoint(north_m, seconds=None, east_m=0.0):
+    return {
+        'lat': 33.3 + north_m / METERS_PER_DEGREE, 'lon': 44.4 + east_m / (METERS_PER_DEGREE * np.cos(np.radians(33.3))),
+        'time': START + timedelta(seconds=seconds) if seconds is not None else None,
+    }
+
+
+def test_snap_window_is_in_seconds():
+    # An out-and-back route passes the same place twice, one fix every 10 seconds
+    offsets = list(np.arange(0, 1000, 50.0)) + list(np.arange(1000, -1, -50.0))
+    tracks = track(offsets, interval=10)
+    # Boarded at 500 m on the way back, 330 seconds in, only fixes 300 to 360 seconds in count
+    events = analyze_passenger_events(tracks, [waypoint(505, 330)])
+    assert events[0]['distance_along_m'] == pytest.approx(1500, abs=2)
+    assert round(events[0]['snap_distance_m']) == 5
+
+
+def test_waypoint_far_from_any_fix_in_time_snaps_to_the_nearest_fix():
+    tracks = track(np.arange(0, 1000, 10.0))
+    events = analyze_passenger_events(tracks, [waypoint(420, 5000, east_m=3)])
+    assert events[0]['distance_along_m'] == pytest.approx(420, abs=2)
+    assert round(events[0]['snap_distance_m']) == 3
+
+
+def test_untimed_waypoints_snap_to_the_nearest_fix():
+    tracks = track(np.arange(0, 1000, 10.0), times=False)
+    events = analyze_passenger_events(tracks, [waypoint(733), waypoint(-50), waypoint(2000)])
+    assert [event['distance_along_m'] for event in events] == pytest.approx([730, 0, 990], abs=2)
+    assert all(event['dwell_seconds'] is None for event in events)
+
+
+def test_dwell_covers_the_stop_around_the_snapped_fix():
+    offsets = list(np.arange(0, 200, 10.0)) + [200.0] * 40 + list(np.arange(210, 400, 10.0))
+    events = analyze_passenger_events(track(offsets), [waypoint(200, 30)])
+    # From 30 m before the stop to 30 m after it
+    assert events[0]['dwell_seconds'] == (len(offsets) - 20 + 3) - (20 - 3)
+
+
+def test_hotspots_sum_events_per_cell():
+    tracks = track(np.arange(0, 300, 10.0))
+    events = analyze_passenger_events(tracks, [waypoint(10, 1), waypoint(20, 2), waypoint(250, 25)])
+    cells = aggregate_hotspots(events)
+    assert sorted(cell['event_count'] for cell in cells) == [1, 2]
+    assert sum(cell['sum_lat'] for cell in cells) == sum(event['snapped_lat'] for event in events)
@@ -0,0 +1,46 @@
+from place_index import PlaceIndex, phonetic_key
+
+
+def make_index():
+    index = PlaceIndex()
+    index.load_places([(1, 'Alawi'), (2, 'Bab Al-Sharqi'), (3, 'Karrada')])
+    index.load_aliases([(1, 'علاوي', 1), (2, 'الباب الشرقي', 2), (3, 'Orphan', 9)])
+    return index
+
+
+def test_phonetic_key_matches_arabic_and_latin_spellings():
+    assert phonetic_key('Alawi') == phonetic_key('allawi') == phonetic_key('Allawy')
+    assert phonetic_key('Al-Karrada') == phonetic_key('karada')
+    assert phonetic_key('  ') == ''
+
+
+def test_lookup_finds_exact_spellings():
+    index = make_index()
+    assert index.lookup('ALLAWI') == 1
+    assert index.lookup('علاوي') == 1
+    assert index.lookup('Mansour') is None
+
+
+def test_suggest_completes_prefixes_and_misspellings():
+    index = make_index()
+    assert index.suggest('Karr')[0][:2] == (3, 'Karrada')
+    assert index.suggest('Karradaa')[0][0] == 3
+    assert index.suggest('Bab Sharki')[0][0] == 2
+    assert index.suggest('Mansour') == []
+    assert index.suggest('') == []
+
+
+def test_exact_match_scores_above_prefix():
+    index = make_index()
+    index.load_places([(4, 'Bab')])
+    suggestions = index.suggest('Bab')
+    assert suggestions[0][:2] == (4, 'Bab')
+    assert suggestions[0][2] == 1.0
+
+
+def test_aliases_of_unknown_places_are_skipped():
+    index = make_index()
+    assert index.lookup('Orphan') is None
+    assert index.last_place_id == 3
+    assert index.last_alias_id == 3
+    assert len(index) == 3
@@ -0,0 +1,169 @@
+import threading
+
+import pytest
+
+import query_api
+from query_api import QueryApi, ResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(query_api.time, 'monotonic', clock)
+    return clock
+
+
+def test_cache_returns_stored_body(clock):
+    cache = ResponseCache(ttl=60)
+    cache.put('/routes?a', cache.generation, b'body')
+    assert cache.get('/routes?a') == b'body'
+    assert cache.get('/routes?b') is None
+
+
+def test_cache_expires_after_ttl(clock):
+    cache = ResponseCache(ttl=60)
+    cache.put('/routes?a', cache.generation, b'body')
+    clock.now += 59
+    assert cache.get('/routes?a') == b'body'
+    clock.now += 2
+    assert cache.get('/routes?a') is None
+
+
+def test_invalidate_drops_entries_and_rejects_stale_puts(clock):
+    cache = ResponseCache(ttl=60)
+    generation = cache.generation
+    cache.put('/routes?a', generation, b'old')
+    cache.invalidate()
+    assert cache.get('/routes?a') is None
+    # Computed before the invalidation arrived
+    cache.put('/routes?a', generation, b'stale')
+    assert cache.get('/routes?a') is None
+    cache.put('/routes?a', cache.generation, b'new')
+    assert cache.get('/routes?a') == b'new'
+
+
+def test_etag_changes_with_generation():
+    cache = ResponseCache(ttl=60)
+    assert cache.etag('/routes?a', 0) == cache.etag('/routes?a', 0)
+    assert cache.etag('/routes?a', 0) != cache.etag('/routes?a', 1)
+    assert cache.etag('/routes?a', 0) != ResponseCache(ttl=60).etag('/routes?a', 0)
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = ResponseCache(max_entries=2, ttl=60, max_entry_bytes=4)
+    cache.put('a', 0, b'1')
+    cache.put('b', 0, b'2')
+    cache.get('a')
+    cache.put('c', 0, b'3')
+    cache.put('d', 0, b'too long')
+    assert cache.get('a') == b'1'
+    assert cache.get('b') is None
+    assert cache.get('c') == b'3'
+    assert cache.get('d') is None
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.itersize = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, params):
+        if self.conn.error:
+            raise self.conn.error
+
+    def __iter__(self):
+        return iter(self.conn.rows)
+
+
+class FakeConnection:
+    readonly = True
+
+    def __init__(self, rows=(), error=None):
+        self.rows = rows
+        self.error = error
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, conn, maxconn=1):
+        self.conn = conn
+        self.maxconn = maxconn
+        self.out = 0
+
+    def getconn(self):
+        if self.out >= self.maxconn:
+            raise AssertionError("pool exhausted")
+        self.out += 1
+        return self.conn
+
+    def putconn(self, conn):
+        self.out -= 1
+
+
+def test_routes_query_errors_come_before_the_first_chunk():
+    pool = FakePool(FakeConnection(error=RuntimeError("canceling statement due to statement timeout")))
+    chunks = QueryApi(pool).routes({'bbox': ['44,33,45,34']})
+    with pytest.raises(RuntimeError):
+        next(chunks)
+    assert pool.out == 0
+
+
+def test_routes_streams_a_feature_collection():
+    row = ('s1', 'Kia', 'a', 'b', '2024-01-01', '{"type":"LineString","coordinates":[[44.4,33.3],[44.5,33.4]]}')
+    pool = FakePool(FakeConnection(rows=[row, row]))
+    body = b''.join(QueryApi(pool).routes({'bbox': ['44,33,45,34']}))
+    assert body.startswith(b'{"type":"FeatureCollection","features":[{"type":"Feature"')
+    assert body.count(b'"session_id":"s1"') == 2
+    assert pool.out == 0
+    assert b''.join(QueryApi(FakePool(FakeConnection())).routes({'bbox': ['44,33,45,34']})) == b'{"type":"FeatureCollection","features":[]}'
+
+
+def test_requests_wait_for_a_free_connection():
+    row = ('s1', 'Kia', 'a', 'b', '2024-01-01', '{}')
+    pool = FakePool(FakeConnection(rows=[row]))
+    api = QueryApi(pool, wait_timeout=5)
+    held = api.routes({'bbox': ['44,33,45,34']})
+    next(held)
+
+    done = threading.Event()
+
+    def second():
+        b''.join(api.routes({'bbox': ['44,33,45,34']}))
+        done.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not done.wait(0.1)
+    held.close()
+    assert done.wait(5)
+    thread.join()
+    assert pool.out == 0
+
+
+def test_busy_pool_times_out():
+    pool = FakePool(FakeConnection(rows=[('s1', 'Kia', 'a', 'b', '2024-01-01', '{}')]))
+    api = QueryApi(pool, wait_timeout=0.05)
+    held = api.routes({'bbox': ['44,33,45,34']})
+    next(held)
+    with pytest.raises(TimeoutError):
+        next(api.routes({'bbox': ['44,33,45,34']}))
+    held.close()
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from telegram.ext import ExtBot
+
+from send_scheduler import PRIORITIES, PRIORITY_CONFIRMATION, PRIORITY_INFO, PRIORITY_PROMPT, FloodControlRateLimiter
+
+
+def test_priorities_survive_extbot():
+    # ExtBot drops falsy rate_limit_args, so a zero priority would reach the limiter as None
+    for priority in PRIORITIES:
+        data = ExtBot._merge_api_rl_kwargs({}, priority)
+        assert ExtBot._extract_rl_kwargs(dict(data)) == priority
+
+
+def test_requests_are_sent_in_priority_order():
+    sent = []
+
+    async def run():
+        limiter = FloodControlRateLimiter()
+        await limiter.initialize()
+        # Hold the dispatcher until every request is queued
+        limiter._paused_until = time.monotonic() + 0.05
+
+        def request(name):
+            async def callback():
+                sent.append(name)
+                return name
+            return callback
+
+        results = await asyncio.gather(
+            limiter.process_request(request('info'), (), {}, 'sendMessage', {'chat_id': 1}, PRIORITY_INFO),
+            limiter.process_request(request('unspecified'), (), {}, 'sendMessage', {'chat_id': 2}, None),
+            limiter.process_request(request('prompt'), (), {}, 'sendMessage', {'chat_id': 3}, PRIORITY_PROMPT),
+            limiter.process_request(request('confirmation'), (), {}, 'sendMessage', {'chat_id': 4}, PRIORITY_CONFIRMATION),
+        )
+        await limiter.shutdown()
+        return results
+
+    assert asyncio.run(run()) == ['info', 'unspecified', 'prompt', 'confirmation']
+    assert sent == ['confirmation', 'unspecified', 'prompt', 'info']
+
+
+def test_superseded_edits_are_coalesced():
+    sent = []
+
+    async def run():
+        limiter = FloodControlRateLimiter()
+        await limiter.initialize()
+        limiter._paused_until = time.monotonic() + 0.05
+
+        def edit(text):
+            async def callback():
+                sent.append(text)
+                return text
+            return callback
+
+        data = {'chat_id': 1, 'message_id': 7}
+        results = await asyncio.gather(
+            limiter.process_request(edit('first'), (), {}, 'editMessageText', data, PRIORITY_PROMPT),
+            limiter.process_request(edit('second'), (), {}, 'editMessageText', data, PRIORITY_PROMPT),
+        )
+        await limiter.shutdown()
+        return results
+
+    assert asyncio.run(run()) == ['second', 'second']
+    assert sent == ['second']
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from psycopg2 import extras
+
+import coverage_grid
+import passenger_events
+import speed_profiles
+from coverage_grid import remove_coverage, save_coverage
+from passenger_events import analyze_passenger_events, remove_hotspots, save_hotspots
+from speed_profiles import remove_speed_profile, save_speed_profile
+from trip_storage import read_session_tracks, recorded_at
+
+START = datetime(2024, 5, 1, 5, 0, tzinfo=timezone.utc)
+METERS_PER_DEGREE = 111320
+
+
+class AggregateCursor:
+    # Runs the aggregate statements against dicts keyed like the tables' primary keys, and serves stored
+    # points to read_session_tracks
+    def __init__(self):
+        self.coverage = {}
+        self.speeds = {}
+        self.hotspots = {}
+        self.route_points = {}
+        self.trip_points = {}
+        self.rows = []
+
+    def execute(self, query, params):
+        if query == coverage_grid.UPSERT_QUERY:
+            level, cell_x, cell_y, *counts, last_seen = params
+            self._add(self.coverage, (level, cell_x, cell_y), [counts[0], 1, *counts[1:]])
+        elif query == coverage_grid.SUBTRACT_QUERY:
+            point_count, *vehicles, level, cell_x, cell_y = params
+            self._add(self.coverage, (level, cell_x, cell_y), [-point_count, -1, *(-value for value in vehicles)])
+        elif query == coverage_grid.DELETE_EMPTY_QUERY:
+            self._delete_empty(self.coverage, params, 1)
+        elif query == speed_profiles.UPSERT_QUERY:
+            *key, segment_count, distance, seconds, speed_sum, speed_sq_sum, last_seen = params
+            self._add(self.speeds, tuple(key), [segment_count, 1, distance, seconds, speed_sum, speed_sq_sum])
+        elif query == speed_profiles.SUBTRACT_QUERY:
+            segment_count, distance, seconds, speed_sum, speed_sq_sum, *key = params
+            self._add(self.speeds, tuple(key), [-segment_count, -1, -distance, -seconds, -speed_sum, -speed_sq_sum])
+        elif query == speed_profiles.DELETE_EMPTY_QUERY:
+            self._delete_empty(self.speeds, params, 1)
+        elif query == passenger_events.HOTSPOT_UPSERT_QUERY:
+            cell_x, cell_y, event_count, dwell, sum_lat, sum_lon = params
+            self._add(self.hotspots, (cell_x, cell_y), [event_count, 1, dwell, sum_lat, sum_lon])
+        elif query == passenger_events.HOTSPOT_SUBTRACT_QUERY:
+            event_count, dwell, sum_lat, sum_lon, cell_x, cell_y = params
+            self._add(self.hotspots, (cell_x, cell_y), [-event_count, -1, -dwell, -sum_lat, -sum_lon])
+        elif query == passenger_events.HOTSPOT_DELETE_EMPTY_QUERY:
+            self._delete_empty(self.hotspots, params, 1)
+        elif 'FROM route_points' in query:
+            self.rows = self.route_points.get(params[0], [])
+        elif 'FROM bus_trips' in query:
+            self.rows = self.trip_points.get(params[1:], [])
+        else:
+            raise AssertionError(f"unexpected query {query}")
+
+    def fetchall(self):
+        return self.rows
+
+    def _add(self, table, key, values):
+        table[key] = [total + value for total, value in zip(table.get(key, [0] * len(values)), values)]
+
+    def _delete_empty(self, table, key, session_count_column):
+        if tuple(key) in table and table[tuple(key)][session_count_column] <= 0:
+            del table[tuple(key)]
+
+    def snapshot(self):
+        return {name: {key: list(values) for key, values in table.items()} for name, table in
+                (('coverage', self.coverage), ('speeds', self.speeds), ('hotspots', self.hotspots))}
+
+
+@pytest.fixture(autouse=True)
+def execute_one_by_one(monkeypatch):
+    monkeypatch.setattr(extras, 'execute_batch', lambda cur, query, rows: [cur.execute(query, row) for row in rows])
+
+
+def trip(east_m, north_m, start):
+    rng = np.random.default_rng(int(east_m))
+    steps = np.cumsum(rng.uniform(3, 12, 400))
+    tracks = [
+        {'lat': 33.3 + (north_m + step) / METERS_PER_DEGREE, 'lon': 44.4 + east_m / 93000, 'time': start + timedelta(seconds=index)}
+        for index, step in enumerate(steps)
+    ]
+    waypoints = [dict(tracks[index], lat=tracks[index]['lat'] + 0.00003) for index in (10, 200, 390)]
+    return tracks, waypoints
+
+
+def ingest(cur, vehicle_type, tracks, waypoints):
+    last_seen = max(recorded_at(point) for point in tracks if point['time'] is not None)
+    save_coverage(cur, vehicle_type, tracks, last_seen)
+    save_speed_profile(cur, tracks, last_seen)
+    events = analyze_passenger_events(tracks, waypoints)
+    save_hotspots(cur, events)
+    # The passenger_events columns cancel_session reads back
+    return [{field: event[field] for field in ('cell_x', 'cell_y', 'dwell_seconds', 'snapped_lat', 'snapped_lon')} for event in events]
+
+
+def cancel(cur, vehicle_type, session_ref, user_id, session_id, events):
+    tracks = read_session_tracks(cur, session_ref, user_id, session_id)
+    remove_coverage(cur, vehicle_type, tracks)
+    remove_speed_profile(cur, tracks)
+    remove_hotspots(cur, events)
+
+
+def assert_same(before, after):
+    assert {name: sorted(table) for name, table in after.items()} == {name: sorted(table) for name, table in before.items()}
+    for name, table in before.items():
+        for key, values in table.items():
+            assert after[name][key] == pytest.approx(values, abs=1e-6)
+
+
+def test_canceling_a_point_session_restores_the_aggregates():
+    cur = AggregateCursor()
+    # An earlier trip on an overlapping road, its counts have to stay
+    ingest(cur, 'Kia', *trip(0, -500, START))
+    before = cur.snapshot()
+
+    tracks, waypoints = trip(0, 0, START + timedelta(hours=3))
+    events = ingest(cur, 'Bus', tracks, waypoints)
+    assert cur.snapshot() != before
+    # Stored in route_points as naive UTC times
+    cur.route_points[7] = [(recorded_at(point), point['lat'], point['lon']) for point in tracks]
+    cancel(cur, 'Bus', 7, 1, 's1', events)
+
+    assert_same(before, cur.snapshot())
+
+
+def test_canceling_a_trip_session_restores_the_aggregates():
+    cur = AggregateCursor()
+    ingest(cur, 'Coaster', *trip(0, -500, START))
+    before = cur.snapshot()
+
+    tracks, waypoints = trip(0, 0, START + timedelta(hours=1))
+    tracks[5]['time'] = None
+    events = ingest(cur, 'Kia', tracks, waypoints)
+    # Stored as the M values of the bus_trips track, epoch seconds or MISSING_TIME_M made NULL
+    cur.trip_points[(1, 's2')] = [
+        (point['time'].timestamp() if point['time'] is not None else None, point['lat'], point['lon']) for point in tracks
+    ]
+    cancel(cur, 'Kia', 8, 1, 's2', events)
+
+    assert_same(before, cur.snapshot())
+
+
+def test_read_session_tracks():
+    cur = AggregateCursor()
+    cur.route_points[1] = [(datetime(2024, 5, 1, 8, 0), 33.3, 44.4)]
+    cur.trip_points[(2, 't')] = [(1714550400.5, 33.4, 44.5), (None, 33.5, 44.6)]
+    assert read_session_tracks(cur, 1, 2, 'r') == [{'lat': 33.3, 'lon': 44.4, 'time': datetime(2024, 5, 1, 8, 0)}]
+    assert read_session_tracks(cur, 2, 2, 't') == [
+        {'lat': 33.4, 'lon': 44.5, 'time': datetime(2024, 5, 1, 8, 0, 0, 500000, tzinfo=timezone.utc)},
+        {'lat': 33.5, 'lon': 44.6, 'time': None},
+    ]
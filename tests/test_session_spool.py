@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import session_spool
+from session_spool import SessionSpool
+
+
+def append_sessions(spool, count):
+    return [spool.append({'user_id': 1, 'session_id': f's{index}'}) for index in range(count)]
+
+
+def test_records_are_drained_in_order(tmp_path):
+    spool = SessionSpool(str(tmp_path))
+    keys = append_sessions(spool, 3)
+    records = spool.pending(2)
+    assert [record['idempotency_key'] for _, record in records] == keys[:2]
+    spool.mark_drained(records[-1][0])
+    records = spool.pending()
+    assert [record['session_id'] for _, record in records] == ['s2']
+    spool.mark_drained(records[-1][0])
+    assert not os.path.exists(spool.journal_path)
+    assert spool.pending() == []
+    assert spool.size() == 0
+
+
+def test_torn_frame_is_cut_off_on_open(tmp_path):
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 2)
+    size = os.path.getsize(spool.journal_path)
+    # A crash in the middle of the third append
+    spool.append({'user_id': 1, 'session_id': 'torn'})
+    with open(spool.journal_path, 'r+b') as journal:
+        journal.truncate(size + 20)
+
+    spool = SessionSpool(str(tmp_path))
+    assert os.path.getsize(spool.journal_path) == size
+    spool.append({'user_id': 1, 'session_id': 'after'})
+    assert [record['session_id'] for _, record in spool.pending()] == ['s0', 's1', 'after']
+
+
+def test_corrupt_checksum_is_cut_off_on_open(tmp_path):
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 2)
+    with open(spool.journal_path, 'r+b') as journal:
+        journal.seek(-1, os.SEEK_END)
+        journal.write(b'\xff')
+
+    spool = SessionSpool(str(tmp_path))
+    spool.append({'user_id': 1, 'session_id': 'after'})
+    assert [record['session_id'] for _, record in spool.pending()] == ['s0', 'after']
+
+
+def test_short_writes_are_completed(tmp_path, monkeypatch):
+    write = os.write
+    monkeypatch.setattr(session_spool.os, 'write', lambda fd, data: write(fd, bytes(data[:7])))
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 2)
+    monkeypatch.undo()
+    assert [record['session_id'] for _, record in SessionSpool(str(tmp_path)).pending()] == ['s0', 's1']
+
+
+def test_failed_append_leaves_no_partial_frame(tmp_path, monkeypatch):
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 1)
+    write = os.write
+    calls = []
+
+    def failing_write(fd, data):
+        if calls:
+            raise OSError("No space left on device")
+        calls.append(fd)
+        return write(fd, bytes(data[:5]))
+
+    monkeypatch.setattr(session_spool.os, 'write', failing_write)
+    with pytest.raises(OSError):
+        spool.append({'user_id': 1, 'session_id': 'failed'})
+    monkeypatch.undo()
+    spool.append({'user_id': 1, 'session_id': 'after'})
+    assert [record['session_id'] for _, record in spool.pending()] == ['s0', 'after']
+
+
+def test_offset_is_reset_before_the_journal_is_removed(tmp_path, monkeypatch):
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 2)
+    records = spool.pending()
+
+    def crash(path):
+        raise KeyboardInterrupt
+
+    # A crash between resetting the offset and removing the journal replays it from the start
+    monkeypatch.setattr(session_spool.os, 'remove', crash)
+    with pytest.raises(KeyboardInterrupt):
+        spool.mark_drained(records[-1][0])
+    monkeypatch.undo()
+    spool = SessionSpool(str(tmp_path))
+    assert [record['idempotency_key'] for _, record in spool.pending()] == [record['idempotency_key'] for _, record in records]
+
+
+def test_offset_past_the_journal_starts_from_the_beginning(tmp_path):
+    spool = SessionSpool(str(tmp_path))
+    append_sessions(spool, 1)
+    spool._write_offset(10 ** 6)
+    spool = SessionSpool(str(tmp_path))
+    assert [record['session_id'] for _, record in spool.pending()] == ['s0']
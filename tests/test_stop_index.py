@@ -0,0 +1,18 @@
+from stop_index import StopIndex
+
+
+def test_nearby_returns_stops_within_the_radius_nearest_first():
+    index = StopIndex()
+    index.load([(1, 33.3000, 44.4000, 'Bab'), (2, 33.3002, 44.4000, 'Alawi'), (3, 33.3100, 44.4000, 'Karrada')])
+    matches = index.nearby(33.30005, 44.4000, 30)
+    assert [stop['id'] for _, stop in matches] == [1, 2]
+    assert index.nearby(33.3001, 44.4000, 5) == []
+
+
+def test_sync_drops_stops_canceled_elsewhere_and_reports_new_ones():
+    index = StopIndex()
+    index.load([(1, 33.3, 44.4, 'Bab'), (2, 33.3001, 44.4, 'Alawi')])
+    missing = index.sync([2, 5])
+    assert missing == {5}
+    assert len(index) == 1
+    assert [stop['id'] for _, stop in index.nearby(33.3, 44.4, 50)] == [2]
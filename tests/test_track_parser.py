@@ -0,0 +1,146 @@
+import gzip
+import json
+import struct
+import zipfile
+from datetime import datetime, timezone
+
+import pytest
+
+from track_parser import FIT_EPOCH, _parse_time, detect_track_format, read_track_file, track_file_suffix
+
+GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+  <wpt lat="33.3100" lon="44.4100"><time>2024-05-01T08:00:30Z</time></wpt>
+  <trk><trkseg>
+    <trkpt lat="33.3000" lon="44.4000"><time>2024-05-01T08:00:00Z</time></trkpt>
+    <trkpt lat="33.3010" lon="44.4010"><time>2024-05-01T08:01:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>
+"""
+
+KML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">
+  <Document>
+    <Placemark>
+      <gx:Track>
+        <when>2024-05-01T08:00:00Z</when>
+        <when>2024-05-01T08:01:00Z</when>
+        <gx:coord>44.4000 33.3000 0</gx:coord>
+        <gx:coord>44.4010 33.3010 0</gx:coord>
+      </gx:Track>
+    </Placemark>
+    <Placemark>
+      <LineString><coordinates>44.5,33.5,0 44.6,33.6,0</coordinates></LineString>
+    </Placemark>
+    <Placemark>
+      <TimeStamp><when>2024-05-01T08:00:30Z</when></TimeStamp>
+      <Point><coordinates>44.41,33.31,0</coordinates></Point>
+    </Placemark>
+  </Document>
+</kml>
+"""
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def fit_file(points):
+    # One definition for record messages with timestamp, latitude and longitude, then one data message per point
+    records = bytes([0x40, 0, 0]) + struct.pack('<HB', 20, 3) + bytes([253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85])
+    for time, lat, lon in points:
+        records += bytes([0x00]) + struct.pack(
+            '<Iii', int((time - FIT_EPOCH).total_seconds()), round(lat / 180 * 2 ** 31), round(lon / 180 * 2 ** 31)
+        )
+    header = struct.pack('<BBHI4sH', 14, 0x10, 2100, len(records), b'.FIT', 0)
+    return header + records + b'\x00\x00'
+
+
+def test_gpx_tracks_and_waypoints(tmp_path):
+    data = read_track_file(write(tmp_path, 'route.gpx', GPX))
+    assert [(point['lat'], point['lon']) for point in data['tracks']] == [(33.3, 44.4), (33.301, 44.401)]
+    assert data['tracks'][1]['time'] == datetime(2024, 5, 1, 8, 1, tzinfo=timezone.utc)
+    assert [(point['lat'], point['lon'], point['type']) for point in data['waypoints']] == [(33.31, 44.41, 'passenger_on_off')]
+
+
+def test_gzipped_gpx_is_detected_from_its_content(tmp_path):
+    # Saved without the .gz suffix, as the bot stores uploads
+    data = read_track_file(write(tmp_path, 'route.gpx', gzip.compress(GPX)))
+    assert len(data['tracks']) == 2
+    assert len(data['waypoints']) == 1
+
+
+def test_kml_track_line_and_point(tmp_path):
+    data = read_track_file(write(tmp_path, 'route.kml', KML))
+    assert [(point['lat'], point['lon']) for point in data['tracks']] == [(33.3, 44.4), (33.301, 44.401), (33.5, 44.5), (33.6, 44.6)]
+    assert data['tracks'][0]['time'] == datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+    assert data['tracks'][2]['time'] is None
+    assert data['waypoints'] == [
+        {'lat': 33.31, 'lon': 44.41, 'time': datetime(2024, 5, 1, 8, 0, 30, tzinfo=timezone.utc), 'type': 'passenger_on_off'}
+    ]
+
+
+def test_kmz(tmp_path):
+    path = tmp_path / 'route.kmz'
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('doc.kml', KML)
+    data = read_track_file(str(path))
+    assert len(data['tracks']) == 4
+    assert len(data['waypoints']) == 1
+
+
+def test_geojson_coord_times(tmp_path):
+    document = {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'LineString', 'coordinates': [[44.4, 33.3], [44.401, 33.301]]},
+                'properties': {'coordTimes': ['2024-05-01T08:00:00Z', '2024-05-01T08:01:00.5Z']},
+            },
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [44.41, 33.31]},
+                'properties': {'time': 1714550430000},
+            },
+        ],
+    }
+    data = read_track_file(write(tmp_path, 'route.geojson', json.dumps(document).encode()))
+    assert [(point['lat'], point['lon']) for point in data['tracks']] == [(33.3, 44.4), (33.301, 44.401)]
+    assert data['tracks'][1]['time'] == datetime(2024, 5, 1, 8, 1, 0, 500000, tzinfo=timezone.utc)
+    assert data['waypoints'][0]['time'] == datetime(2024, 5, 1, 8, 0, 30, tzinfo=timezone.utc)
+
+
+def test_fit_records(tmp_path):
+    start = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+    data = read_track_file(write(tmp_path, 'route.fit', fit_file([(start, 33.3, 44.4), (start.replace(minute=1), 33.301, 44.401)])))
+    assert [point['time'] for point in data['tracks']] == [start, start.replace(minute=1)]
+    assert data['tracks'][1]['lat'] == pytest.approx(33.301, abs=1e-6)
+    assert data['tracks'][1]['lon'] == pytest.approx(44.401, abs=1e-6)
+
+
+def test_parse_time():
+    utc = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+    assert _parse_time('2024-05-01T08:00:00') == utc
+    assert _parse_time('2024-05-01T08:00:00Z') == utc
+    assert _parse_time('2024-05-01T11:00:00+03:00') == utc
+    assert _parse_time('2024-05-01T08:00:00.1234567Z') == utc.replace(microsecond=123456)
+    assert _parse_time(1714550400) == utc
+    assert _parse_time(1714550400000) == utc
+    assert _parse_time('') is None
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        detect_track_format(b'hello')
+    with pytest.raises(ValueError):
+        read_track_file(write(tmp_path, 'notes.gpx', b'hello'))
+
+
+def test_track_file_suffix():
+    assert track_file_suffix('Route.GPX.GZ') == '.gpx.gz'
+    assert track_file_suffix('route.kmz') == '.kmz'
+    assert track_file_suffix('route.txt') == '.gpx'
+    assert track_file_suffix(None) == '.gpx'
@@ -0,0 +1,95 @@
+import gzip
+import sqlite3
+
+import pytest
+
+import vector_tiles
+from vector_tiles import MBTiles, regenerate_dirty_tiles, tiles_for_line, tiles_for_point
+
+
+def test_tiles_for_line_covers_every_zoom_level():
+    tiles = tiles_for_line([(44.36, 33.31), (44.42, 33.33)])
+    assert {zoom for zoom, _, _ in tiles} == set(range(vector_tiles.MIN_ZOOM, vector_tiles.MAX_ZOOM + 1))
+    assert tiles_for_point(44.36, 33.31) <= tiles
+    assert tiles_for_line([]) == set()
+
+
+def test_mbtiles_round_trip_closes_its_connections(tmp_path, monkeypatch):
+    opened = []
+    connect = sqlite3.connect
+
+    class TrackedConnection(sqlite3.Connection):
+        def close(self):
+            opened.remove(self)
+            super().close()
+
+    def tracked_connect(*args, **kwargs):
+        db = connect(*args, factory=TrackedConnection, **kwargs)
+        opened.append(db)
+        return db
+
+    monkeypatch.setattr(vector_tiles.sqlite3, 'connect', tracked_connect)
+    mbtiles = MBTiles(str(tmp_path / 'tiles.mbtiles'))
+    mbtiles.put_many([((12, 2600, 1620), b'tile'), ((12, 2601, 1620), b'')])
+    assert gzip.decompress(mbtiles.get(12, 2600, 1620)) == b'tile'
+    assert mbtiles.get(12, 2601, 1620) is None
+    mbtiles.put_many([((12, 2600, 1620), b'')])
+    assert mbtiles.get(12, 2600, 1620) is None
+    assert opened == []
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, params):
+        if 'DELETE FROM dirty_tiles' in query:
+            self.result = [self.conn.queue.pop(0)] if self.conn.queue else []
+        else:
+            if self.conn.fail_render:
+                raise RuntimeError("canceling statement due to statement timeout")
+            self.result = [(b'rendered',)]
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0]
+
+
+class FakeConnection:
+    def __init__(self, queue, fail_render=False):
+        self.queue = list(queue)
+        self.fail_render = fail_render
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def test_claimed_tiles_are_rendered(tmp_path):
+    mbtiles = MBTiles(str(tmp_path / 'tiles.mbtiles'))
+    conn = FakeConnection([(12, 2600, 1620), (12, 2601, 1620)])
+    assert regenerate_dirty_tiles(conn, mbtiles, batch_size=1) == 2
+    assert gzip.decompress(mbtiles.get(12, 2601, 1620)) == b'rendered'
+
+
+def test_failed_batch_goes_back_into_the_queue(tmp_path, monkeypatch):
+    requeued = []
+    monkeypatch.setattr(vector_tiles, 'mark_tiles_dirty', lambda cur, tiles: requeued.extend(tiles))
+    conn = FakeConnection([(12, 2600, 1620)], fail_render=True)
+    with pytest.raises(RuntimeError):
+        regenerate_dirty_tiles(conn, MBTiles(str(tmp_path / 'tiles.mbtiles')))
+    assert requeued == [(12, 2600, 1620)]
@@ -0,0 +1,268 @@
+import gzip
+import json
+import re
+import struct
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+
+import gpxpy
+
+# Upload extensions accepted by the bot, compressed variants are detected from the content
+TRACK_EXTENSIONS = [
+    'gpx', 'gpx.gz', 'kml', 'kml.gz', 'kmz', 'geojson', 'geojson.gz', 'json', 'fit', 'fit.gz'
+]
+
+FIT_EPOCH = datetime(1989, 12, 31, tzinfo=timezone.utc)
+FIT_RECORD_MESSAGE = 20
+FIT_SEMICIRCLES = 180 / 2 ** 31
+
+
+def _track_point(lat, lon, time):
+    return {'lat': lat, 'lon': lon, 'time': time, 'type': 'bus_routing'}
+
+
+def _waypoint(lat, lon, time):
+    return {'lat': lat, 'lon': lon, 'time': time, 'type': 'passenger_on_off'}
+
+
+def _parse_time(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        # Epoch seconds, or milliseconds as written by most JavaScript exporters
+        return datetime.fromtimestamp(value / 1000 if value > 1e11 else value, tz=timezone.utc)
+    value = value.strip().replace('Z', '+00:00')
+    # Python 3.10 only accepts 3 or 6 fractional digits
+    value = re.sub(r'\.(\d+)', lambda match: '.' + match.group(1)[:6].ljust(6, '0'), value)
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_gpx(stream):
+    gpx = gpxpy.parse(stream)
+    for track in gpx.tracks:
+        for segment in track.segments:
+            for point in segment.points:
+                yield _track_point(point.latitude, point.longitude, point.time)
+    for waypoint in gpx.waypoints:
+        yield _waypoint(waypoint.latitude, waypoint.longitude, waypoint.time)
+
+
+def iter_kml(stream):
+    # Placemarks are handled and freed one at a time so large exports are never held in memory
+    for event, element in ET.iterparse(stream, events=('end',)):
+        if _local_name(element.tag) != 'Placemark':
+            continue
+        placemark_time = None
+        for child in element:
+            if _local_name(child.tag) == 'TimeStamp':
+                for item in child:
+                    if _local_name(item.tag) == 'when':
+                        placemark_time = item.text
+        for child in element.iter():
+            tag = _local_name(child.tag)
+            if tag == 'Track':
+                whens = [item.text for item in child if _local_name(item.tag) == 'when']
+                coords = [item.text for item in child if _local_name(item.tag) == 'coord']
+                for when, coord in zip(whens, coords):
+                    lon, lat = coord.split()[:2]
+                    yield _track_point(float(lat), float(lon), _parse_time(when))
+            elif tag == 'LineString':
+                for item in child:
+                    if _local_name(item.tag) == 'coordinates' and item.text:
+                        for coord in item.text.split():
+                            lon, lat = coord.split(',')[:2]
+                            yield _track_point(float(lat), float(lon), None)
+            elif tag == 'Point':
+                for item in child:
+                    if _local_name(item.tag) == 'coordinates' and item.text:
+                        lon, lat = item.text.strip().split(',')[:2]
+                        yield _waypoint(float(lat), float(lon), _parse_time(placemark_time))
+        element.clear()
+
+
+def _geojson_line(coordinates, times):
+    for index, coord in enumerate(coordinates):
+        if times is not None and index < len(times):
+            time = _parse_time(times[index])
+        elif len(coord) > 3:
+            time = _parse_time(coord[3])
+        else:
+            time = None
+        yield _track_point(coord[1], coord[0], time)
+
+
+def _iter_geojson_geometry(geometry, properties):
+    geometry_type = geometry.get('type')
+    times = properties.get('coordTimes') or properties.get('times')
+    if geometry_type == 'LineString':
+        yield from _geojson_line(geometry['coordinates'], times)
+    elif geometry_type == 'MultiLineString':
+        for index, line in enumerate(geometry['coordinates']):
+            line_times = times[index] if times and isinstance(times[0], list) else None
+            yield from _geojson_line(line, line_times)
+    elif geometry_type == 'Point':
+        coord = geometry['coordinates']
+        time = properties.get('time') or properties.get('timestamp')
+        yield _waypoint(coord[1], coord[0], _parse_time(time))
+    elif geometry_type == 'GeometryCollection':
+        for item in geometry['geometries']:
+            yield from _iter_geojson_geometry(item, properties)
+
+
+def iter_geojson(stream):
+    document = json.load(stream)
+    if document.get('type') == 'FeatureCollection':
+        features = document['features']
+    elif document.get('type') == 'Feature':
+        features = [document]
+    else:
+        features = [{'geometry': document, 'properties': {}}]
+    for feature in features:
+        if feature.get('geometry'):
+            yield from _iter_geojson_geometry(feature['geometry'], feature.get('properties') or {})
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated FIT file")
+    return data
+
+
+def iter_fit(stream):
+    header_size = _read_exact(stream, 1)[0]
+    header = _read_exact(stream, header_size - 1)
+    data_size = struct.unpack('<I', header[3:7])[0]
+    if header[7:11] != b'.FIT':
+        raise ValueError("Not a FIT file")
+
+    definitions = {}
+    last_timestamp = None
+    consumed = 0
+    while consumed < data_size:
+        record_header = _read_exact(stream, 1)[0]
+        consumed += 1
+
+        if record_header & 0x80:
+            # Compressed timestamp header, always a data message
+            local_type = (record_header >> 5) & 0x03
+            time_offset = record_header & 0x1F
+            if last_timestamp is not None:
+                timestamp = (last_timestamp & ~0x1F) + time_offset
+                if time_offset < (last_timestamp & 0x1F):
+                    timestamp += 0x20
+                last_timestamp = timestamp
+            is_definition = False
+        else:
+            local_type = record_header & 0x0F
+            is_definition = bool(record_header & 0x40)
+
+        if is_definition:
+            fixed = _read_exact(stream, 5)
+            endian = '>' if fixed[1] == 1 else '<'
+            global_number = struct.unpack(endian + 'H', fixed[2:4])[0]
+            fields = [struct.unpack('BBB', _read_exact(stream, 3)) for _ in range(fixed[4])]
+            consumed += 5 + 3 * len(fields)
+            developer_size = 0
+            if record_header & 0x20:
+                developer_count = _read_exact(stream, 1)[0]
+                developer_fields = [struct.unpack('BBB', _read_exact(stream, 3)) for _ in range(developer_count)]
+                developer_size = sum(size for _, size, _ in developer_fields)
+                consumed += 1 + 3 * developer_count
+            definitions[local_type] = (endian, global_number, fields, developer_size)
+            continue
+
+        if local_type not in definitions:
+            raise ValueError("FIT data message without definition")
+        endian, global_number, fields, developer_size = definitions[local_type]
+        values = {}
+        for number, size, base_type in fields:
+            raw = _read_exact(stream, size)
+            consumed += size
+            if size == 4 and number in (0, 1):
+                values[number] = struct.unpack(endian + 'i', raw)[0]
+            elif size == 4 and number == 253:
+                values[number] = struct.unpack(endian + 'I', raw)[0]
+        if developer_size:
+            _read_exact(stream, developer_size)
+            consumed += developer_size
+
+        if 253 in values:
+            last_timestamp = values[253]
+        if global_number != FIT_RECORD_MESSAGE:
+            continue
+        lat, lon = values.get(0), values.get(1)
+        if lat is None or lon is None or lat == 0x7FFFFFFF or lon == 0x7FFFFFFF:
+            continue
+        time = FIT_EPOCH + timedelta(seconds=last_timestamp) if last_timestamp is not None else None
+        yield _track_point(lat * FIT_SEMICIRCLES, lon * FIT_SEMICIRCLES, time)
+
+
+def detect_track_format(head):
+    if head[8:12] == b'.FIT':
+        return 'fit'
+    if head.startswith(b'PK\x03\x04'):
+        return 'kmz'
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'{'):
+        return 'geojson'
+    if b'<gpx' in head:
+        return 'gpx'
+    if b'<kml' in head:
+        return 'kml'
+    raise ValueError("Unsupported track file format")
+
+
+def _open_track_stream(file_path):
+    with open(file_path, 'rb') as raw:
+        magic = raw.read(2)
+    if magic == b'\x1f\x8b':
+        # Decompressed on the fly while the decoder reads
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def iter_track_points(file_path):
+    with _open_track_stream(file_path) as stream:
+        head = stream.read(1024)
+        stream.seek(0)
+        track_format = detect_track_format(head)
+        if track_format == 'kmz':
+            with zipfile.ZipFile(stream) as archive:
+                kml_names = [name for name in archive.namelist() if name.lower().endswith('.kml')]
+                if not kml_names:
+                    raise ValueError("No KML document in KMZ file")
+                with archive.open(kml_names[0]) as kml_stream:
+                    yield from iter_kml(kml_stream)
+            return
+        decoders = {'gpx': iter_gpx, 'kml': iter_kml, 'geojson': iter_geojson, 'fit': iter_fit}
+        yield from decoders[track_format](stream)
+
+
+def read_track_file(file_path):
+    gpx_data = {
+        'tracks': [],
+        'waypoints': []
+    }
+    for point in iter_track_points(file_path):
+        if point['type'] == 'bus_routing':
+            gpx_data['tracks'].append(point)
+        else:
+            gpx_data['waypoints'].append(point)
+    return gpx_data
+
+
+def track_file_suffix(file_name):
+    file_name = (file_name or '').lower()
+    for extension in sorted(TRACK_EXTENSIONS, key=len, reverse=True):
+        if file_name.endswith('.' + extension):
+            return '.' + extension
+    return '.gpx'
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+
+from shapely.geometry import LineString
+from simplification.cutil import simplify_coords_vw
+
+# Builds the stored geometries of a trip. In the one-row-per-trip storage mode the M value of every
+# vertex is the point time in epoch seconds.
+
+# Points without a timestamp get this M value, the bus_route_points view turns it back into NULL
+MISSING_TIME_M = -1
+# route_points.point_type, a small integer instead of the name repeated on every row
+POINT_TYPE_CODES = {'bus_routing': 0, 'passenger_on_off': 1}
+
+
+def recorded_at(point):
+    # Stored as UTC without an offset. Times with an offset are converted, times without one are already UTC.
+    if point['time'] is None:
+        return None
+    if point['time'].tzinfo is None:
+        return point['time']
+    return point['time'].astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _m_value(point):
+    return point['time'].timestamp() if point['time'] is not None else MISSING_TIME_M
+
+
+def _coordinates(point):
+    return f"{point['lon']} {point['lat']} {_m_value(point)}"
+
+
+def linestring_m_wkt(points):
+    if not points:
+        return None
+    if len(points) == 1:
+        # A LineString needs two vertices, a single fix is stored as a zero-length line
+        points = points * 2
+    return 'LINESTRING M (' + ', '.join(_coordinates(point) for point in points) + ')'
+
+
+def multipoint_m_wkt(points):
+    if not points:
+        return None
+    return 'MULTIPOINT M (' + ', '.join(f'({_coordinates(point)})' for point in points) + ')'
+
+
+# The bus_routing points of a stored session in track order as {'lat', 'lon', 'time'}, from route_points
+# or, for sessions stored with TRIP_STORAGE_MODE=trips, from the bus_trips track. Times are UTC. Empty for
+# sessions whose points were moved to the cold archive.
+def read_session_tracks(cur, session_ref, user_id, session_id):
+    cur.execute(
+        """
+        SELECT recorded_at, ST_Y(geom_point), ST_X(geom_point)
+        FROM route_points
+        WHERE session_ref = %s AND point_type = 0
+        ORDER BY point_id
+        """, (session_ref,)
+    )
+    rows = cur.fetchall()
+    if not rows:
+        cur.execute(
+            """
+            SELECT NULLIF(ST_M(p.geom), %s), ST_Y(p.geom), ST_X(p.geom)
+            FROM bus_trips t CROSS JOIN LATERAL ST_DumpPoints(t.geom_track) AS p
+            WHERE t.user_id = %s AND t.session_id = %s
+            ORDER BY t.id, p.path[1]
+            """, (MISSING_TIME_M, user_id, session_id)
+        )
+        rows = [
+            (datetime.fromtimestamp(m, tz=timezone.utc) if m is not None else None, lat, lon)
+            for m, lat, lon in cur.fetchall()
+        ]
+    return [{'lat': lat, 'lon': lon, 'time': time} for time, lat, lon in rows]
+
+
+# Visvalingam-Whyatt simplification of the (lon, lat) route, used for simplified_bus_routes
+def simplify_route(route_points, tolerance=0.000000001):
+    line = LineString(route_points)
+    simplified = simplify_coords_vw(line.coords, tolerance)
+    return list(simplified)
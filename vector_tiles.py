@@ -0,0 +1,296 @@
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Precomputed Mapbox Vector Tiles of the simplified routes and bus stops, kept in an MBTiles file.
+# The bot only records which tiles a new route or stop touches in dirty_tiles, in the same
+# transaction as the row itself. This module renders those tiles with PostGIS ST_AsMVT, writes them
+# to the MBTiles file and serves them, so a map load is a key lookup instead of a spatial query.
+
+MIN_ZOOM = 10
+MAX_ZOOM = 16
+# Lines are sampled at a quarter of a tile at MAX_ZOOM so no tile they cross is missed
+SAMPLES_PER_TILE = 4
+TILE_URL = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)\.pbf$')
+
+TILE_QUERY = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom, ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4326) AS geom_4326
+    ),
+    routes AS (
+        SELECT r.session_id, r.vehicle_type, r.source, r.destination, r.date::text AS date,
+               ST_AsMVTGeom(ST_Transform(r.geom_line, 3857), bounds.geom) AS geom
+        FROM simplified_bus_routes r, bounds
+        WHERE r.cancel = FALSE AND r.geom_line && bounds.geom_4326
+    ),
+    stops AS (
+        SELECT s.id, s.vehicle_type, s.destination,
+               ST_AsMVTGeom(ST_Transform(ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326), 3857), bounds.geom) AS geom
+        FROM bus_stops s, bounds
+        WHERE s.cancel = FALSE AND s.same_as_stop_id IS NULL
+          AND ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326) && bounds.geom_4326
+    )
+    SELECT COALESCE((SELECT ST_AsMVT(routes, 'routes', 4096, 'geom') FROM routes WHERE geom IS NOT NULL), ''::bytea)
+        || COALESCE((SELECT ST_AsMVT(stops, 'stops', 4096, 'geom') FROM stops WHERE geom IS NOT NULL), ''::bytea)
+"""
+
+
+def _tile_xy(lon, lat, zoom):
+    lat = np.clip(np.radians(lat), -1.4844222, 1.4844222)
+    scale = 2 ** zoom
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * scale).astype(np.int64)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * scale).astype(np.int64)
+    return np.clip(x, 0, scale - 1), np.clip(y, 0, scale - 1)
+
+
+def _with_parents(x, y, min_zoom, max_zoom):
+    tiles = set()
+    for zoom in range(min_zoom, max_zoom + 1):
+        shift = max_zoom - zoom
+        tiles.update((zoom, int(tile_x), int(tile_y)) for tile_x, tile_y in set(zip(x >> shift, y >> shift)))
+    return tiles
+
+
+# Returns the (zoom, x, y) tiles a line of (lon, lat) points passes through at every zoom level
+def tiles_for_line(points, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    if not points:
+        return set()
+    coordinates = np.array(points, dtype=float).reshape(-1, 2)
+    step = 360.0 / 2 ** max_zoom / SAMPLES_PER_TILE
+    samples = [coordinates[:1]]
+    for start, end in zip(coordinates[:-1], coordinates[1:]):
+        count = max(int(math.ceil(np.abs(end - start).max() / step)), 1)
+        fractions = np.arange(1, count + 1)[:, None] / count
+        samples.append(start + (end - start) * fractions)
+    samples = np.concatenate(samples)
+    x, y = _tile_xy(samples[:, 0], samples[:, 1], max_zoom)
+    return _with_parents(x, y, min_zoom, max_zoom)
+
+
+def tiles_for_point(lon, lat, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    return tiles_for_line([(lon, lat)], min_zoom, max_zoom)
+
+
+# Same as tiles_for_line for a line read back with ST_AsText
+def tiles_for_wkt(line_wkt, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    coordinates = re.findall(r'(-?[\d.]+) (-?[\d.]+)', line_wkt or '')
+    return tiles_for_line([(float(lon), float(lat)) for lon, lat in coordinates], min_zoom, max_zoom)
+
+
+def mark_tiles_dirty(cur, tiles):
+    from psycopg2 import extras
+
+    extras.execute_batch(
+        cur, "INSERT INTO dirty_tiles (zoom, x, y) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING", sorted(tiles)
+    )
+
+
+class MBTiles:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            metadata = {
+                'name': 'Transit Lab collected routes',
+                'format': 'pbf',
+                'minzoom': str(MIN_ZOOM),
+                'maxzoom': str(MAX_ZOOM),
+                'json': json.dumps({'vector_layers': [
+                    {'id': 'routes', 'fields': {'session_id': 'String', 'vehicle_type': 'String', 'source': 'String', 'destination': 'String', 'date': 'String'}},
+                    {'id': 'stops', 'fields': {'id': 'Number', 'vehicle_type': 'String', 'destination': 'String'}},
+                ]}),
+            }
+            db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+
+    # One transaction on a connection of its own, closed afterwards, so serving threads never share one
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # MBTiles rows count tiles from the south (TMS), URLs from the north (XYZ)
+    def get(self, zoom, x, y):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x, 2 ** zoom - 1 - y)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, tiles):
+        with self._connect() as db:
+            for (zoom, x, y), data in tiles:
+                key = (zoom, x, 2 ** zoom - 1 - y)
+                if data:
+                    db.execute(
+                        "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                        key + (gzip.compress(data),)
+                    )
+                else:
+                    db.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key)
+
+
+# Renders the tiles waiting in dirty_tiles. A batch is claimed by deleting it in a transaction of its own
+# before rendering, so a route or stop saved while the batch renders queues its tiles again instead of
+# being lost with the old queue row. SKIP LOCKED lets several regenerators share the queue, and a batch
+# that fails to render or write goes back into it.
+def regenerate_dirty_tiles(conn, mbtiles, batch_size=200):
+    regenerated = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM dirty_tiles
+                WHERE (zoom, x, y) IN (SELECT zoom, x, y FROM dirty_tiles ORDER BY zoom, x, y LIMIT %s FOR UPDATE SKIP LOCKED)
+                RETURNING zoom, x, y
+                """, (batch_size,)
+            )
+            keys = cur.fetchall()
+        conn.commit()
+        if not keys:
+            return regenerated
+        try:
+            rendered = []
+            with conn.cursor() as cur:
+                for zoom, x, y in keys:
+                    cur.execute(TILE_QUERY, {'z': zoom, 'x': x, 'y': y})
+                    rendered.append(((zoom, x, y), bytes(cur.fetchone()[0])))
+            conn.rollback()
+            mbtiles.put_many(rendered)
+        except Exception:
+            conn.rollback()
+            with conn.cursor() as cur:
+                mark_tiles_dirty(cur, keys)
+            conn.commit()
+            raise
+        regenerated += len(keys)
+        logging.info(f"Regenerated {len(keys)} vector tiles")
+
+
+# Queues every tile of the existing routes and stops, for the first build or after changing zoom levels
+def mark_all_tiles_dirty(conn):
+    with conn.cursor(name='vector_tiles_routes') as cur:
+        cur.itersize = 500
+        cur.execute("SELECT ST_AsText(geom_line) FROM simplified_bus_routes WHERE cancel = FALSE AND geom_line IS NOT NULL")
+        tiles = set()
+        for (line_wkt,) in cur:
+            tiles |= tiles_for_wkt(line_wkt)
+    with conn.cursor() as cur:
+        cur.execute("SELECT lon, lat FROM bus_stops WHERE cancel = FALSE AND same_as_stop_id IS NULL AND lat IS NOT NULL AND lon IS NOT NULL")
+        for lon, lat in cur.fetchall():
+            tiles |= tiles_for_point(lon, lat)
+        mark_tiles_dirty(cur, tiles)
+    conn.commit()
+    logging.info(f"Queued {len(tiles)} vector tiles")
+
+
+def serve(mbtiles, port, regenerate=None, interval=30):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = TILE_URL.match(self.path.split('?')[0])
+            if not match:
+                self.send_error(404)
+                return
+            data = mbtiles.get(*map(int, match.groups()))
+            if data is None:
+                # No route or stop in this tile
+                self.send_response(204)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.mapbox-vector-tile')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    if regenerate is not None:
+        def regenerate_forever():
+            while True:
+                try:
+                    regenerate()
+                except Exception as e:
+                    logging.error(f"Error regenerating vector tiles: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=regenerate_forever, daemon=True).start()
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), TileHandler)
+    logging.info(f"Serving vector tiles on http://127.0.0.1:{port}/tiles/{{z}}/{{x}}/{{y}}.pbf")
+    server.serve_forever()
+
+
+def main() -> None:
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build, update and serve vector tiles of the collected routes and stops")
+    parser.add_argument('--mbtiles', default=os.getenv('TILES_PATH', os.path.join(os.getcwd(), 'tiles.mbtiles')))
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('build', help="queue and render the tiles of all existing routes and stops")
+    commands.add_parser('update', help="render the tiles touched since the last update")
+    serve_command = commands.add_parser('serve', help="serve the tiles and keep rendering touched tiles")
+    serve_command.add_argument('--port', type=int, default=int(os.getenv('TILES_PORT', 8090)))
+    serve_command.add_argument('--interval', type=float, default=30, help="seconds between updates of touched tiles")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    mbtiles = MBTiles(args.mbtiles)
+
+    def connect():
+        return psycopg2.connect(
+            host=os.getenv('DB_HOST'),
+            port=os.getenv('DB_PORT'),
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD'),
+            dbname=os.getenv('DB_NAME')
+        )
+
+    if args.command == 'serve':
+        conn = connect()
+
+        def regenerate():
+            try:
+                regenerate_dirty_tiles(conn, mbtiles)
+            except Exception:
+                conn.rollback()
+                raise
+
+        serve(mbtiles, args.port, regenerate=regenerate, interval=args.interval)
+        return
+
+    conn = connect()
+    try:
+        if args.command == 'build':
+            mark_all_tiles_dirty(conn)
+        regenerate_dirty_tiles(conn, mbtiles)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()